@@ -1,13 +1,12 @@
 #!/usr/bin/env python
 
-import pandas as pd
 from datetime import datetime
-import os
-from collections import OrderedDict
 import numpy as np
 
 import matplotlib.pyplot as plt
 
+from fss_query import get_fss
+
 # Set publication-quality style
 plt.style.use('seaborn-v0_8-whitegrid')
 plt.rcParams.update({
@@ -57,55 +56,21 @@ REGION_SEL = "NORTH_SWEDEN"
 REGION_SEL = "NORTH_SCAND"
 regions = ["full"] #,"north_scand"]
 
-def load_fss_data(model_path, region):
-    """Load FSS data for a specific model and region, avoiding concat warning."""
-    all_results = os.listdir(model_path)
-    fss_files = OrderedDict()
-    # Load FSS files
-    for f in all_results:
-        if f.endswith("_nbrcnt.txt"):
-            read_date = f.split("_")[3]
-            print(read_date)
-            fss_files[read_date] = pd.read_csv(os.path.join(model_path, f), sep=r'\s+')
-    # Collect rows in a list
-    rows = []
-    for key in fss_files:
-        data = fss_files[key][fss_files[key]["VX_MASK"] == region]
-        for _, r in data.iterrows():
-            conv_date = datetime.strptime(r["FCST_VALID_BEG"], "%Y%m%d_%H%M%S")
-            rows.append({
-                "date": conv_date,
-                "points": r["INTERP_PNTS"],
-                "fss": r["FSS"]
-            })
-    df_fss = pd.DataFrame(rows, columns=["date", "points", "fss"])
-    return df_fss
-
-# Load data for both models and regions
-model_data = {}
-for model_name, model_config in models.items():
-    model_data[model_name] = {
-        'full': load_fss_data(model_config['path'], REGION)
-        #'north_scand': load_fss_data(model_config['path'], REGION_SEL)
-    }
-
-# Filter data for the specified time period and extract relevant scales (points 1 and 25)
+# Load both models and regions for the time period and relevant scales (points 1 and 25)
+# in one cached query
+region_names = {'full': REGION, 'north_scand': REGION_SEL}
 scales_to_plot = [1, 25]
+# add months=[11, 12, 1, 2] to keep only the winter months
+fss = get_fss({model_name: model_config['path'] for model_name, model_config in models.items()},
+              [region_names[region_key] for region_key in regions], scales_to_plot,
+              (date_ini, date_end))
 filtered_data = {}
 
 for model_name in models.keys():
     filtered_data[model_name] = {}
     for region_key in regions: #['full', 'north_sweden']:
-        df = model_data[model_name][region_key]
-        # Filter by date range and scales
-        df_filtered = df[
-            (df.date >= date_ini) & 
-            (df.date <= date_end) & 
-            (df.points.isin(scales_to_plot))
-        ].sort_values('date')
-        # Filter to only winter months (Dec, Jan, Feb)
-        #df_filtered = df_filtered[df_filtered['date'].dt.month.isin([11,12,1,2])]
-        filtered_data[model_name][region_key] = df_filtered
+        region = region_names[region_key]
+        filtered_data[model_name][region_key] = fss[(fss.model == model_name) & (fss.region == region)]
 
 # Create comparison plots
 fig, axes = plt.subplots(2, 2, figsize=(16, 12))
@@ -2,12 +2,12 @@
 
 import pandas as pd
 from datetime import datetime
-import os
-from collections import OrderedDict
 import numpy as np
 
 import matplotlib.pyplot as plt
 
+from fss_query import get_fss
+
 # Set publication-quality style
 plt.style.use('seaborn-v0_8-whitegrid')
 plt.rcParams.update({
@@ -55,59 +55,17 @@ date_end = datetime(2019, 9, 11)
 REGION = "FULL"
 REGION_SEL = "NORTH_SWEDEN"
 
-def load_fss_data(model_path, region):
-    """Load FSS data for a specific model and region"""
-    all_results = os.listdir(model_path)
-    fss_files = OrderedDict()
-    
-    # Load FSS files
-    for f in all_results:
-        if f.endswith("_nbrcnt.txt"):
-            read_date = f.split("_")[3]
-            fss_files[read_date] = pd.read_csv(os.path.join(model_path, f), sep=r'\s+')
-    
-    # Create dataframe
-    df_fss = pd.DataFrame(columns=["date", "points", "fss"])
-    
-    for key in fss_files:
-        data = fss_files[key][fss_files[key]["VX_MASK"] == region]
-        for _, r in data.iterrows():
-            conv_date = datetime.strptime(r["FCST_VALID_BEG"], "%Y%m%d_%H%M%S")
-            data_row = pd.DataFrame({
-                "date": [conv_date],
-                "points": [r["INTERP_PNTS"]],
-                "fss": [r["FSS"]]
-            }, columns=["date", "points", "fss"])
-            df_fss = pd.concat([df_fss, data_row], ignore_index=True)
-    
-    return df_fss
-
-# Load data for both models and regions
-model_data = {}
-for model_name, model_config in models.items():
-    model_data[model_name] = {
-        'full': load_fss_data(model_config['path'], REGION),
-        'north_sweden': load_fss_data(model_config['path'], REGION_SEL)
-    }
-
-# Filter data for the specified time period and extract relevant scales (points 1 and 25)
+# Load both models and regions for the time period, relevant scales (points 1 and 25)
+# and only winter months (Dec, Jan, Feb), in one cached query
 scales_to_plot = [1, 25]
+fss = get_fss({model_name: model_config['path'] for model_name, model_config in models.items()},
+              [REGION, REGION_SEL], scales_to_plot, (date_ini, date_end), months=[12, 1, 2])
 filtered_data = {}
 
 for model_name in models.keys():
     filtered_data[model_name] = {}
-    for region_key in ['full', 'north_sweden']:
-        df = model_data[model_name][region_key]
-        # Filter by date range and scales
-        df_filtered = df[
-            (df.date >= date_ini) & 
-            (df.date <= date_end) & 
-            (df.points.isin(scales_to_plot))
-        ].sort_values('date')
-        filtered_data[model_name][region_key] = df_filtered
-        # Filter to only winter months (Dec, Jan, Feb)
-        df_filtered = df_filtered[df_filtered['date'].dt.month.isin([12,1,2])]
-        filtered_data[model_name][region_key] = df_filtered
+    for region_key, region in [('full', REGION), ('north_sweden', REGION_SEL)]:
+        filtered_data[model_name][region_key] = fss[(fss.model == model_name) & (fss.region == region)]
 
 
 
@@ -117,6 +75,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 from scipy import stats
 
+from fss_bootstrap import fss_difference_test
+
 # Set publication-quality style
 plt.style.use('seaborn-v0_8-whitegrid')
 plt.rcParams.update({
@@ -354,6 +314,12 @@ def create_summary_table(filtered_data):
                     wins_carra1 = (merged['fss_carra1'] > merged['fss_cerise']).sum()
                     wins_cerise = (merged['fss_cerise'] > merged['fss_carra1']).sum()
                     total_comparisons = len(merged)
+
+                    # Moving-block bootstrap CI and paired permutation p-value of the difference
+                    boot = fss_difference_test(
+                        carra1_scale.astype({'points': int, 'fss': float}).assign(region=region_name),
+                        cerise_scale.astype({'points': int, 'fss': float}).assign(region=region_name),
+                        n_rep=10000, block_length=7, seed=1, use_sums=False).iloc[0]
                     
                     summary_data.append({
                         'Region': region_name,
@@ -361,6 +327,8 @@ def create_summary_table(filtered_data):
                         'CERISE Mean': cerise_fss.mean(),
                         'CARRA1 Mean': carra1_fss.mean(),
                         'Mean Difference': mean_diff,
+                        'Difference 95% CI': f"[{boot['ci_low']:.4f}, {boot['ci_high']:.4f}]",
+                        'p-value (permutation)': boot['p_value'],
                         'CARRA1 Wins': f"{wins_carra1}/{total_comparisons}",
                         'CERISE Wins': f"{wins_cerise}/{total_comparisons}",
                         'Win Percentage CARRA1': f"{100*wins_carra1/total_comparisons:.1f}%",
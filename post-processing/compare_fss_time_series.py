@@ -1,13 +1,12 @@
 #!/usr/bin/env python
 
-import pandas as pd
 from datetime import datetime
-import os
-from collections import OrderedDict
 import numpy as np
 
 import matplotlib.pyplot as plt
 
+from met_ingest import load_fss_data
+
 # Set publication-quality style
 plt.style.use('seaborn-v0_8-whitegrid')
 plt.rcParams.update({
@@ -55,32 +54,6 @@ date_end = datetime(2015, 12, 31)
 REGION = "FULL"
 REGION_SEL = "NORTH_SWEDEN"
 
-def load_fss_data(model_path, region):
-    """Load FSS data for a specific model and region"""
-    all_results = os.listdir(model_path)
-    fss_files = OrderedDict()
-    
-    # Load FSS files
-    for f in all_results:
-        if f.endswith("_nbrcnt.txt"):
-            read_date = f.split("_")[3]
-            fss_files[read_date] = pd.read_csv(os.path.join(model_path, f), sep=r'\s+')
-    
-    # Create dataframe
-    df_fss = pd.DataFrame(columns=["date", "points", "fss"])
-    
-    for key in fss_files:
-        data = fss_files[key][fss_files[key]["VX_MASK"] == region]
-        for _, r in data.iterrows():
-            conv_date = datetime.strptime(r["FCST_VALID_BEG"], "%Y%m%d_%H%M%S")
-            data_row = pd.DataFrame({
-                "date": [conv_date],
-                "points": [r["INTERP_PNTS"]],
-                "fss": [r["FSS"]]
-            }, columns=["date", "points", "fss"])
-            df_fss = pd.concat([df_fss, data_row], ignore_index=True)
-    return df_fss
-
 # Load data for both models and regions
 model_data = {}
 for model_name, model_config in models.items():
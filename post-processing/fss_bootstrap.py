@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+"""
+Resampling tests for the FSS difference between two models.
+
+MET runs with boot.n_rep = 0, so the daily comparisons in
+compare_fss_highlight.py come without uncertainty. This module computes,
+for every (region, points) combination:
+- a moving-block bootstrap confidence interval of the FSS difference
+- a paired (block) permutation p-value for the difference
+
+The input is a per-day table per model. When the FSS numerator and
+denominator sums are available (fss_num = sum (Pf-Po)^2 and
+fss_den = sum Pf^2 + sum Po^2) the aggregated FSS 1 - sum(fss_num)/sum(fss_den)
+is resampled; otherwise the mean of the daily FSS values is used.
+
+All replicates are drawn at once with a seeded numpy.random.Generator and
+evaluated as one matrix product per scale, scales are processed in
+parallel threads.
+
+Usage:
+    python fss_bootstrap.py CARRA1=/path/MET_CARRA1_vs_IMS_paper \
+        CERISE=/path/MET_CERISE_vs_IMS_paper --months 12 1 2 --output boot.csv
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from met_ingest import met_files, read_met_files
+
+KEYS = ["region", "points"]
+# below this 1 - FSS, the 5 decimals of the MET FSS give fss_den to worse than 0.5 %
+MIN_FSS_GAP = 1e-3
+
+
+def load_nbrcnt(met_dir):
+    """
+    Reads all _nbrcnt.txt files of a MET output directory in one table.
+
+    Returns:
+        pd.DataFrame: columns date, region, points, n, fss, fss_num, fss_den
+    """
+    files = met_files(met_dir, ["nbrcnt"])
+    if not files:
+        return pd.DataFrame(columns=["date"] + KEYS + ["n", "fss", "fss_num", "fss_den"])
+    return partial_sums_from_nbrcnt(read_met_files(files)["nbrcnt"].to_pandas())
+
+
+def partial_sums_from_nbrcnt(df):
+    """
+    Recovers the FSS numerator and denominator sums from MET NBRCNT lines.
+
+    FBS = fss_num / TOTAL and FSS = 1 - FBS / FBS_ref with
+    FBS_ref = fss_den / TOTAL, so fss_den = fss_num / (1 - FSS). MET writes
+    FSS with 5 decimals, which leaves 1 - FSS too imprecise (and undefined
+    at FSS = 1) when it is below MIN_FSS_GAP. There fss_den comes from the
+    rates: F_RATE and O_RATE are the means of the fractions, which are in
+    [0, 1], so TOTAL * (F_RATE + O_RATE) >= sum Pf^2 + sum Po^2, with
+    equality for 0/1 fractions (e.g. fully snow-covered at FSS = 1). It
+    also caps the other values. Entries that still have no sums (no
+    F_RATE/O_RATE columns, NA values) get NaN and are counted.
+    """
+    fbs = df["FBS"].astype(float)
+    fss = df["FSS"].astype(float)
+    total = df["TOTAL"].astype(float)
+    fss_num = fbs * total
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fss_den = (fss_num / (1.0 - fss)).where(1.0 - fss >= MIN_FSS_GAP)
+    if {"F_RATE", "O_RATE"} <= set(df.columns):
+        bound = total * (df["F_RATE"].astype(float) + df["O_RATE"].astype(float))
+        fss_den = fss_den.where(fss_den.isna(), np.minimum(fss_den, bound)).fillna(bound)
+        fss_den = fss_den.where(fss_num.notna())
+    missing = int((fss_num.isna() | fss_den.isna()).sum())
+    if missing:
+        print(f"{missing} of {len(df)} NBRCNT lines without FSS partial sums, left out of the sums")
+    return pd.DataFrame({
+        "date": pd.to_datetime(df["FCST_VALID_BEG"], format="%Y%m%d_%H%M%S"),
+        "region": df["VX_MASK"],
+        "points": df["INTERP_PNTS"].astype(int),
+        "n": total,
+        "fss": fss,
+        "fss_num": fss_num,
+        "fss_den": fss_den,
+    })
+
+
+def date_runs(dates):
+    """
+    Run of consecutive days of every date: a new run starts after a gap
+    of more than one day (e.g. between the DJF of two winters).
+
+    Returns:
+        np.ndarray: Run number of every date (sorted dates).
+    """
+    gaps = np.diff(pd.DatetimeIndex(dates).values) > np.timedelta64(1, "D")
+    return np.concatenate([[0], np.cumsum(gaps)])
+
+
+def _run_bounds(runs):
+    """First index and length of the run of every day."""
+    _, first, length = np.unique(runs, return_index=True, return_counts=True)
+    return first[runs], length[runs]
+
+
+def block_bootstrap_counts(n, n_rep, block_length, rng, runs=None):
+    """
+    Moving-block bootstrap as a (n_rep, n) matrix of day multiplicities.
+
+    Each replicate concatenates randomly placed blocks of block_length
+    consecutive days, cut to n days. Counting how often every day is drawn
+    turns the resampled sums into one matrix product. With runs (see
+    date_runs) a block never leaves the run of its first day: it wraps
+    around to the start of the run (circular block bootstrap per run), so
+    28 February is not joined to the next 1 December.
+    """
+    block_length = max(1, min(block_length, n))
+    n_blocks = -(-n // block_length)
+    if runs is None:
+        starts = rng.integers(0, n - block_length + 1, size=(n_rep, n_blocks))
+        idx = starts[..., None] + np.arange(block_length)
+    else:
+        first, length = _run_bounds(np.asarray(runs))
+        starts = rng.integers(0, n, size=(n_rep, n_blocks))
+        offset = (starts - first[starts])[..., None] + np.arange(block_length)
+        idx = first[starts][..., None] + offset % length[starts][..., None]
+    idx = idx.reshape(n_rep, -1)[:, :n]
+    flat = idx + n * np.arange(n_rep)[:, None]
+    return np.bincount(flat.ravel(), minlength=n_rep * n).reshape(n_rep, n).astype(float)
+
+
+def block_swap_signs(n, n_rep, block_length, rng, runs=None):
+    """
+    Paired permutation: a (n_rep, n) 0/1 matrix telling on which days the two
+    models are swapped. Days are swapped in blocks of block_length, which
+    start again at the first day of every run if runs are given.
+    """
+    block_length = max(1, block_length)
+    if runs is None:
+        block = np.arange(n) // block_length
+    else:
+        first, _ = _run_bounds(np.asarray(runs))
+        new_block = (np.arange(n) - first) % block_length == 0
+        block = np.cumsum(new_block) - 1
+    swap = rng.integers(0, 2, size=(n_rep, block[-1] + 1 if n else 0))
+    return swap[:, block].astype(float)
+
+
+def _score(num, den, use_sums):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = num / den
+    return 1.0 - ratio if use_sums else ratio
+
+
+def _prepare(a, b, use_sums):
+    """Numerator/denominator arrays (days, regions) for both models."""
+    if use_sums:
+        ok = (a["fss_num"].notna() & a["fss_den"].notna()
+              & b["fss_num"].notna() & b["fss_den"].notna()).values
+        parts = [np.where(ok, x.values, 0.0) for x in
+                 (a["fss_num"], a["fss_den"], b["fss_num"], b["fss_den"])]
+    else:
+        ok = (a["fss"].notna() & b["fss"].notna()).values
+        parts = [np.where(ok, a["fss"].values, 0.0), ok.astype(float),
+                 np.where(ok, b["fss"].values, 0.0), ok.astype(float)]
+    return [np.asarray(p, dtype=float) for p in parts], ok
+
+
+def _test_scale(a, b, counts, swaps, use_sums, ci_alpha):
+    """Bootstrap CI and permutation p-value for all regions of one scale."""
+    (a_num, a_den, b_num, b_den), ok = _prepare(a, b, use_sums)
+    fss_a = _score(a_num.sum(0), a_den.sum(0), use_sums)
+    fss_b = _score(b_num.sum(0), b_den.sum(0), use_sums)
+    diff = fss_a - fss_b
+
+    boot = (_score(counts @ a_num, counts @ a_den, use_sums)
+            - _score(counts @ b_num, counts @ b_den, use_sums))
+    ci_low, ci_high = np.nanquantile(boot, [ci_alpha / 2, 1 - ci_alpha / 2], axis=0)
+
+    # swapping a day moves its contribution from one model to the other
+    perm_a_num = a_num.sum(0) + swaps @ (b_num - a_num)
+    perm_a_den = a_den.sum(0) + swaps @ (b_den - a_den)
+    perm_b_num = b_num.sum(0) - swaps @ (b_num - a_num)
+    perm_b_den = b_den.sum(0) - swaps @ (b_den - a_den)
+    perm = _score(perm_a_num, perm_a_den, use_sums) - _score(perm_b_num, perm_b_den, use_sums)
+    exceed = (np.abs(perm) >= np.abs(diff) - 1e-12).sum(0)
+    p_value = (1 + exceed) / (1 + swaps.shape[0])
+
+    return pd.DataFrame({
+        "n_days": ok.sum(0),
+        "fss_a": fss_a,
+        "fss_b": fss_b,
+        "diff": diff,
+        "ci_low": ci_low,
+        "ci_high": ci_high,
+        "p_value": p_value,
+    }, index=pd.Index(a.columns.get_level_values("region").unique(), name="region"))
+
+
+def fss_difference_test(df_a, df_b, n_rep=10000, block_length=7, ci_alpha=0.05,
+                        seed=None, use_sums=None, workers=None):
+    """
+    Block bootstrap CIs and permutation p-values of FSS(a) - FSS(b).
+
+    Args:
+        df_a (pd.DataFrame): Daily table of model a with columns date,
+            region, points and fss and/or fss_num, fss_den.
+        df_b (pd.DataFrame): Same for model b.
+        n_rep (int): Number of bootstrap and permutation replicates.
+        block_length (int): Block length in days (autocorrelation of the
+            daily scores). Blocks stay within runs of consecutive dates.
+        ci_alpha (float): Confidence level as in ci_alpha of the
+            GridStatConfig files.
+        seed (int): Seed of the random generator.
+        use_sums (bool): Resample the partial sums instead of the daily
+            FSS. Defaults to True when both tables have fss_num/fss_den.
+        workers (int): Number of threads, one scale per task.
+
+    Returns:
+        pd.DataFrame: One row per (region, points) with the number of days,
+        the FSS of both models, the difference, its CI and the p-value.
+    """
+    if use_sums is None:
+        use_sums = all({"fss_num", "fss_den"} <= set(d.columns) for d in (df_a, df_b))
+    values = ["fss_num", "fss_den"] if use_sums else ["fss"]
+    wide_a = df_a.pivot_table(index="date", columns=KEYS, values=values, aggfunc="first")
+    wide_b = df_b.pivot_table(index="date", columns=KEYS, values=values, aggfunc="first")
+    dates = wide_a.index.intersection(wide_b.index).sort_values()
+    wide_a, wide_b = wide_a.loc[dates], wide_b.loc[dates]
+
+    rng = np.random.default_rng(seed)
+    runs = date_runs(dates)
+    counts = block_bootstrap_counts(len(dates), n_rep, block_length, rng, runs)
+    swaps = block_swap_signs(len(dates), n_rep, block_length, rng, runs)
+
+    def run(points):
+        a = wide_a.xs(points, axis=1, level="points")
+        b = wide_b.xs(points, axis=1, level="points").reindex(columns=a.columns)
+        a = a.reindex(columns=pd.MultiIndex.from_product(
+            [values, a.columns.get_level_values("region").unique()], names=[None, "region"]))
+        b = b.reindex(columns=a.columns)
+        res = _test_scale(a, b, counts, swaps, use_sums, ci_alpha)
+        res.insert(0, "points", points)
+        return res
+
+    scales = sorted(set(wide_a.columns.get_level_values("points"))
+                    & set(wide_b.columns.get_level_values("points")))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run, scales))
+    if not results:
+        return pd.DataFrame()
+    out = pd.concat(results).reset_index()
+    return out[["region", "points", "n_days", "fss_a", "fss_b", "diff",
+                "ci_low", "ci_high", "p_value"]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("model_a", help="NAME=MET output dir of the first model")
+    parser.add_argument("model_b", help="NAME=MET output dir of the second model")
+    parser.add_argument("--date-ini", default="2015-09-01")
+    parser.add_argument("--date-end", default="2019-09-11")
+    parser.add_argument("--months", type=int, nargs="*", help="Keep only these months")
+    parser.add_argument("--n-rep", type=int, default=10000)
+    parser.add_argument("--block-length", type=int, default=7,
+                        help="Days per block, blocks do not cross gaps in the dates (e.g. --months)")
+    parser.add_argument("--ci-alpha", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--daily-fss", action="store_true",
+                        help="Resample the daily FSS instead of the partial sums")
+    parser.add_argument("--output", default="fss_bootstrap.csv")
+    args = parser.parse_args()
+
+    tables = []
+    for spec in (args.model_a, args.model_b):
+        name, path = spec.split("=", 1)
+        df = load_nbrcnt(path)
+        df = df[(df.date >= args.date_ini) & (df.date <= args.date_end)]
+        if args.months:
+            df = df[df.date.dt.month.isin(args.months)]
+        tables.append((name, df))
+    (name_a, df_a), (name_b, df_b) = tables
+
+    result = fss_difference_test(df_a, df_b, n_rep=args.n_rep,
+                                 block_length=args.block_length,
+                                 ci_alpha=args.ci_alpha, seed=args.seed,
+                                 use_sums=False if args.daily_fss else None)
+    result = result.rename(columns={"fss_a": f"fss_{name_a}", "fss_b": f"fss_{name_b}"})
+    print(f"FSS difference {name_a} - {name_b}")
+    print(result.to_string(index=False))
+    result.to_csv(args.output, index=False)
+    print(f"Saved: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""
+Memoized FSS queries for the post-processing scripts and notebooks.
+
+The comparison scripts loaded, filtered by VX_MASK and pivoted the same
+MET output several times (per model, per region). get_fss answers a
+whole selection (models, regions, scales, date range, months) in one
+call, as a tidy (model, region, date, points, fss) frame or pivoted by
+date, from
+- MET output directories (read with met_ingest), or
+- a stats_catalog.py database (catalog=...)
+with two caches:
+- in-process LRU caches of the parsed _nbrcnt.txt lines of a directory
+  and of the query results
+- an on-disk cache (one Parquet file per query) under FSS_QUERY_CACHE
+  (default ~/.cache/fss_query), shared by scripts and notebooks
+Both are keyed on the query and the version of the store: number, total
+size and latest mtime of the _nbrcnt.txt files, or size and mtime of the
+catalog, so new MET output or a catalog update is picked up. Writing the
+result of a new version removes the on-disk files of the older ones.
+
+Usage:
+    from fss_query import get_fss
+    fss = get_fss({"CERISE": cerise_dir, "CARRA1": carra1_dir}, ["FULL", "NORTH_SWEDEN"],
+                  scales=[1, 25], date_range=(date_ini, date_end), months=[12, 1, 2])
+    python fss_query.py CERISE=/path/MET_CERISE_vs_IMS_paper --regions FULL --scales 1 25 --pivot
+"""
+
+import argparse
+import functools
+import hashlib
+import os
+
+import pandas as pd
+
+from met_ingest import read_line_type
+from stats_catalog import StatsCatalog
+
+CACHE_DIR = os.environ.get("FSS_QUERY_CACHE",
+                           os.path.join(os.path.expanduser("~"), ".cache", "fss_query"))
+FSS_COLUMNS = ["model", "region", "date", "points", "fss"]
+
+
+def store_version(sources, catalog=None):
+    """
+    Version of the data behind a query: size and mtime of the catalog, or
+    number, total size and latest mtime of the _nbrcnt.txt files of every
+    MET directory.
+    """
+    if catalog is not None:
+        info = os.stat(catalog)
+        return f"catalog-{info.st_size}-{info.st_mtime_ns}"
+    versions = []
+    for _, met_dir in sources:
+        n = size = mtime = 0
+        with os.scandir(met_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith("_nbrcnt.txt"):
+                    info = entry.stat()
+                    n, size, mtime = n + 1, size + info.st_size, max(mtime, info.st_mtime_ns)
+        versions.append(f"{n}-{size}-{mtime}")
+    return "/".join(versions)
+
+
+@functools.lru_cache(maxsize=8)
+def _nbrcnt(met_dir, version):
+    """NBRCNT lines of a directory, parsed once per version."""
+    return read_line_type(met_dir, "nbrcnt")[["VX_MASK", "FCST_VALID_BEG", "INTERP_PNTS", "FSS"]]
+
+
+def _select(df, regions, scales, start, end, months):
+    keep = pd.Series(True, index=df.index)
+    if regions is not None:
+        keep &= df["region"].isin(regions)
+    if scales is not None:
+        keep &= df["points"].isin(scales)
+    if start is not None:
+        keep &= df["date"] >= pd.Timestamp(start)
+    if end is not None:
+        keep &= df["date"] <= pd.Timestamp(end)
+    if months is not None:
+        keep &= df["date"].dt.month.isin(months)
+    return df[keep]
+
+
+def _load(sources, catalog, obs, version, regions, scales, start, end, months):
+    if catalog is not None:
+        store = StatsCatalog(catalog)
+        df = store.query(["FSS"], [model for model, _ in sources], None if obs is None else [obs],
+                         regions, ["nbrcnt"], scales, start, end, months)
+        store.close()
+        n_obs = df.groupby("model")["obs"].nunique()
+        if (n_obs > 1).any():
+            mixed = ", ".join(n_obs.index[n_obs > 1])
+            raise ValueError(f"{mixed} verified against several observations in {catalog}, "
+                             "give obs")
+        return df.rename(columns={"value": "fss"})[FSS_COLUMNS]
+    frames = []
+    for (model, met_dir), dir_version in zip(sources, version.split("/")):
+        nbrcnt = _nbrcnt(met_dir, dir_version)
+        df = pd.DataFrame({
+            "model": model,
+            "region": nbrcnt["VX_MASK"],
+            "date": pd.to_datetime(nbrcnt["FCST_VALID_BEG"]).astype("datetime64[ns]"),
+            "points": nbrcnt["INTERP_PNTS"].astype(int),
+            "fss": nbrcnt["FSS"],
+        })
+        frames.append(_select(df, regions, scales, start, end, months))
+    return pd.concat(frames, ignore_index=True)
+
+
+def _digest(key):
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+@functools.lru_cache(maxsize=32)
+def _query(sources, catalog, obs, version, regions, scales, start, end, months, cache_dir):
+    # <query>-<version>.parquet, so that the files of older versions can be found
+    query = _digest((sources, catalog, obs, regions, scales, start, end, months))
+    name = f"{query}-{_digest(version)[:16]}.parquet"
+    path = None
+    if cache_dir:
+        path = os.path.join(cache_dir, name)
+        if os.path.isfile(path):
+            return pd.read_parquet(path)
+    df = _load(sources, catalog, obs, version, regions, scales, start, end, months)
+    df = df.sort_values(["model", "region", "date", "points"], ignore_index=True)
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        df.to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+        for old in os.listdir(cache_dir):
+            if old.startswith(f"{query}-") and old.endswith(".parquet") and old != name:
+                try:
+                    os.remove(os.path.join(cache_dir, old))
+                except FileNotFoundError:  # removed by another process
+                    pass
+    return df
+
+
+def _tuple(values):
+    return None if values is None else tuple(sorted(values))
+
+
+def get_fss(models, regions=None, scales=None, date_range=None, months=None, pivot=False,
+            catalog=None, obs=None, cache_dir=CACHE_DIR):
+    """
+    Daily FSS of a selection.
+
+    Args:
+        models (dict or list): Model name -> MET output directory, or the
+            model names in the catalog.
+        regions (list): VX_MASK names, None for all.
+        scales (list): Points (INTERP_PNTS), e.g. [1, 25], None for all.
+        date_range (tuple): (start, end), both included, either can be None.
+        months (list): Keep only these months, e.g. [12, 1, 2].
+        pivot (bool): Dates as rows and (model, region, points) as columns.
+        catalog (str): stats_catalog.py database to read instead of the MET directories.
+        obs (str): Observation source of the catalog rows, e.g. IMS; needed when a
+            model is catalogued against several (a MET directory has one).
+        cache_dir (str): On-disk cache, None to keep the in-process cache only.
+
+    Returns:
+        pd.DataFrame: model, region, date, points, fss (a copy, free to modify)
+    """
+    if isinstance(models, dict):
+        sources = tuple(sorted((model, os.path.abspath(path)) for model, path in models.items()))
+    else:
+        if catalog is None:
+            raise ValueError("give the MET directories of the models ({name: path}) or a catalog")
+        sources = tuple((model, None) for model in sorted(models))
+    catalog = None if catalog is None else os.path.abspath(catalog)
+    start, end = date_range if date_range is not None else (None, None)
+    start = None if start is None else pd.Timestamp(start).isoformat()
+    end = None if end is None else pd.Timestamp(end).isoformat()
+    df = _query(sources, catalog, obs, store_version(sources, catalog), _tuple(regions),
+                _tuple(scales), start, end, _tuple(months), cache_dir)
+    if pivot:
+        return df.pivot_table(index="date", columns=["model", "region", "points"], values="fss")
+    return df.copy()
+
+
+def clear_cache(cache_dir=CACHE_DIR):
+    """Empties the in-process caches and removes the on-disk cache files."""
+    _nbrcnt.cache_clear()
+    _query.cache_clear()
+    if cache_dir and os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            if name.endswith(".parquet"):
+                os.remove(os.path.join(cache_dir, name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("models", nargs="+",
+                        help="NAME=MET output directory, or NAME with --catalog")
+    parser.add_argument("--catalog", help="stats_catalog.py database")
+    parser.add_argument("--obs", help="Observation source in the catalog, e.g. IMS")
+    parser.add_argument("--regions", nargs="*")
+    parser.add_argument("--scales", type=int, nargs="*", help="Points, e.g. 1 25")
+    parser.add_argument("--date-ini")
+    parser.add_argument("--date-end")
+    parser.add_argument("--months", type=int, nargs="*")
+    parser.add_argument("--pivot", action="store_true", help="Dates as rows")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use the on-disk cache")
+    parser.add_argument("--clear-cache", action="store_true", help="Empty the on-disk cache first")
+    parser.add_argument("--output", help="Write the result to this CSV file")
+    args = parser.parse_args()
+
+    if args.clear_cache:
+        clear_cache()
+    models = args.models
+    if args.catalog is None:
+        models = dict(spec.split("=", 1) for spec in args.models)
+    result = get_fss(models, args.regions, args.scales, (args.date_ini, args.date_end),
+                     args.months, args.pivot, args.catalog, args.obs,
+                     None if args.no_cache else CACHE_DIR)
+    print(result.to_string())
+    if args.output:
+        result.to_csv(args.output)
+        print(f"Saved: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
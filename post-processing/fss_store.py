@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Store of the daily FSS partial sums and aggregated FSS queries.
+
+Averaging daily FSS values (as the plotting scripts do) does not give the
+FSS of a period: the FSS of several days is
+1 - sum(fss_num) / sum(fss_den), with fss_num = sum (Pf-Po)^2 and
+fss_den = sum Pf^2 + sum Po^2 over the points of each day.
+
+The store is one Parquet table with a row per model, day, region and
+scale (points = width^2, as INTERP_PNTS in MET) holding n, fss_num and
+fss_den. It is built from
+- MET output directories (_nbrcnt.txt, sums recovered from FBS, FSS,
+  F_RATE and O_RATE, also on the FSS = 1 days, see
+  fss_bootstrap.partial_sums_from_nbrcnt)
+- native verification tables (verification/native/multi_model_verify.py,
+  stats TOTAL, FSS_NUM and FSS_DEN)
+and updated in place when a model is re-ingested.
+
+FSSStore answers queries by summing the stored partials: the FSS of any
+date window of one model/region/scale comes from cumulative sums (two
+lookups), and grouped queries (month, season, winter, year) from one
+groupby over the filtered rows.
+
+Usage:
+    python fss_store.py build --store fss_partials.parquet \
+        --met CERISE=/path/MET_CERISE_vs_IMS_paper --native vx.parquet
+    python fss_store.py query --store fss_partials.parquet --models CERISE CARRA1 \
+        --regions FULL --months 12 1 2 --by winter
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from fss_bootstrap import load_nbrcnt
+
+STORE_COLUMNS = ["model", "date", "region", "points", "n", "fss_num", "fss_den"]
+GROUPINGS = ("month", "season", "winter", "year")
+SEASONS = np.array(["DJF", "DJF", "MAM", "MAM", "MAM", "JJA",
+                    "JJA", "JJA", "SON", "SON", "SON", "DJF"])
+
+
+def partials_from_met(met_dir, model):
+    """Partial sums of all _nbrcnt.txt files of a MET output directory."""
+    df = load_nbrcnt(met_dir)
+    return df.assign(model=model)[STORE_COLUMNS]
+
+
+def partials_from_native(table):
+    """
+    Partial sums from a multi_model_verify.py table (date, model, obs,
+    region, width, stat, value).
+    """
+    df = table[table["stat"].isin(["TOTAL", "FSS_NUM", "FSS_DEN"])]
+    wide = df.pivot_table(index=["model", "date", "region", "width"], columns="stat",
+                          values="value", aggfunc="first").reset_index()
+    return pd.DataFrame({
+        "model": wide["model"],
+        "date": pd.to_datetime(wide["date"]),
+        "region": wide["region"],
+        "points": wide["width"].astype(int) ** 2,
+        "n": wide["TOTAL"],
+        "fss_num": wide["FSS_NUM"],
+        "fss_den": wide["FSS_DEN"],
+    })
+
+
+def update_store(path, partials):
+    """Adds partial sums to the store, replacing rows of the same key."""
+    if os.path.isfile(path):
+        partials = pd.concat([pd.read_parquet(path), partials], ignore_index=True)
+    partials = partials.drop_duplicates(["model", "date", "region", "points"], keep="last")
+    partials = partials.sort_values(["model", "region", "points", "date"], ignore_index=True)
+    partials.to_parquet(path, index=False)
+    print(f"Store {path}: {len(partials)} rows")
+    return partials
+
+
+def period_labels(dates, by):
+    """Group labels of the dates. Winter and DJF include the previous December."""
+    # month, season and year as period_labels in verification/native/contingency_maps.py,
+    # keep the two in step
+    dates = pd.DatetimeIndex(dates)
+    if by == "month":
+        return np.asarray(dates.strftime("%Y-%m"))
+    if by == "year":
+        return np.asarray(dates.strftime("%Y"))
+    winter_year = dates.year + (dates.month == 12)
+    if by == "season":
+        return np.array([f"{y}-{s}" for y, s in zip(winter_year, SEASONS[dates.month - 1])])
+    if by == "winter":
+        # the winter of 2016 runs from the autumn of 2015 to the spring of 2016
+        winter_year = dates.year + (dates.month >= 9)
+        return np.array([f"{y - 1}/{y}" for y in winter_year])
+    raise ValueError(f"Unknown grouping {by}, use one of {GROUPINGS}")
+
+
+def aggregate(df, keys):
+    """
+    FSS of the rows summed by keys. Days without partial sums (which
+    partial_sums_from_nbrcnt could not recover) cannot be summed, they are
+    counted in n_missing.
+    """
+    ok = df["fss_num"].notna() & df["fss_den"].notna()
+    sums = df[ok].groupby(keys, sort=True)[["n", "fss_num", "fss_den"]].sum()
+    sums["n_days"] = df[ok].groupby(keys, sort=True).size()
+    missing = (~ok).groupby([df[key] for key in keys], sort=True).sum()
+    sums = sums.join(missing.rename("n_missing"), how="outer")
+    sums[["n_days", "n_missing"]] = sums[["n_days", "n_missing"]].fillna(0).astype(int)
+    sums["fss"] = 1.0 - sums["fss_num"] / sums["fss_den"].where(sums["fss_den"] > 0)
+    return sums.reset_index()
+
+
+class FSSStore:
+    """
+    Queries of aggregated FSS over the partial-sum store.
+
+    Args:
+        path (str): Parquet store written by update_store.
+    """
+
+    def __init__(self, path):
+        self.table = pd.read_parquet(path)
+        self.table["date"] = pd.to_datetime(self.table["date"])
+        self._cumsums = {}
+        has_sums = self.table["fss_num"].notna() & self.table["fss_den"].notna()
+        if not has_sums.all():
+            print(f"Store {path}: {(~has_sums).sum()} rows without partial sums left out of the FSS")
+        ok = self.table[has_sums]
+        for key, group in ok.groupby(["model", "region", "points"], sort=False):
+            group = group.sort_values("date")
+            self._cumsums[key] = (
+                group["date"].values,
+                np.concatenate([[0.0], np.cumsum(group["fss_num"].values)]),
+                np.concatenate([[0.0], np.cumsum(group["fss_den"].values)]),
+            )
+
+    def fss(self, model, region, points, start=None, end=None):
+        """FSS of one model, region and scale over a date window (both ends included)."""
+        dates, cum_num, cum_den = self._cumsums[(model, region, points)]
+        i0 = 0 if start is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(start)), "left")
+        i1 = len(dates) if end is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(end)), "right")
+        den = cum_den[i1] - cum_den[i0]
+        return 1.0 - (cum_num[i1] - cum_num[i0]) / den if den > 0 else np.nan
+
+    def query(self, models=None, regions=None, points=None, start=None, end=None,
+              months=None, by=None):
+        """
+        Aggregated FSS of a selection, optionally grouped by period.
+
+        Args:
+            models, regions, points (list): Selections, None for all.
+            start, end (str): Date window, both ends included.
+            months (list): Keep only these months, e.g. [12, 1, 2].
+            by (str): None (whole selection), month, season, winter or year.
+
+        Returns:
+            pd.DataFrame: model, region, points, [period,] n, fss_num,
+            fss_den, n_days, n_missing, fss.
+        """
+        df = self.table
+        keep = np.ones(len(df), dtype=bool)
+        if models is not None:
+            keep &= df["model"].isin(models).values
+        if regions is not None:
+            keep &= df["region"].isin(regions).values
+        if points is not None:
+            keep &= df["points"].isin(points).values
+        if start is not None:
+            keep &= (df["date"] >= pd.Timestamp(start)).values
+        if end is not None:
+            keep &= (df["date"] <= pd.Timestamp(end)).values
+        if months is not None:
+            keep &= df["date"].dt.month.isin(months).values
+        df = df[keep]
+        keys = ["model", "region", "points"]
+        if by is not None:
+            df = df.assign(period=period_labels(df["date"], by))
+            keys.append("period")
+        return aggregate(df, keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="Add MET or native results to the store")
+    build.add_argument("--store", default="fss_partials.parquet")
+    build.add_argument("--met", action="append", default=[],
+                       help="NAME=MET output directory (repeatable)")
+    build.add_argument("--native", action="append", default=[],
+                       help="multi_model_verify.py output table (repeatable)")
+    query = sub.add_parser("query", help="Aggregated FSS from the store")
+    query.add_argument("--store", default="fss_partials.parquet")
+    query.add_argument("--models", nargs="*")
+    query.add_argument("--regions", nargs="*")
+    query.add_argument("--points", type=int, nargs="*")
+    query.add_argument("--date-ini")
+    query.add_argument("--date-end")
+    query.add_argument("--months", type=int, nargs="*")
+    query.add_argument("--by", choices=GROUPINGS)
+    query.add_argument("--output", help="Write the result to this CSV file")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        partials = [partials_from_met(path, name)
+                    for name, path in (spec.split("=", 1) for spec in args.met)]
+        for path in args.native:
+            table = pd.read_parquet(path) if path.endswith(".parquet") else pd.read_csv(path)
+            partials.append(partials_from_native(table))
+        if not partials:
+            parser.error("give at least one --met or --native input")
+        update_store(args.store, pd.concat(partials, ignore_index=True))
+        return
+
+    store = FSSStore(args.store)
+    result = store.query(args.models, args.regions, args.points, args.date_ini,
+                         args.date_end, args.months, args.by)
+    print(result.to_string(index=False))
+    if args.output:
+        result.to_csv(args.output, index=False)
+        print(f"Saved: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
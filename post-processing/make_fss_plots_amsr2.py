@@ -12,6 +12,8 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 from matplotlib.colors import BoundaryNorm, ListedColormap
 
+from met_ingest import fss_table, read_line_type
+
 
 model="amsr2"
 year="2018"
@@ -43,37 +45,9 @@ for key_date in results.keys():
 
 # ### find fraction skill score
 
-fss_files=OrderedDict()
-for f in all_results:
-    
-    if f.endswith("_nbrcnt.txt"):
-        read_date = f.split("_")[3]
-        fss_files[read_date]  = pd.read_csv(os.path.join(MET_res,f),sep=r'\s+')
-    
-#date_sel = check_date
-#get_fss_all = fss_files[date_sel][fss_files[date_sel]["VX_MASK"] == REGION]
-#get_fss_nor_scan = fss_files[date_sel][fss_files[date_sel]["VX_MASK"] == REGION_SEL]
-#fss_all = get_fss_all[["INTERP_PNTS","FSS","FCST_LEAD","FCST_VALID_BEG","FCST_VALID_END"]]
-#fss_nor_scan = get_fss_nor_scan[["INTERP_PNTS","FSS","FCST_LEAD","FCST_VALID_BEG","FCST_VALID_END"]]
-
-
-df_fss_full = pd.DataFrame(columns=["date","points","fss"])
-df_fss_nor_scan = pd.DataFrame(columns=["date","points","fss"])
-
-
-for key in fss_files:
-    data = fss_files[key][fss_files[key]["VX_MASK"] == REGION]
-    for _,r in data.iterrows():
-        conv_date = datetime.strptime(r["FCST_VALID_BEG"],"%Y%m%d_%H%M%S")
-        data_row = pd.DataFrame({"date":[conv_date],"points":[r["INTERP_PNTS"]],"fss":[r["FSS"]]},columns=["date","points","fss"])
-        df_fss_full=pd.concat([df_fss_full,data_row],ignore_index=True)
-
-for key in fss_files:
-    data = fss_files[key][fss_files[key]["VX_MASK"] == REGION_SEL]
-    for _,r in data.iterrows():
-        conv_date = datetime.strptime(r["FCST_VALID_BEG"],"%Y%m%d_%H%M%S")
-        data_row = pd.DataFrame({"date":[conv_date],"points":[r["INTERP_PNTS"]],"fss":[r["FSS"]]},columns=["date","points","fss"])
-        df_fss_nor_scan=pd.concat([df_fss_nor_scan,data_row],ignore_index=True)
+nbrcnt = read_line_type(MET_res, "nbrcnt")
+df_fss_full = fss_table(nbrcnt, REGION)
+df_fss_nor_scan = fss_table(nbrcnt, REGION_SEL)
 
 #this for plotting
 df_fss_full["day"] = df_fss_full["date"].dt.strftime('%Y-%m-%d')
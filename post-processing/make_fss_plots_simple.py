@@ -12,6 +12,8 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 from matplotlib.colors import BoundaryNorm, ListedColormap
 
+from met_ingest import fss_table, read_line_type
+
 
 model="eraland"
 model="CARRA1_LAND2"
@@ -48,28 +50,8 @@ for key_date in results.keys():
 
 # ### find fraction skill score
 
-fss_files=OrderedDict()
-for f in all_results:
-    
-    if f.endswith("_nbrcnt.txt"):
-        read_date = f.split("_")[3]
-        fss_files[read_date]  = pd.read_csv(os.path.join(MET_res,f),sep=r'\s+')
-    
-
-
-df_fss_full = pd.DataFrame(columns=["date","points","fss"])
-
-print("\n=== DEBUG: Processing FSS files ===")
-for key in fss_files:
-    data = fss_files[key][fss_files[key]["VX_MASK"] == REGION]
-    print(f"Date key: {key}, Number of rows: {len(data)}")
-    for _,r in data.iterrows():
-        conv_date = datetime.strptime(r["FCST_VALID_BEG"],"%Y%m%d_%H%M%S")
-        fss_value = r["FSS"]
-        points_value = r["INTERP_PNTS"]
-        print(f"  Date: {conv_date}, Points: {points_value}, FSS: {fss_value}, FSS is NaN: {pd.isna(fss_value)}")
-        data_row = pd.DataFrame({"date":[conv_date],"points":[points_value],"fss":[fss_value]},columns=["date","points","fss"])
-        df_fss_full=pd.concat([df_fss_full,data_row],ignore_index=True)
+nbrcnt = read_line_type(MET_res, "nbrcnt")
+df_fss_full = fss_table(nbrcnt, REGION)
 
 print(f"\n=== DEBUG: Total rows in df_fss_full: {len(df_fss_full)} ===")
 print(f"Unique dates: {df_fss_full['date'].nunique()}")
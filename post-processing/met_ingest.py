@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""
+Columnar ingest of the MET text output (_nbrcnt.txt, _cts.txt, _ctc.txt,
+... and .stat files) into Parquet.
+
+The plotting scripts used to read every file with
+pd.read_csv(sep=r'\\s+') and build their tables row by row. Here all
+files of a directory are read in a thread pool, the padding spaces
+squeezed, and the files of each line type (same header) parsed in one
+multi-threaded pyarrow CSV read, with normalised types:
+- FCST/OBS_VALID_BEG/END as timestamps, the MET leads as strings
+- INTERP_PNTS int32, TOTAL int64, the statistics float64 (NA -> null)
+The line types of .stat files (ragged lines) are parsed with the
+columns of the _<line type>.txt files read along.
+
+`ingest` writes a Parquet dataset partitioned by model, line type and
+year (hive layout, model=CERISE/line_type=nbrcnt/year=2016); ingesting
+a model again replaces all of its partitions. `load_dataset` reads
+one line type back (a few models and years only if asked), and
+`load_fss_data` gives the (date, points, fss) table of the plotting
+scripts, from a MET directory or from the dataset.
+
+Usage:
+    python met_ingest.py --store met_parquet CERISE=/path/MET_CERISE_vs_IMS_paper \
+        CARRA1=/path/MET_CARRA1_vs_IMS_paper
+"""
+
+import argparse
+import glob
+import io
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+
+STRING_COLUMNS = ["VERSION", "MODEL", "DESC", "FCST_LEAD", "OBS_LEAD", "FCST_VAR", "FCST_UNITS",
+                  "FCST_LEV", "OBS_VAR", "OBS_UNITS", "OBS_LEV", "OBTYPE", "VX_MASK",
+                  "INTERP_MTHD", "FCST_THRESH", "OBS_THRESH", "COV_THRESH", "LINE_TYPE"]
+TIME_COLUMNS = ["FCST_VALID_BEG", "FCST_VALID_END", "OBS_VALID_BEG", "OBS_VALID_END"]
+INT_COLUMNS = {"INTERP_PNTS": pa.int32(), "TOTAL": pa.int64()}
+PARTITIONS = ["model", "line_type", "year"]
+_SUFFIX = re.compile(r"_([a-z0-9]+)\.txt$")
+
+
+def _squeeze(data):
+    """MET text with single spaces between the columns."""
+    data = re.sub(rb"[ \t]+", b" ", data)
+    return re.sub(rb"( ?\n ?)+", b"\n", data).strip(b" \n") + b"\n"
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return _squeeze(f.read())
+
+
+def _column_types(names):
+    types = {}
+    for name in names:
+        if name in STRING_COLUMNS:
+            types[name] = pa.string()
+        elif name in TIME_COLUMNS:
+            types[name] = pa.timestamp("s")
+        else:
+            types[name] = INT_COLUMNS.get(name, pa.float64())
+    return types
+
+
+def _parse(header, parts, source):
+    """One pyarrow read of the lines of several files sharing a header."""
+    names = header.decode().split(" ")
+    buffer = io.BytesIO(b"".join(body for _, body in parts))
+    table = pv.read_csv(
+        buffer,
+        read_options=pv.ReadOptions(column_names=names, use_threads=True),
+        parse_options=pv.ParseOptions(delimiter=" "),
+        convert_options=pv.ConvertOptions(column_types=_column_types(names), null_values=["NA"],
+                                          timestamp_parsers=["%Y%m%d_%H%M%S"]),
+    )
+    if source:
+        paths = [path for path, body in parts for _ in range(body.count(b"\n"))]
+        table = table.append_column("FILE", pa.array(paths, pa.string()))
+    return table
+
+
+def read_met_files(paths, workers=8, source=False):
+    """
+    Parses MET _<line type>.txt and .stat files.
+
+    Args:
+        paths (list): Files to read.
+        workers (int): Threads reading the files.
+        source (bool): Add a FILE column with the path of every line.
+
+    Returns:
+        dict: line type (lower case, e.g. "nbrcnt") -> pa.Table
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        contents = list(pool.map(_read_file, paths))
+    groups, stat_lines, in_txt = {}, [], set()
+    for path, data in zip(paths, contents):
+        header, _, body = data.partition(b"\n")
+        if not body:
+            continue
+        if path.endswith(".stat"):
+            stat_lines.append((path, header, body))
+            continue
+        match = _SUFFIX.search(path)
+        if match is None:
+            continue
+        groups.setdefault((match.group(1), header), []).append((path, body))
+        in_txt.add((path[:match.start()], match.group(1)))
+    # .stat lines: regrouped by line type, with the header of its .txt files,
+    # unless the same lines were read from the _<line type>.txt file
+    headers = {line_type: header for line_type, header in groups}
+    for path, header, body in stat_lines:
+        base = path[:-len(".stat")]
+        position = header.split(b" ").index(b"LINE_TYPE")
+        for line in body.splitlines():
+            line_type = line.split(b" ", position + 1)[position].decode().lower()
+            if (base, line_type) in in_txt:
+                continue
+            if line_type not in headers:
+                print(f"Skipping {line_type.upper()} lines of .stat files, no _{line_type}.txt "
+                      "file to take the columns from")
+                headers[line_type] = None
+            if headers[line_type] is not None:
+                groups.setdefault((line_type, headers[line_type]), []).append((path, line + b"\n"))
+    tables = {}
+    for (line_type, header), parts in groups.items():
+        tables.setdefault(line_type, []).append(_parse(header, parts, source))
+    # different MET versions may have written different columns
+    return {line_type: pa.concat_tables(parts, promote_options="default")
+            for line_type, parts in tables.items()}
+
+
+def met_files(met_dir, line_types=None):
+    """MET text and stat files of a directory, of some line types only if given."""
+    names = os.listdir(met_dir)
+    keep = []
+    for name in names:
+        match = _SUFFIX.search(name)
+        if match and (line_types is None or match.group(1) in line_types):
+            keep.append(os.path.join(met_dir, name))
+        elif name.endswith(".stat") and line_types is None:
+            keep.append(os.path.join(met_dir, name))
+    return sorted(keep)
+
+
+def read_line_type(met_dir, line_type, workers=8):
+    """All lines of one type (e.g. "nbrcnt") of the _<line type>.txt files of a directory."""
+    table = read_met_files(met_files(met_dir, [line_type]), workers).get(line_type)
+    if table is None:
+        raise FileNotFoundError(f"No _{line_type}.txt lines in {met_dir}")
+    return table.to_pandas()
+
+
+def fss_table(nbrcnt, region):
+    """(date, points, fss) of the NBRCNT lines of one region, as the plotting scripts use."""
+    data = nbrcnt[nbrcnt["VX_MASK"] == region]
+    return pd.DataFrame({
+        "date": pd.to_datetime(data["FCST_VALID_BEG"]).astype("datetime64[ns]"),
+        "points": data["INTERP_PNTS"],
+        "fss": data["FSS"],
+    }).sort_values(["date", "points"], ignore_index=True)
+
+
+def load_fss_data(model_path, region, store=None, model=None):
+    """
+    Daily FSS of a model and region, from a MET output directory, or from
+    the Parquet dataset store if given (model being its name there).
+
+    Returns:
+        pd.DataFrame: date, points, fss
+    """
+    if store is not None:
+        nbrcnt = load_dataset(store, "nbrcnt", models=[model],
+                              columns=["FCST_VALID_BEG", "VX_MASK", "INTERP_PNTS", "FSS"])
+    else:
+        nbrcnt = read_line_type(model_path, "nbrcnt")
+    return fss_table(nbrcnt, region)
+
+
+def ingest(met_dir, model, root, workers=8):
+    """
+    Writes all MET lines of a directory to the partitioned dataset root,
+    replacing everything stored for the model before (also the years and
+    line types the directory no longer has).
+
+    Returns:
+        dict: line type -> number of lines
+    """
+    tables = read_met_files(met_files(met_dir), workers)
+    shutil.rmtree(os.path.join(root, f"model={model}"), ignore_errors=True)
+    for line_type, table in tables.items():
+        n = table.num_rows
+        table = table.append_column("model", pa.array([model] * n, pa.string()))
+        table = table.append_column("line_type", pa.array([line_type] * n, pa.string()))
+        table = table.append_column("year", pc.year(table["FCST_VALID_BEG"]).cast(pa.int16()))
+        ds.write_dataset(table, root, format="parquet", partitioning=PARTITIONS,
+                         partitioning_flavor="hive", existing_data_behavior="delete_matching",
+                         basename_template=f"{line_type}-{{i}}.parquet")
+    return {line_type: table.num_rows for line_type, table in tables.items()}
+
+
+def load_dataset(root, line_type, models=None, years=None, columns=None):
+    """
+    Lines of one type from the dataset, optionally of some models and years.
+
+    Returns:
+        pd.DataFrame: The MET columns (or the given ones) and model, year.
+    """
+    files = glob.glob(os.path.join(root, "model=*", f"line_type={line_type}", "year=*", "*.parquet"))
+    if not files:
+        raise FileNotFoundError(f"No {line_type} lines in {root}")
+    dataset = ds.dataset(files, format="parquet", partitioning=ds.partitioning(flavor="hive"),
+                         partition_base_dir=root)
+    keep = None
+    if models is not None:
+        keep = ds.field("model").isin(list(models))
+    if years is not None:
+        in_years = ds.field("year").isin([int(y) for y in years])
+        keep = in_years if keep is None else keep & in_years
+    if columns is not None:
+        columns = list(columns) + [c for c in ("model", "year") if c not in columns]
+    return dataset.to_table(columns=columns, filter=keep).to_pandas()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="NAME=MET output directory")
+    parser.add_argument("--store", default="met_parquet", help="Root of the Parquet dataset")
+    parser.add_argument("--workers", type=int, default=8, help="Threads reading the files")
+    args = parser.parse_args()
+
+    for spec in args.inputs:
+        model, met_dir = spec.split("=", 1)
+        counts = ingest(met_dir, model, args.store, args.workers)
+        summary = ", ".join(f"{n} {line_type}" for line_type, n in sorted(counts.items()))
+        print(f"{model}: {summary or 'no MET lines'} -> {args.store}")
+
+
+if __name__ == "__main__":
+    main()
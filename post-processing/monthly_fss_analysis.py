@@ -1,9 +1,7 @@
 #!/usr/bin/env python
 
-import pandas as pd
 from datetime import datetime
 import os
-from collections import OrderedDict
 import numpy as np
 import calendar
 
@@ -11,6 +9,9 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from matplotlib.colors import BoundaryNorm, ListedColormap
 
+from fss_bootstrap import load_nbrcnt
+from fss_store import aggregate
+
 # Set publication-quality style
 plt.style.use('seaborn-v0_8-whitegrid')
 plt.rcParams.update({
@@ -61,27 +62,9 @@ REGION = "FULL"
 REGION_SEL = "NORTH_SCAND"
 
 def load_fss_data(model_path, region):
-    """Load FSS data for a specific model and region, avoiding concat warning."""
-    all_results = os.listdir(model_path)
-    fss_files = OrderedDict()
-    # Load FSS files
-    for f in all_results:
-        if f.endswith("_nbrcnt.txt"):
-            read_date = f.split("_")[3]
-            fss_files[read_date] = pd.read_csv(os.path.join(model_path, f), sep=r'\s+')
-    # Collect rows in a list
-    rows = []
-    for key in fss_files:
-        data = fss_files[key][fss_files[key]["VX_MASK"] == region]
-        for _, r in data.iterrows():
-            conv_date = datetime.strptime(r["FCST_VALID_BEG"], "%Y%m%d_%H%M%S")
-            rows.append({
-                "date": conv_date,
-                "points": r["INTERP_PNTS"],
-                "fss": r["FSS"]
-            })
-    df_fss = pd.DataFrame(rows, columns=["date", "points", "fss"])
-    return df_fss
+    """Load daily FSS and its partial sums for a specific model and region."""
+    df = load_nbrcnt(model_path)
+    return df[df["region"] == region][["date", "points", "fss", "fss_num", "fss_den"]]
 
 def create_monthly_analysis_plots(df, model_name, region_name, year_month_str):
     """Create the extended FSS analysis plots for a specific month"""
@@ -100,6 +83,8 @@ def create_monthly_analysis_plots(df, model_name, region_name, year_month_str):
     scales = np.array(sorted(pivot_df.columns.values))
     days = list(pivot_df.index.values)
     fss = pivot_df.reindex(columns=scales).values
+    # FSS of the month from the summed partials, not the mean of daily FSS
+    fss_month = aggregate(df, ["points"]).set_index("points")["fss"].reindex(scales).values
     
     # Create output directory
     output_dir = f"monthly_analysis_{model_name.lower()}_{region_name.lower()}"
@@ -129,6 +114,7 @@ def create_monthly_analysis_plots(df, model_name, region_name, year_month_str):
     for i in range(fss.shape[0]):
         plt.plot(scales, fss[i, :], color='gray', alpha=0.25, linewidth=1)
     plt.plot(scales, median, color=model_config['color'], linewidth=3, label='Median')
+    plt.plot(scales, fss_month, color='black', linewidth=2, linestyle='--', label='Monthly FSS')
     plt.fill_between(scales, p25, p75, color=model_config['color'], alpha=0.25, label='IQR')
     plt.ylim(0, 1.0)
     plt.xlabel('Neighbourhood Size (grid points)')
@@ -165,8 +151,8 @@ def create_monthly_analysis_plots(df, model_name, region_name, year_month_str):
     plt.figure(figsize=(9, 4))
     plt.boxplot([fss[:, j] for j in range(fss.shape[1])], positions=scales,
                 widths=0.06*np.max(scales), showfliers=False)
-    plt.plot(scales, np.mean(fss, axis=0), color=model_config['color'], 
-             marker='o', linewidth=2, markersize=6, label='Mean')
+    plt.plot(scales, fss_month, color=model_config['color'], 
+             marker='o', linewidth=2, markersize=6, label='Monthly FSS')
     plt.ylim(0, 1.0)
     plt.xlabel('Neighbourhood Size (grid points)')
     plt.ylabel('FSS')
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""
+Persistent, incrementally updated catalog of the MET statistics (SQLite).
+
+Every plotting script rescans and reparses the whole MET output
+directory. The catalog keeps
+- files: every ingested _<line type>.txt file with its size and mtime
+- stats: one row per statistic of every MET line (model, obs, region,
+  line type, valid date, points, threshold, stat, value), indexed on
+  (model, obs, region, line_type, valid_date, points, stat)
+and an update only parses the files that are new or changed since the
+last one (the rows of changed and removed files are replaced or
+deleted). Queries such as the FSS at points 1 and 25 of NORTH_SCAND in
+DJF then come from the index, without reading the text files.
+
+.stat files are not ingested, their lines repeat those of the
+_<line type>.txt files.
+
+Usage:
+    python stats_catalog.py update --catalog met_stats.sqlite --obs IMS \
+        CERISE=/path/MET_CERISE_vs_IMS_paper CARRA1=/path/MET_CARRA1_vs_IMS_paper
+    python stats_catalog.py query --catalog met_stats.sqlite --stat FSS \
+        --regions NORTH_SCAND --points 1 25 --months 12 1 2
+"""
+
+import argparse
+import os
+import sqlite3
+from datetime import datetime
+
+import pandas as pd
+
+from met_ingest import met_files, read_met_files
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    directory TEXT NOT NULL,
+    model TEXT NOT NULL,
+    obs TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    n_lines INTEGER NOT NULL,
+    ingested TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stats (
+    file_id INTEGER NOT NULL REFERENCES files(id),
+    model TEXT NOT NULL,
+    obs TEXT NOT NULL,
+    region TEXT NOT NULL,
+    line_type TEXT NOT NULL,
+    valid_date TEXT NOT NULL,
+    month INTEGER NOT NULL,
+    points INTEGER,
+    thresh TEXT,
+    stat TEXT NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stats_key
+    ON stats (model, obs, region, line_type, valid_date, points, stat);
+CREATE INDEX IF NOT EXISTS stats_file ON stats (file_id);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory, model, obs);
+"""
+STATS_COLUMNS = ["file_id", "model", "obs", "region", "line_type", "valid_date", "month",
+                 "points", "thresh", "stat", "value"]
+
+
+class DirectoryConflict(ValueError):
+    """A MET directory is already in the catalog under another model or obs source."""
+
+
+def long_stats(table, line_type):
+    """
+    One row per statistic of the MET lines of one type (columns after
+    LINE_TYPE), missing values (NA) dropped.
+    """
+    columns = list(table.columns)
+    stats = [c for c in columns[columns.index("LINE_TYPE") + 1:]
+             if c != "FILE" and pd.api.types.is_numeric_dtype(table[c])]
+    valid = pd.to_datetime(table["FCST_VALID_BEG"])
+    df = pd.DataFrame({
+        "FILE": table["FILE"],
+        "region": table["VX_MASK"],
+        "line_type": line_type,
+        "valid_date": valid.dt.strftime("%Y-%m-%d %H:%M:%S"),
+        "month": valid.dt.month,
+        "points": table["INTERP_PNTS"],
+        "thresh": table["FCST_THRESH"],
+    })
+    df = pd.concat([df, table[stats]], axis=1)
+    df = df.melt(id_vars=list(df.columns[:7]), value_vars=stats, var_name="stat")
+    return df[df["value"].notna()]
+
+
+class StatsCatalog:
+    """
+    SQLite catalog of MET statistics, updated with new files only.
+
+    Args:
+        path (str): Database file, created if needed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.con = sqlite3.connect(path)
+        self.con.executescript(SCHEMA)
+
+    def close(self):
+        self.con.close()
+
+    def update(self, met_dir, model, obs, line_types=None, workers=8):
+        """
+        Ingests the new and changed _<line type>.txt files of a MET
+        output directory and drops the rows of removed ones. A directory
+        belongs to one model and obs source, registering it under another
+        raises DirectoryConflict.
+
+        Returns:
+            dict: Number of new, changed, unchanged and removed files, and of stats rows added.
+        """
+        directory = os.path.abspath(met_dir)
+        registered = self.con.execute(
+            "SELECT DISTINCT model, obs FROM files WHERE directory = ? AND (model != ? OR obs != ?)",
+            (directory, model, obs)).fetchall()
+        if registered:
+            names = ", ".join(f"{m}/{o}" for m, o in registered)
+            raise DirectoryConflict(f"{directory} is already in the catalog as {names}, not {model}/{obs}")
+        current = {}
+        for path in met_files(directory, line_types):
+            if path.endswith(".stat"):
+                continue
+            info = os.stat(path)
+            current[path] = (info.st_size, info.st_mtime_ns)
+        known = {path: (file_id, size, mtime_ns) for file_id, path, size, mtime_ns in self.con.execute(
+            "SELECT id, path, size, mtime_ns FROM files WHERE directory = ? AND model = ? AND obs = ?",
+            (directory, model, obs))}
+        new = [path for path in current if path not in known]
+        changed = [path for path in current if path in known and known[path][1:] != current[path]]
+        removed = [path for path in known if path not in current]
+        if line_types is not None:
+            # files of the other line types are not removed
+            removed = [path for path in removed
+                       if any(path.endswith(f"_{lt}.txt") for lt in line_types)]
+
+        with self.con:
+            stale = [(known[path][0],) for path in changed + removed]
+            self.con.executemany("DELETE FROM stats WHERE file_id = ?", stale)
+            self.con.executemany("DELETE FROM files WHERE id = ?", stale)
+            n_rows = 0
+            todo = sorted(new + changed)
+            if todo:
+                tables = read_met_files(todo, workers, source=True)
+                lines = [t.column("FILE").to_pandas() for t in tables.values()]
+                # header-only files give no table: registered with 0 lines, no stats
+                n_lines = pd.concat(lines).value_counts() if lines else pd.Series(dtype=int)
+                ingested = datetime.now().isoformat(timespec="seconds")
+                self.con.executemany(
+                    "INSERT INTO files (path, directory, model, obs, size, mtime_ns, n_lines, ingested)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(path, directory, model, obs, *current[path], int(n_lines.get(path, 0)), ingested)
+                     for path in todo])
+                ids = dict((path, file_id) for file_id, path in self.con.execute(
+                    "SELECT id, path FROM files WHERE directory = ? AND model = ? AND obs = ?",
+                    (directory, model, obs)))
+                for line_type, table in tables.items():
+                    df = long_stats(table.to_pandas(), line_type)
+                    df = df.assign(file_id=df["FILE"].map(ids), model=model, obs=obs)
+                    df[STATS_COLUMNS].to_sql("stats", self.con, if_exists="append", index=False,
+                                             chunksize=100000)
+                    n_rows += len(df)
+        return {"new": len(new), "changed": len(changed), "removed": len(removed),
+                "unchanged": len(current) - len(new) - len(changed), "rows": n_rows}
+
+    def files(self):
+        """Ingested files with their size, mtime, number of lines and ingestion time."""
+        return pd.read_sql_query("SELECT * FROM files ORDER BY model, obs, path", self.con)
+
+    def query(self, stats=None, models=None, obs=None, regions=None, line_types=None,
+              points=None, start=None, end=None, months=None):
+        """
+        Statistics of a selection.
+
+        Args:
+            stats, models, obs, regions, line_types, points (list): Selections,
+                None for all, e.g. stats=["FSS"], line_types=["nbrcnt"].
+            start, end (str): Date window, both ends included.
+            months (list): Keep only these months, e.g. [12, 1, 2].
+
+        Returns:
+            pd.DataFrame: model, obs, region, line_type, date, points,
+            thresh, stat, value.
+        """
+        where, params = [], []
+        for column, values in (("model", models), ("obs", obs), ("region", regions),
+                               ("line_type", line_types), ("points", points),
+                               ("stat", stats), ("month", months)):
+            if values is not None:
+                where.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params += list(values)
+        if start is not None:
+            where.append("valid_date >= ?")
+            params.append(f"{pd.Timestamp(start):%Y-%m-%d %H:%M:%S}")
+        if end is not None:
+            where.append("valid_date <= ?")
+            params.append(f"{pd.Timestamp(end):%Y-%m-%d %H:%M:%S}")
+        sql = ("SELECT model, obs, region, line_type, valid_date AS date, points, thresh, stat, value"
+               " FROM stats")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY model, obs, region, line_type, stat, points, date"
+        df = pd.read_sql_query(sql, self.con, params=params)
+        df["date"] = pd.to_datetime(df["date"]).astype("datetime64[ns]")
+        return df
+
+    def fss_data(self, model, region, obs=None):
+        """
+        Daily FSS of a model and region, as met_ingest.load_fss_data
+        (date, points, fss) without the missing (NA) values.
+        """
+        df = self.query(stats=["FSS"], models=[model], obs=None if obs is None else [obs],
+                        regions=[region], line_types=["nbrcnt"])
+        df = df.rename(columns={"value": "fss"})
+        return df[["date", "points", "fss"]].sort_values(["date", "points"], ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    update = sub.add_parser("update", help="Ingest new and changed MET files")
+    update.add_argument("inputs", nargs="+", help="MODEL=MET output directory")
+    update.add_argument("--catalog", default="met_stats.sqlite")
+    update.add_argument("--obs", required=True, help="Observation source, e.g. IMS")
+    update.add_argument("--line-types", nargs="*", help="e.g. nbrcnt cts (default: all)")
+    update.add_argument("--workers", type=int, default=8, help="Threads reading the files")
+    files = sub.add_parser("files", help="List the ingested files")
+    files.add_argument("--catalog", default="met_stats.sqlite")
+    query = sub.add_parser("query", help="Statistics from the catalog")
+    query.add_argument("--catalog", default="met_stats.sqlite")
+    query.add_argument("--stat", nargs="*", default=["FSS"], help="MET columns, e.g. FSS PODY")
+    query.add_argument("--models", nargs="*")
+    query.add_argument("--obs", nargs="*")
+    query.add_argument("--regions", nargs="*")
+    query.add_argument("--line-types", nargs="*")
+    query.add_argument("--points", type=int, nargs="*")
+    query.add_argument("--date-ini")
+    query.add_argument("--date-end")
+    query.add_argument("--months", type=int, nargs="*")
+    query.add_argument("--output", help="Write the result to this CSV file")
+    args = parser.parse_args()
+
+    catalog = StatsCatalog(args.catalog)
+    if args.command == "update":
+        for spec in args.inputs:
+            model, met_dir = spec.split("=", 1)
+            try:
+                counts = catalog.update(met_dir, model, args.obs, args.line_types, args.workers)
+            except DirectoryConflict as err:
+                catalog.close()
+                parser.error(str(err))
+            print(f"{model}/{args.obs}: {counts['new']} new, {counts['changed']} changed, "
+                  f"{counts['removed']} removed, {counts['unchanged']} unchanged files, "
+                  f"{counts['rows']} rows added")
+    elif args.command == "files":
+        print(catalog.files().to_string(index=False))
+    else:
+        result = catalog.query(args.stat, args.models, args.obs, args.regions, args.line_types,
+                               args.points, args.date_ini, args.date_end, args.months)
+        print(result.to_string(index=False))
+        if args.output:
+            result.to_csv(args.output, index=False)
+            print(f"Saved: {args.output}")
+    catalog.close()
+
+
+if __name__ == "__main__":
+    main()
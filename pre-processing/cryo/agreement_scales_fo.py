@@ -1,9 +1,10 @@
 import numpy as np
 import xarray as xr
-from scipy.ndimage import uniform_filter
+from scipy.ndimage import distance_transform_cdt
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 
 # This script is a Python implementation of the agreement scale method described in:
@@ -43,29 +44,118 @@ def similarity_D(a, b):
     
     return D
 
+def sum_dtype(max_sum):
+    """Smallest unsigned integer type holding window sums up to max_sum."""
+    for dtype in (np.uint16, np.uint32):
+        if max_sum <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def mirror_index(index, n):
+    """Indices of a mirrored axis of length n (mode='mirror', d c b | a b c d | c b a)."""
+    if n == 1:
+        return np.zeros_like(index)
+    period = 2 * (n - 1)
+    index = np.mod(index, period)
+    return np.where(index >= n, period - index, index)
+
+
+def mirror_block(mat, pad, tile=None):
+    """
+    A tile (y0, y1, x0, x1) of a 2D field extended by pad points on every
+    side, mirrored at the edges of the domain. The whole field by default.
+    """
+    ny, nx = mat.shape
+    y0, y1, x0, x1 = tile or (0, ny, 0, nx)
+    rows = mirror_index(np.arange(y0 - pad, y1 + pad), ny)
+    cols = mirror_index(np.arange(x0 - pad, x1 + pad), nx)
+    return mat[np.ix_(rows, cols)]
+
+
+def window_tables(mat, pad, tile=None, backend="numpy"):
+    """
+    Integral images of a 2D field with NaNs, for window sums at any point.
+
+    The field (or a tile of it) is mirrored by pad points on every side
+    (mode='mirror' of scipy.ndimage), so any window of half-width S <= pad
+    can be summed with four lookups. The valid points, and the values of
+    fields holding non-negative integers (e.g. bin_snow), are summed in the
+    smallest unsigned type holding a (2 pad + 1)^2 window sum: the
+    cumulative sums wrap around but the window sums, being differences,
+    are exact. Other fields are summed in float64.
+
+    Args:
+        mat (np.ndarray): The input 2D array.
+        pad (int): The largest window half-width.
+        tile (tuple): Optional (y0, y1, x0, x1) tile of the field.
+        backend (str): "numpy", or "numba" for the multi-threaded cumulative
+            sums of verification/native/box_filter.py (on the PYTHONPATH),
+            same tables.
+
+    Returns:
+        tuple: (integral image of the values, integral image of the valid points)
+    """
+    block = mirror_block(mat, pad, tile)
+    nan_mask = np.isnan(block)
+    values = np.where(nan_mask, 0.0, block)
+    area = (2 * pad + 1) ** 2
+    value_dtype = np.float64
+    if np.all(values >= 0) and np.all(values == np.round(values)):
+        value_dtype = sum_dtype(values.max(initial=0) * area)
+    if backend == "numba":
+        from box_filter import integral_image
+        return tuple(integral_image(field[None], 0, dtype)[0]
+                     for field, dtype in ((values, value_dtype), (~nan_mask, sum_dtype(area))))
+    tables = []
+    for field, dtype in ((values, value_dtype), (~nan_mask, sum_dtype(area))):
+        table = np.zeros((field.shape[0] + 1, field.shape[1] + 1), dtype=dtype)
+        np.cumsum(field, axis=0, dtype=dtype, out=table[1:, 1:])
+        np.cumsum(table[1:, 1:], axis=1, dtype=dtype, out=table[1:, 1:])
+        tables.append(table)
+    return tuple(tables)
+
+
+def tiles(shape, tile):
+    """(y0, y1, x0, x1) tiles of at most tile x tile points covering a grid."""
+    ny, nx = shape
+    return [(y0, min(y0 + tile, ny), x0, min(x0 + tile, nx))
+            for y0 in range(0, ny, tile) for x0 in range(0, nx, tile)]
+
+
+def window_sums_at(tables, S, pad, iy, ix):
+    """
+    Window sums of half-width S at the points (iy, ix) only.
+
+    Args:
+        tables (tuple): Output of window_tables.
+        S (int): Window half-width, S <= pad.
+        pad (int): The pad of the tables.
+        iy, ix (np.ndarray): Point indices.
+
+    Returns:
+        tuple: (sums of the values, number of valid points) in the windows.
+    """
+    y0, y1 = iy + pad - S, iy + pad + S + 1
+    x0, x1 = ix + pad - S, ix + pad + S + 1
+    return tuple(t[y1, x1] - t[y0, x1] - t[y1, x0] + t[y0, x0] for t in tables)
+
+
 def window_mean_nan(mat, size):
     """
     Calculates the window mean for a 2D array with NaNs.
     
     Args:
         mat (np.ndarray): The input 2D array.
-        size (int): The size of the square window (e.g., 3 for a 3x3 window).
+        size (int): The size of the square window (odd, e.g., 3 for a 3x3 window).
         
     Returns:
         np.ndarray: The array of windowed means.
     """
-    # Create a mask for NaN values
-    nan_mask = np.isnan(mat)
-    
-    # Create a copy of the matrix and replace NaNs with 0 for calculation
-    mat_no_nan = np.where(nan_mask, 0, mat)
-    
-    # Create a count of non-NaN values in the window
-    counts = uniform_filter(np.where(nan_mask, 0.0, 1.0), size=size, mode='mirror')
-    
-    # Calculate the sum within the window
-    sums = uniform_filter(mat_no_nan, size=size, mode='mirror')
-    
+    S = (size - 1) // 2
+    iy, ix = np.indices(mat.shape)
+    sums, counts = window_sums_at(window_tables(mat, S), S, S, iy, ix)
+
     # Calculate the mean, avoiding division by zero
     mean_val = np.full_like(mat, np.nan, dtype=float)
     np.divide(sums, counts, out=mean_val, where=counts > 0)
@@ -73,68 +163,143 @@ def window_mean_nan(mat, size):
     return mean_val
 
 
-def agreement_scale_map(f1, f2, alpha=0.5, S_lim=80):
+def similarity_D_sums(sums1, counts1, sums2, counts2, exact=True):
+    """
+    similarity_D of the window means sums1 / counts1 and sums2 / counts2.
+
+    D does not change when both means are multiplied by counts1 * counts2,
+    so it is computed from the products sums1 * counts2 and sums2 * counts1:
+    with integer sums (exact=True) everything up to the final division is
+    integer arithmetic. D is NaN where a window has no valid point.
+    """
+    dtype = np.int64 if exact else np.float64
+    D = similarity_D(sums1.astype(dtype) * counts2.astype(dtype),
+                     sums2.astype(dtype) * counts1.astype(dtype))
+    D[(counts1 == 0) | (counts2 == 0)] = np.nan
+    return D
+
+
+def zero_distance(f1, f2):
+    """
+    Chessboard distance of every point to the nearest non-zero value of
+    either field. Below that scale both window means are 0, so D = 1.
+    """
+    nonzero = (np.nan_to_num(f1) != 0) | (np.nan_to_num(f2) != 0)
+    if not nonzero.any():
+        return np.full(f1.shape, np.iinfo(np.int32).max)
+    return distance_transform_cdt(~nonzero, metric='chessboard')
+
+
+def exact_products(f1, f2, S_lim):
+    """
+    Whether D can be computed from int64 products of window sums and
+    counts (similarity_D_sums): both fields hold non-negative integers and
+    2 (max sum * max count)^2 < 2^63.
+    """
+    values = np.concatenate([f1[~np.isnan(f1)], f2[~np.isnan(f2)]])
+    if np.any(values < 0) or np.any(values != np.round(values)):
+        return False
+    area = (2 * S_lim + 1) ** 2
+    return 2 * (values.max(initial=0) * area ** 2) ** 2 < 2 ** 63
+
+
+def agreement_scales(f1, f2, tables1, tables2, alpha=0.5, S_lim=80, tile=None, exact=None):
+    """
+    Agreement scales of two fields from their window_tables (padded by S_lim).
+
+    Only the points that have not agreed yet are evaluated at each scale,
+    and a point only becomes active once its window reaches a non-zero
+    value (before that D = 1 > D_crit): in winter most of the domain is
+    either snow in both fields (agreement at S = 0) or snow-free far away
+    from the snow line.
+
+    Args:
+        tile (tuple): (y0, y1, x0, x1) tile the tables were built for, the
+            whole field by default.
+        exact (bool): exact_products of the whole fields, so that every
+            tile takes the same path.
+
+    Returns:
+        tuple: (int32 map of agreement scales, valid mask) of the tile
+    """
+    if exact is None:
+        exact = exact_products(f1, f2, S_lim)
+    b1, b2 = mirror_block(f1, S_lim, tile), mirror_block(f2, S_lim, tile)
+    core = (slice(S_lim, b1.shape[0] - S_lim), slice(S_lim, b1.shape[1] - S_lim))
+    f1, f2 = b1[core], b2[core]
+    valid_mask = ~np.isnan(f1) & ~np.isnan(f2)
+    SA = np.full(f1.shape, S_lim, dtype=np.int32)
+
+    # pending points, in order of the scale at which they can first agree;
+    # mirrored points are never closer than the points they mirror
+    dist = zero_distance(b1, b2)[core].ravel()
+    pending = np.flatnonzero(valid_mask.ravel())
+    order = np.argsort(dist[pending], kind='stable')
+    pending, pending_dist = pending[order], dist[pending][order]
+
+    # at S_lim D_crit = 1 and the remaining points keep SA = S_lim
+    for S in range(S_lim):
+        n_active = np.searchsorted(pending_dist, S, side='right')
+        if n_active == 0:
+            continue
+        active = pending[:n_active]
+        if S == 0:
+            D = similarity_D(f1.ravel()[active], f2.ravel()[active])
+        else:
+            iy, ix = np.divmod(active, f1.shape[1])
+            D = similarity_D_sums(*window_sums_at(tables1, S, S_lim, iy, ix),
+                                  *window_sums_at(tables2, S, S_lim, iy, ix), exact)
+
+        # Eq. 1 to 3: first scale where D <= D_crit
+        D_crit = alpha + (1 - alpha) * S / S_lim
+        agreed = D <= D_crit
+        SA.ravel()[active[agreed]] = S
+
+        keep = np.concatenate([~agreed, np.ones(len(pending) - n_active, dtype=bool)])
+        pending, pending_dist = pending[keep], pending_dist[keep]
+        if len(pending) == 0:
+            break
+    return SA, valid_mask
+
+
+def agreement_scale_map(f1, f2, alpha=0.5, S_lim=80, tile=1024, workers=1, backend="numpy"):
     """
     Calculates the agreement scale map based on Dey et al. (2016).
 
+    The grid is processed in tiles with a halo of S_lim points, so the
+    temporaries are set by the tile size; tiles run in parallel threads.
+    Every point only depends on the exact window sums around it, so the
+    map does not depend on the tiling.
+
     Args:
         f1 (np.ndarray): First 2D field (e.g., forecast).
         f2 (np.ndarray): Second 2D field (e.g., observation).
         alpha (float): Tunable parameter for the agreement criterion (0 to 1).
         S_lim (int): Maximum scale (in grid points) to check.
+        tile (int): Tile size in grid points.
+        workers (int): Number of threads.
+        backend (str): Integral image backend, see window_tables.
 
     Returns:
         np.ndarray: 2D map of agreement scales.
     """
     ny, nx = f1.shape
-    
-    # Initialize agreement scale matrix SA with the maximum scale
-    SA = np.full((ny, nx), S_lim, dtype=np.int32)
-    
     print(f"Calculating agreement scales for {ny} x {nx} grid...")
-    
-    # Create a mask for valid (non-NaN) data points in the original fields
-    valid_mask = ~np.isnan(f1) & ~np.isnan(f2)
-    
-    # Loop over scales from S = 0 to S_lim
-    for S in range(S_lim + 1):
-        if S % 10 == 0:
-            print(f"  Processing scale S = {S}/{S_lim}")
-            
-        # At scale S=0, the neighborhood is the point itself.
-        if S == 0:
-            f1_bar = f1
-            f2_bar = f2
-        else:
-            # The size of the filter window is (2*S + 1)
-            filter_size = 2 * S + 1
-            f1_bar = window_mean_nan(f1, size=filter_size)
-            f2_bar = window_mean_nan(f2, size=filter_size)
 
-        # Calculate similarity measure D (Eq. 1)
-        D = similarity_D(f1_bar, f2_bar)
-        
-        # Calculate agreement criterion threshold D_crit (Eq. 3)
-        D_crit = alpha + (1 - alpha) * S / S_lim
-        
-        # Find points where agreement is achieved (Eq. 2)
-        agreement_achieved = (D <= D_crit)
-        
-        # Update SA for points that achieve agreement for the first time.
-        # We only update points that are currently at S_lim and have valid data.
-        update_mask = agreement_achieved & (SA == S_lim) & valid_mask
-        SA[update_mask] = S
-        
-        # Check for early termination if all valid points have found their scale
-        if np.all(SA[valid_mask] != S_lim):
-            print(f"  All valid points converged at scale S = {S}")
-            break
-            
+    exact = exact_products(f1, f2, S_lim)
+
+    def tile_scales(t):
+        tables1 = window_tables(f1, S_lim, t, backend)
+        tables2 = window_tables(f2, S_lim, t, backend)
+        return t, agreement_scales(f1, f2, tables1, tables2, alpha, S_lim, t, exact)
+
+    # NaN where either input is NaN
+    SA = np.full((ny, nx), np.nan)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for (y0, y1, x0, x1), (SA_t, valid_t) in pool.map(tile_scales, tiles((ny, nx), tile)):
+            SA[y0:y1, x0:x1][valid_t] = SA_t[valid_t]
+
     print("Agreement scale calculation completed!")
-    
-    # Convert SA to float and set to NaN where input was NaN
-    SA = SA.astype(float)
-    SA[~valid_mask] = np.nan
     return SA
 
 def plot_agreement_scales(obs_field, fc_field, SA_fo, output_filename="agreement_scales_FO.png"):
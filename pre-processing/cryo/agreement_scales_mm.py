@@ -0,0 +1,181 @@
+import numpy as np
+import xarray as xr
+import matplotlib.pyplot as plt
+import sys
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from agreement_scales_fo import agreement_scales, exact_products, tiles, window_tables
+
+
+# Ensemble agreement scales from Dey et al. (2016), see agreement_scales_fo.py.
+# SA(mm) is the agreement scale between two ensemble members, averaged over
+# all member pairs: it measures the spatial spread of the ensemble.
+# SA(fo) is averaged over all member-observation pairs. Where the ensemble is
+# spread-skill consistent SA(mm) ~ SA(fo); SA(fo) > SA(mm) means the
+# members agree with each other at smaller scales than with the observation
+# (under-spread).
+
+CERISE_ZARR = "/ec/scratch/fab0/Projects/cerise/carra_snow_data/ana_v2.zarr"
+
+
+def agreement_scale_pairs(fields, pairs, alpha=0.5, S_lim=80, workers=8, tile=1024,
+                          backend="numpy"):
+    """
+    Agreement scale maps of several pairs of fields.
+
+    The grid is split in tiles with a halo of S_lim points (see
+    agreement_scale_map in agreement_scales_fo.py), processed one after the
+    other so that only the integral images of one tile are held. Within a
+    tile the integral images of each field are computed once, in parallel
+    threads, and shared by all the pairs the field belongs to; the pairs
+    then run in parallel threads, each only evaluated at its own not yet
+    agreed points.
+
+    Args:
+        fields (np.ndarray): (n_fields, y, x) stack, e.g. members + observation.
+        pairs (list): (i, j) indices into fields.
+        alpha (float): Tunable parameter for the agreement criterion (0 to 1).
+        S_lim (int): Maximum scale (in grid points) to check.
+        workers (int): Number of threads.
+        tile (int): Tile size in grid points.
+        backend (str): Integral image backend, numpy or numba (window_tables).
+
+    Returns:
+        np.ndarray: (n_pairs, y, x) agreement scales, NaN where undefined.
+    """
+    n_pairs = len(pairs)
+    ny, nx = fields.shape[1:]
+    print(f"Calculating agreement scales of {n_pairs} pairs for {ny} x {nx} grid...")
+
+    exact = [exact_products(fields[i], fields[j], S_lim) for i, j in pairs]
+    used = sorted({k for pair in pairs for k in pair})
+
+    SA = np.full((n_pairs, ny, nx), np.nan)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for t in tiles((ny, nx), tile):
+            y0, y1, x0, x1 = t
+            tables = dict(zip(used, pool.map(
+                lambda k: window_tables(fields[k], S_lim, t, backend), used)))
+
+            def pair_scales(p):
+                i, j = pairs[p]
+                return agreement_scales(fields[i], fields[j], tables[i], tables[j], alpha, S_lim,
+                                        t, exact[p])
+
+            for p, (SA_t, valid_t) in enumerate(pool.map(pair_scales, range(n_pairs))):
+                SA[p, y0:y1, x0:x1][valid_t] = SA_t[valid_t]
+    return SA
+
+
+def ensemble_agreement_scales(members, obs, alpha=0.5, S_lim=80, workers=8, tile=1024,
+                              backend="numpy"):
+    """
+    Mean SA(mm) over all member pairs and mean SA(fo) over all members.
+
+    Args:
+        members (np.ndarray): (member, y, x) fields.
+        obs (np.ndarray): 2D observed field on the same grid.
+
+    Returns:
+        tuple: (SA_mm, SA_fo) 2D maps.
+    """
+    n_members = members.shape[0]
+    fields = np.concatenate([members, obs[None]]).astype(float)
+    mm_pairs = [(i, j) for i in range(n_members) for j in range(i + 1, n_members)]
+    fo_pairs = [(i, n_members) for i in range(n_members)]
+    SA = agreement_scale_pairs(fields, mm_pairs + fo_pairs, alpha, S_lim, workers, tile, backend)
+    SA_mm = np.nanmean(SA[:len(mm_pairs)], axis=0)
+    SA_fo = np.nanmean(SA[len(mm_pairs):], axis=0)
+    return SA_mm, SA_fo
+
+
+def spread_skill(SA_mm, SA_fo, n_bins=10):
+    """
+    Binned comparison of SA(fo) against SA(mm).
+
+    Returns:
+        tuple: (bin centres of SA(mm), mean SA(fo) per bin, points per bin)
+    """
+    ok = ~np.isnan(SA_mm) & ~np.isnan(SA_fo)
+    edges = np.linspace(0, np.nanmax(SA_mm[ok]) + 1e-6, n_bins + 1)
+    index = np.digitize(SA_mm[ok], edges) - 1
+    counts = np.bincount(index, minlength=n_bins)[:n_bins]
+    sums = np.bincount(index, weights=SA_fo[ok], minlength=n_bins)[:n_bins]
+    mean_fo = np.full(n_bins, np.nan)
+    np.divide(sums, counts, out=mean_fo, where=counts > 0)
+    return 0.5 * (edges[1:] + edges[:-1]), mean_fo, counts
+
+
+def plot_ensemble_agreement_scales(obs_field, SA_mm, SA_fo, output_filename="agreement_scales_MM.png"):
+    """
+    Creates and saves a 4-panel plot: observation, SA(mm), SA(fo) and the
+    spread-skill comparison.
+    """
+    fig, axes = plt.subplots(2, 2, figsize=(12, 10))
+    fig.suptitle('Ensemble Agreement Scales (Dey et al. 2016)', fontsize=16)
+    vmax = np.nanmax([np.nanmax(SA_mm), np.nanmax(SA_fo)])
+
+    ax = axes[0, 0]
+    im1 = ax.imshow(obs_field, cmap='viridis', origin='lower', vmin=0)
+    ax.set_title("Observations")
+    plt.colorbar(im1, ax=ax, fraction=0.046, pad=0.04, label="Value")
+
+    for ax, SA, title in ((axes[0, 1], SA_mm, "Mean SA(mm)"), (axes[1, 0], SA_fo, "Mean SA(fo)")):
+        im = ax.imshow(SA, cmap='YlOrRd_r', origin='lower', vmin=0, vmax=vmax)
+        ax.set_title(title)
+        ax.set_xlabel("Grid X")
+        ax.set_ylabel("Grid Y")
+        plt.colorbar(im, ax=ax, fraction=0.046, pad=0.04, label="Agreement Scale (grid points)")
+
+    ax = axes[1, 1]
+    centres, mean_fo, counts = spread_skill(SA_mm, SA_fo)
+    ax.plot(centres[counts > 0], mean_fo[counts > 0], 'o-', color='red', label="binned mean")
+    ax.plot([0, vmax], [0, vmax], 'k--', label="SA(fo) = SA(mm)")
+    ax.set_title("Spread-skill")
+    ax.set_xlabel("SA(mm) (grid points)")
+    ax.set_ylabel("SA(fo) (grid points)")
+    ax.legend()
+
+    plt.tight_layout(rect=[0, 0.03, 1, 0.95])
+    plt.savefig(output_filename, dpi=150)
+    print(f"\nVisualization saved as '{output_filename}'")
+
+
+if __name__ == "__main__":
+    # --- Parameters from Dey et al. (2016) ---
+    alpha = 0.5
+    S_lim = 80  # Maximum neighborhood half-width (grid points)
+    hxa_thresh = 0.01  # snow threshold, as in dump_cerise.py
+    workers = int(os.environ.get("OMP_NUM_THREADS", 8))
+
+    # usage: python agreement_scales_mm.py 2018-02-02 obs_file.nc out.png [ana_v2.zarr]
+    date = sys.argv[1]
+    obs_file_path = sys.argv[2]
+    png_path = sys.argv[3]
+    zarr_path = sys.argv[4] if len(sys.argv) > 4 else CERISE_ZARR
+
+    print("--- Loading data ---")
+    hxa = xr.open_zarr(zarr_path)["hxa"].sel(time=slice(date, date)).isel(time=0)
+    hxa = hxa.transpose("member", ...).values
+    members = np.where(np.isnan(hxa), np.nan, (hxa > hxa_thresh).astype(float))
+    obs_field = xr.open_dataset(obs_file_path)["bin_snow"].squeeze(drop=True).values
+    if obs_field.shape != members.shape[1:]:
+        sys.exit(f"Observation grid {obs_field.shape} differs from the ensemble grid {members.shape[1:]}")
+    print(f"--- {members.shape[0]} members loaded ---")
+
+    SA_mm, SA_fo = ensemble_agreement_scales(members, obs_field, alpha=alpha, S_lim=S_lim,
+                                             workers=workers)
+
+    print("\n=== RESULTS SUMMARY ===")
+    print(f"Domain-mean SA(mm): {np.nanmean(SA_mm):.1f} grid points")
+    print(f"Domain-mean SA(fo): {np.nanmean(SA_fo):.1f} grid points")
+    ok = ~np.isnan(SA_mm) & ~np.isnan(SA_fo)
+    print(f"Share of points with SA(fo) > SA(mm) (under-spread): {np.mean(SA_fo[ok] > SA_mm[ok]):.2f}")
+
+    nc_path = os.path.splitext(png_path)[0] + ".nc"
+    xr.Dataset({"SA_mm": (("y", "x"), SA_mm), "SA_fo": (("y", "x"), SA_fo)},
+               attrs={"date": date, "alpha": alpha, "S_lim": S_lim}).to_netcdf(nc_path)
+    print(f"Agreement scale maps saved as '{nc_path}'")
+
+    plot_ensemble_agreement_scales(obs_field, SA_mm, SA_fo, png_path)
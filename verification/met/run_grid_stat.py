@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Parallel grid_stat driver over dates and GridStat configurations.
+
+The run_grid_stat_*.sh and verify_carra1_land2_cryo.sh scripts call
+grid_stat one day after the other. Here the (fcst, obs, config) jobs are
+built by listing the forecast and observation directories once, matching
+the file names against strftime templates, and run through a bounded
+process pool, with grid_stat called directly or through
+`apptainer run <met.sif>`.
+
+Every job runs in its own temporary directory (also used as MET_TMP_DIR),
+so concurrent jobs do not share scratch files; the files it writes are
+moved to the output directory when it succeeds (to <outdir>/<config
+name> when several configurations are given, their output names would
+clash otherwise). The grid_stat output of every job goes to
+<outdir>/logs/<config>_<date>.log and the status, return code and
+duration of all jobs to <outdir>/logs/jobs.csv, which --resume uses to
+skip the jobs already done.
+
+stub_grid_stat.py stands in for grid_stat (--grid-stat) to try the
+driver without MET.
+
+Usage:
+    python run_grid_stat.py --fcst /ec/res4/scratch/nhd/CERISE/CERISE_output/cerise_%Y%m%d.nc \
+        --obs /ec/res4/scratch/nhd/CERISE/IMS_snow_cover/from_zarr/ims_%Y%m%d.nc \
+        --config config-files/GridStatConfig_ims_vs_cerise \
+        --outdir /ec/res4/scratch/nhd/CERISE/MET_CERISE_vs_IMS_paper \
+        --date-ini 2015-09-01 --date-end 2019-08-31 --workers 16 \
+        --apptainer /ec/res4/hpcperm/nhd/containers/met_12.1.0.sif
+"""
+
+import argparse
+import concurrent.futures as cf
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import pandas as pd
+
+LOG_COLUMNS = ["date", "config", "fcst", "obs", "status", "returncode", "seconds", "n_files"]
+
+
+def scan_dates(template):
+    """
+    Dates of the files matching a template, listing its directory once.
+
+    Args:
+        template (str): Path with strftime codes in the file name only,
+            e.g. /data/ims_%Y%m%d.nc.
+
+    Returns:
+        dict: pd.Timestamp -> absolute path (grid_stat runs in a temporary directory)
+    """
+    directory, pattern = os.path.split(os.path.abspath(template))
+    found = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                date = datetime.strptime(entry.name, pattern)
+            except ValueError:
+                continue
+            found[pd.Timestamp(date)] = entry.path
+    return found
+
+
+def build_jobs(fcst_template, obs_template, configs, date_ini=None, date_end=None):
+    """
+    (date, fcst, obs, config) of every configuration and day with both files.
+
+    Returns:
+        list: Jobs as dicts, oldest date first.
+    """
+    fcst, obs = scan_dates(fcst_template), scan_dates(obs_template)
+    dates = sorted(set(fcst) & set(obs))
+    if date_ini is not None:
+        dates = [d for d in dates if d >= pd.Timestamp(date_ini)]
+    if date_end is not None:
+        dates = [d for d in dates if d <= pd.Timestamp(date_end)]
+    return [{"date": date, "fcst": fcst[date], "obs": obs[date], "config": config}
+            for date in dates for config in configs]
+
+
+def grid_stat_command(job, outdir, grid_stat="grid_stat", apptainer=None, binds=(), verbosity=2):
+    """Command line of one job, writing its output to outdir."""
+    command = [grid_stat, job["fcst"], job["obs"], os.path.abspath(job["config"]),
+               "-outdir", outdir, "-v", str(verbosity)]
+    if apptainer is None:
+        return command
+    prefix = ["apptainer", "run"]
+    for path in binds:
+        prefix += ["--bind", path]
+    return prefix + [apptainer] + command
+
+
+def job_name(job):
+    return f"{os.path.basename(job['config'])}_{job['date']:%Y%m%d}"
+
+
+def run_job(job, outdir, log_dir, tmp_root, grid_stat="grid_stat", apptainer=None, binds=(),
+            verbosity=2, timeout=None):
+    """
+    Runs one grid_stat job in its own temporary directory and moves its
+    output files to outdir if it succeeds.
+
+    Returns:
+        dict: The job with status, returncode, seconds and n_files.
+    """
+    name = job_name(job)
+    os.makedirs(tmp_root or tempfile.gettempdir(), exist_ok=True)
+    start = time.monotonic()
+    with tempfile.TemporaryDirectory(prefix=f"{name}_", dir=tmp_root) as work:
+        job_out = os.path.join(work, "out")
+        os.makedirs(job_out)
+        # apptainer binds the working directory, grid_stat sees the same paths
+        binds = list(binds) + ([work] if apptainer else [])
+        command = grid_stat_command(job, job_out, grid_stat, apptainer, binds, verbosity)
+        env = dict(os.environ, MET_TMP_DIR=work)
+        with open(os.path.join(log_dir, f"{name}.log"), "w") as log:
+            log.write(" ".join(command) + "\n")
+            log.flush()
+            try:
+                returncode = subprocess.run(command, cwd=work, env=env, stdout=log,
+                                            stderr=subprocess.STDOUT, timeout=timeout).returncode
+                status = "done" if returncode == 0 else "failed"
+            except subprocess.TimeoutExpired:
+                returncode, status = None, "timeout"
+            except OSError as err:  # executable not found, ...
+                log.write(f"{err}\n")
+                returncode, status = None, "failed"
+        files = os.listdir(job_out)
+        if status == "done" and not files:
+            status = "no output"
+        if status == "done":
+            for file in files:
+                os.replace(os.path.join(job_out, file), os.path.join(outdir, file))
+    return dict(job, status=status, returncode=returncode, n_files=len(files),
+                seconds=round(time.monotonic() - start, 2))
+
+
+def done_jobs(log_path):
+    """(config, date) of the jobs done according to a jobs.csv log."""
+    if not os.path.isfile(log_path):
+        return set()
+    log = pd.read_csv(log_path, parse_dates=["date"])
+    log = log[log["status"] == "done"]
+    return set(zip(log["config"], log["date"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fcst", required=True,
+                        help="Forecast files, strftime template, e.g. /data/cerise_%%Y%%m%%d.nc")
+    parser.add_argument("--obs", required=True, help="Observation files, strftime template")
+    parser.add_argument("--config", nargs="+", required=True, help="GridStatConfig file(s)")
+    parser.add_argument("--outdir", required=True, help="MET output directory")
+    parser.add_argument("--date-ini", help="First date, YYYY-MM-DD")
+    parser.add_argument("--date-end", help="Last date, YYYY-MM-DD")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent grid_stat jobs")
+    parser.add_argument("--grid-stat", default="grid_stat",
+                        help="grid_stat executable (e.g. stub_grid_stat.py to test)")
+    parser.add_argument("--apptainer", help="Run grid_stat in this MET container (.sif)")
+    parser.add_argument("--bind", nargs="*", default=[],
+                        help="Extra apptainer bind paths (input and output directories)")
+    parser.add_argument("--tmp-dir", help="Root of the job directories (default: TMPDIR)")
+    parser.add_argument("--timeout", type=float, help="Seconds before a job is killed")
+    parser.add_argument("-v", "--verbosity", type=int, default=2, help="grid_stat -v level")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip the jobs done in a previous run (logs/jobs.csv)")
+    args = parser.parse_args()
+
+    for config in args.config:
+        if not os.path.isfile(config):
+            parser.error(f"{config} not found")
+    grid_stat = args.grid_stat
+    if args.apptainer is None:
+        # jobs run in their own directory, relative paths would not be found
+        grid_stat = shutil.which(grid_stat)
+        if grid_stat is None:
+            parser.error(f"{args.grid_stat} not found or not executable")
+        grid_stat = os.path.abspath(grid_stat)
+    jobs = build_jobs(args.fcst, args.obs, args.config, args.date_ini, args.date_end)
+    log_dir = os.path.join(args.outdir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    log_path = os.path.join(log_dir, "jobs.csv")
+    if args.resume:
+        done = done_jobs(log_path)
+        jobs = [job for job in jobs if (job["config"], job["date"]) not in done]
+    if not jobs:
+        print("No jobs to run")
+        return
+    outdirs = {}
+    for config in args.config:
+        outdirs[config] = args.outdir
+        if len(args.config) > 1:
+            outdirs[config] = os.path.join(args.outdir, os.path.basename(config))
+        os.makedirs(outdirs[config], exist_ok=True)
+
+    print(f"{len(jobs)} jobs, {args.workers} workers")
+    results = []
+    with cf.ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(run_job, job, outdirs[job["config"]], log_dir, args.tmp_dir,
+                               grid_stat, args.apptainer, args.bind, args.verbosity,
+                               args.timeout)
+                   for job in jobs]
+        for future in cf.as_completed(futures):
+            result = future.result()
+            results.append(result)
+            # logged as the jobs finish, an interrupted run can be resumed
+            pd.DataFrame([result], columns=LOG_COLUMNS).to_csv(
+                log_path, mode="a", header=not os.path.isfile(log_path), index=False)
+            print(f"{job_name(result)}: {result['status']} in {result['seconds']:.1f} s"
+                  f" ({len(results)}/{len(jobs)})")
+
+    table = pd.DataFrame(results, columns=LOG_COLUMNS).sort_values(["date", "config"])
+    counts = table["status"].value_counts()
+    print(", ".join(f"{n} {status}" for status, n in counts.items()) + f", log in {log_path}")
+    failed = table[table["status"] != "done"]
+    for _, row in failed.iterrows():
+        print(f"  {job_name(row)}: {row['status']}, see {log_dir}/{job_name(row)}.log")
+
+
+if __name__ == "__main__":
+    main()
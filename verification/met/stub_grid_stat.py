@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Stand-in for grid_stat, to run run_grid_stat.py (or a pipeline) without MET.
+
+Takes the grid_stat arguments (fcst obs config -outdir DIR [-v N]),
+checks that the files exist and writes the .stat and _nbrcnt.txt files
+grid_stat would name for the day (model and output_prefix read from the
+config), with made-up FSS values for the FULL mask and widths 1, 3, 5, 7.
+The _nbrcnt.txt files can be read by post-processing/fss_store.py.
+
+Environment variables for testing the driver:
+- STUB_GRID_STAT_SLEEP: seconds to wait before writing (default 0)
+- STUB_GRID_STAT_FAIL: fail (exit code 1) for fcst files containing this string
+
+Usage:
+    python run_grid_stat.py --grid-stat ./stub_grid_stat.py ...
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+import numpy as np
+
+NBRCNT_COLUMNS = ["VERSION", "MODEL", "DESC", "FCST_LEAD", "FCST_VALID_BEG", "FCST_VALID_END",
+                  "OBS_LEAD", "OBS_VALID_BEG", "OBS_VALID_END", "FCST_VAR", "FCST_UNITS",
+                  "FCST_LEV", "OBS_VAR", "OBS_UNITS", "OBS_LEV", "OBTYPE", "VX_MASK",
+                  "INTERP_MTHD", "INTERP_PNTS", "FCST_THRESH", "OBS_THRESH", "COV_THRESH",
+                  "ALPHA", "LINE_TYPE", "TOTAL", "FBS", "FBS_BCL", "FBS_BCU", "FSS", "FSS_BCL",
+                  "FSS_BCU", "AFSS", "AFSS_BCL", "AFSS_BCU", "UFSS", "UFSS_BCL", "UFSS_BCU",
+                  "F_RATE", "F_RATE_BCL", "F_RATE_BCU", "O_RATE", "O_RATE_BCL", "O_RATE_BCU"]
+
+
+def config_value(text, key, default):
+    match = re.search(rf'^\s*{key}\s*=\s*"([^"]*)"', text, re.MULTILINE)
+    return match.group(1) if match else default
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fcst")
+    parser.add_argument("obs")
+    parser.add_argument("config")
+    parser.add_argument("-outdir", required=True)
+    parser.add_argument("-v", type=int, default=2)
+    args = parser.parse_args()
+
+    for path in (args.fcst, args.obs, args.config):
+        if not os.path.isfile(path):
+            sys.exit(f"ERROR: {path} not found")
+    time.sleep(float(os.environ.get("STUB_GRID_STAT_SLEEP", 0)))
+    fail = os.environ.get("STUB_GRID_STAT_FAIL")
+    if fail and fail in os.path.basename(args.fcst):
+        sys.exit(f"ERROR: stub failure for {args.fcst}")
+
+    date = re.search(r"(\d{8})", os.path.basename(args.fcst))
+    if date is None:
+        sys.exit(f"ERROR: no YYYYMMDD date in {args.fcst}")
+    valid = f"{date.group(1)}_000000"
+    with open(args.config) as f:
+        text = f.read()
+    model = config_value(text, "model", "FCST")
+    prefix = config_value(text, "output_prefix", "")
+    base = "grid_stat_" + (f"{prefix}_" if prefix else "") + f"000000L_{valid}V"
+
+    rng = np.random.default_rng(int(date.group(1)))
+    rows = []
+    for width in (1, 3, 5, 7):
+        fss = min(0.99, 0.6 + 0.05 * width + 0.05 * rng.random())
+        f_rate, o_rate = rng.uniform(0.3, 0.5, 2)
+        fbs_ref = f_rate ** 2 + o_rate ** 2
+        values = {"VERSION": "V12.1.0", "MODEL": model, "DESC": "NA", "FCST_LEAD": "000000",
+                  "FCST_VALID_BEG": valid, "FCST_VALID_END": valid, "OBS_LEAD": "000000",
+                  "OBS_VALID_BEG": valid, "OBS_VALID_END": valid, "FCST_VAR": "bin_snow",
+                  "FCST_UNITS": "1", "FCST_LEV": "*,*", "OBS_VAR": "bin_snow", "OBS_UNITS": "1",
+                  "OBS_LEV": "*,*", "OBTYPE": "OBS", "VX_MASK": "FULL", "INTERP_MTHD": "NBRHD",
+                  "INTERP_PNTS": width * width, "FCST_THRESH": ">=1.0", "OBS_THRESH": ">=1.0",
+                  "COV_THRESH": ">=0.5", "ALPHA": "NA", "LINE_TYPE": "NBRCNT", "TOTAL": 100000,
+                  "FBS": f"{(1 - fss) * fbs_ref:.5f}", "FSS": f"{fss:.5f}",
+                  "AFSS": f"{fss:.5f}", "UFSS": f"{0.5 + o_rate / 2:.5f}",
+                  "F_RATE": f"{f_rate:.5f}", "O_RATE": f"{o_rate:.5f}"}
+        rows.append([str(values.get(column, "NA")) for column in NBRCNT_COLUMNS])
+
+    os.makedirs(args.outdir, exist_ok=True)
+    lines = [" ".join(NBRCNT_COLUMNS)] + [" ".join(row) for row in rows]
+    with open(os.path.join(args.outdir, f"{base}_nbrcnt.txt"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+    with open(os.path.join(args.outdir, f"{base}.stat"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+    if args.v >= 2:
+        print(f"DEBUG 1: stub grid_stat {model} {valid}: {base}.stat, {base}_nbrcnt.txt")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Thread scaling of the numba box-filter kernels (box_filter.py).
+
+For every grid size and thread count, times on a synthetic snow field
+- the fraction fields of all widths: numpy (neighbourhood.fraction_fields)
+  against numba (box_filter.fraction_fields)
+- the NaN-aware window mean of agreement_scales_fo.py: scipy
+  uniform_filter against box_filter.window_mean_nan
+and prints the throughput in Mpixel/s. The numpy and scipy versions run
+on one core whatever the thread count; they are repeated as reference.
+
+Usage:
+    python bench_box_filter.py --grid IMS=1000x800 CARRA2=2869x2869 --threads 1 2 4 8 16 \
+        --csv bench_box_filter.csv
+"""
+
+import argparse
+import os
+import time
+
+import numba
+import numpy as np
+import pandas as pd
+from scipy.ndimage import gaussian_filter, uniform_filter
+
+import box_filter
+from neighbourhood import check_widths, fraction_fields
+
+
+def parse_grid(spec):
+    """NAME=NYxNX, e.g. CARRA2=2869x2869."""
+    name, _, size = spec.partition("=")
+    ny, nx = (int(n) for n in size.lower().split("x"))
+    return name, (ny, nx)
+
+
+def snow_field(shape, seed=0):
+    """Binary snow field with smooth edges and a few undefined points (NaN)."""
+    rng = np.random.default_rng(seed)
+    field = (gaussian_filter(rng.normal(size=shape), 10) > 0).astype(float)
+    field[rng.random(shape) < 0.01] = np.nan
+    return field
+
+
+def uniform_window_mean_nan(mat, size):
+    """window_mean_nan of pre-processing/cryo/agreement_scales_fo.py with uniform_filter."""
+    nan_mask = np.isnan(mat)
+    sums = uniform_filter(np.where(nan_mask, 0.0, mat), size=size, mode="mirror")
+    counts = uniform_filter((~nan_mask).astype(float), size=size, mode="mirror")
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def best_time(func, repeat):
+    """Shortest of repeat wall-clock times of func()."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run(grids, threads, widths, window, repeat):
+    rows = []
+    for name, shape in grids:
+        field = snow_field(shape)
+        valid = ~np.isnan(field)
+        event = field >= 1.0
+        mpix = shape[0] * shape[1] / 1e6
+        cases = {
+            "fraction_fields": (
+                lambda: fraction_fields(event, valid, widths),
+                lambda: box_filter.fraction_fields(event, valid, widths),
+            ),
+            "window_mean_nan": (
+                lambda: uniform_window_mean_nan(field, window),
+                lambda: box_filter.window_mean_nan(field, window),
+            ),
+        }
+        for case, (reference, kernel) in cases.items():
+            kernel()  # compile (or load from the cache) before timing
+            for n in threads:
+                numba.set_num_threads(n)
+                t_ref = best_time(reference, repeat)
+                t_numba = best_time(kernel, repeat)
+                rows.append({"grid": name, "ny": shape[0], "nx": shape[1], "case": case,
+                             "threads": n, "reference_s": t_ref, "numba_s": t_numba,
+                             "reference_mpix_s": mpix / t_ref, "numba_mpix_s": mpix / t_numba,
+                             "speedup": t_ref / t_numba})
+                print(f"{name:8s} {case:16s} {n:4d} threads: reference {mpix / t_ref:8.1f}"
+                      f" numba {mpix / t_numba:8.1f} Mpixel/s ({t_ref / t_numba:.2f}x)")
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--grid", nargs="+", default=["IMS=1000x800", "CARRA2=2869x2869"],
+                        help="Grid sizes as NAME=NYxNX")
+    parser.add_argument("--threads", type=int, nargs="+",
+                        help="Thread counts (default: powers of two up to all cores)")
+    parser.add_argument("--widths", type=int, nargs="+", default=[1, 3, 5, 7, 9, 11])
+    parser.add_argument("--window", type=int, default=41,
+                        help="Window of the NaN-aware mean (2 S + 1)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--csv", help="Write the timings to this CSV file")
+    args = parser.parse_args()
+
+    max_threads = numba.config.NUMBA_NUM_THREADS
+    threads = args.threads or sorted({min(2 ** k, max_threads)
+                                      for k in range(max_threads.bit_length() + 1)})
+    if max(threads) > max_threads:
+        parser.error(f"at most {max_threads} threads (NUMBA_NUM_THREADS) on this node")
+    print(f"{os.cpu_count()} cores, threading layer {numba.config.THREADING_LAYER}")
+    result = run([parse_grid(spec) for spec in args.grid], threads, check_widths(args.widths),
+                 args.window, args.repeat)
+    if args.csv:
+        result.to_csv(args.csv, index=False)
+        print(f"Saved: {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Multi-threaded integral images and box filters (numba).
+
+scipy.ndimage.uniform_filter and the numpy cumulative sums used in
+neighbourhood.py run on one core. The kernels here are compiled with
+numba (parallel=True, nogil=True):
+- integral_image: the cumulative sum down the columns runs in parallel
+  over blocks of columns, the one along the rows in parallel over rows.
+  Every element is accumulated in the same order as the numpy version,
+  so the tables (and everything derived from them) are bit-identical to
+  neighbourhood.integral_image, for counts and for float fields.
+- fraction_fields: window sums of the events and of the valid points and
+  their ratio in one pass over the rows, without full-size temporaries.
+- window_mean_nan: NaN-aware window mean with mirrored edges, as
+  window_mean_nan of pre-processing/cryo/agreement_scales_fo.py.
+
+The number of threads of one call is set with numba.set_num_threads or
+NUMBA_NUM_THREADS. Being nogil, the kernels can also be called from a
+thread pool (e.g. the bands of neighbourhood.tiled_partial_sums), but
+the default workqueue threading layer cannot be entered by two threads
+at once: the calls are then serialized, unless NUMBA_THREADING_LAYER is
+tbb or omp.
+"""
+
+import threading
+
+import numba
+import numpy as np
+
+from neighbourhood import check_widths, count_dtype
+
+# columns handled together in the vertical pass (cache lines of the rows)
+COLUMN_BLOCK = 64
+_LOCK = threading.Lock()
+
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def _prefix_sums(table):
+    n_fields, n_rows, n_cols = table.shape
+    n_blocks = (n_cols + COLUMN_BLOCK - 1) // COLUMN_BLOCK
+    # down the columns (numpy axis -2 first)
+    for task in numba.prange(n_fields * n_blocks):
+        k, b = task // n_blocks, task % n_blocks
+        j0, j1 = b * COLUMN_BLOCK, min((b + 1) * COLUMN_BLOCK, n_cols)
+        for i in range(1, n_rows):
+            for j in range(j0, j1):
+                table[k, i, j] += table[k, i - 1, j]
+    # along the rows
+    for task in numba.prange(n_fields * n_rows):
+        k, i = task // n_rows, task % n_rows
+        for j in range(1, n_cols):
+            table[k, i, j] += table[k, i, j - 1]
+
+
+def _launch(kernel, *args):
+    """Calls a parallel kernel, one thread at a time unless the threading layer is thread-safe."""
+    if numba.config.THREADING_LAYER in ("tbb", "omp"):
+        return kernel(*args)
+    with _LOCK:
+        return kernel(*args)
+
+
+def integral_image(field, pad, dtype=None):
+    """
+    neighbourhood.integral_image computed with the numba kernels.
+
+    Args:
+        field (np.ndarray): Array (..., y, x), boolean (counts) or numeric.
+        pad (int): Number of zero points added around the domain.
+        dtype: Table type, by default as neighbourhood.integral_image.
+
+    Returns:
+        np.ndarray: (..., y + 2 pad + 1, x + 2 pad + 1) cumulative sums,
+        same dtype and values as neighbourhood.integral_image.
+    """
+    lead = field.shape[:-2]
+    ny, nx = field.shape[-2:]
+    if dtype is None and field.dtype == bool:
+        dtype = count_dtype((2 * pad + 1) ** 2)
+    elif dtype is None:
+        dtype = np.result_type(field.dtype, np.int64)
+    table = np.zeros((int(np.prod(lead)), ny + 2 * pad + 1, nx + 2 * pad + 1), dtype=dtype)
+    table[:, pad + 1:pad + ny + 1, pad + 1:pad + nx + 1] = field.reshape(-1, ny, nx)
+    _launch(_prefix_sums, table)
+    return table.reshape(lead + table.shape[1:])
+
+
+def _modulus(table):
+    """2^bits of uint16/uint32 tables, whose window sums are taken modulo 2^bits, else 0."""
+    if table.dtype in (np.uint16, np.uint32):
+        return 2 ** (8 * table.dtype.itemsize)
+    return 0
+
+
+@numba.njit(inline="always")
+def _corners(table, k, y0, y1, x0, x1, modulus):
+    value = table[k, y1, x1] - table[k, y0, x1] - table[k, y1, x0] + table[k, y0, x0]
+    if modulus > 0:
+        # the tables wrap around, the window sums are exact modulo 2^bits
+        value = value % modulus
+    return value
+
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def _box_ratio(sum_table, count_table, point_valid, half, pad, min_count, out, sum_modulus,
+               count_modulus):
+    # out[k, i, j] = window sum / window count, NaN where the point is not
+    # valid or the window has fewer than min_count valid points
+    n_fields, ny, nx = out.shape
+    for task in numba.prange(n_fields * ny):
+        k, i = task // ny, task % ny
+        y0, y1 = i + pad - half, i + pad + half + 1
+        for j in range(nx):
+            x0, x1 = j + pad - half, j + pad + half + 1
+            count = _corners(count_table, k, y0, y1, x0, x1, count_modulus)
+            if point_valid[k, i, j] and count >= min_count and count > 0:
+                out[k, i, j] = _corners(sum_table, k, y0, y1, x0, x1, sum_modulus) / count
+            else:
+                out[k, i, j] = np.nan
+
+
+def fraction_fields(event, valid, widths, vld_thresh=1.0, nbrhd_shape="SQUARE"):
+    """
+    neighbourhood.fraction_fields (SQUARE) computed with the numba kernels.
+
+    Returns:
+        dict: width -> float64 fraction field (..., y, x), bit-identical to
+        neighbourhood.fraction_fields.
+    """
+    widths = check_widths(widths)
+    if nbrhd_shape != "SQUARE":
+        raise ValueError(f"The numba kernels support SQUARE neighbourhoods only, not {nbrhd_shape}")
+    lead = event.shape[:-2]
+    ny, nx = event.shape[-2:]
+    pad = (max(widths) - 1) // 2
+    event_table = integral_image((event & valid).reshape(-1, ny, nx), pad)
+    valid_table = integral_image(valid.reshape(-1, ny, nx), pad)
+    point_valid = np.ascontiguousarray(valid.reshape(-1, ny, nx))
+    fractions = {}
+    for width in widths:
+        out = np.empty(point_valid.shape)
+        _launch(_box_ratio, event_table, valid_table, point_valid, (width - 1) // 2, pad,
+                vld_thresh * width * width, out, _modulus(event_table), _modulus(valid_table))
+        fractions[width] = out.reshape(lead + (ny, nx))
+    return fractions
+
+
+def window_mean_nan(mat, size):
+    """
+    Window mean of a 2D array with NaNs, mirrored edges (mode='mirror').
+
+    Args:
+        mat (np.ndarray): The input 2D array.
+        size (int): Odd size of the square window.
+
+    Returns:
+        np.ndarray: The windowed means, NaN where the window has no valid point.
+    """
+    half = (size - 1) // 2
+    nan_mask = np.isnan(mat)
+    values = np.pad(np.where(nan_mask, 0.0, mat), half, mode="reflect")
+    counts = np.pad(~nan_mask, half, mode="reflect")
+    sum_table = integral_image(values[None], 0)
+    count_table = integral_image(counts[None], 0, count_dtype(size * size))
+    out = np.empty((1,) + mat.shape)
+    _launch(_box_ratio, sum_table, count_table, np.ones(out.shape, dtype=np.bool_), half, half,
+            1, out, 0, _modulus(count_table))
+    return out[0]
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Native computation of the MET CTC/CTS statistics for binary snow.
+
+Instead of running grid_stat once per day and reading the _cts.txt files
+back (see post-processing/time_series_fss.py), the daily bin_snow files of
+a forecast and an observation source are stacked into (time, y, x) cubes
+and the contingency table of every day and region is obtained in one
+vectorized pass.
+
+Usage:
+    python categorical_stats.py CERISE IMS 2015-09-01 2019-08-31 \
+        --mask NORTH_SWEDEN=north_sweden_mask.nc --output cts_cerise.csv
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from packed_ctc import contingency_counts_packed, pack_bits, packed_counts
+from snow_io import daily_dates, load_bin_snow_cube, load_regions, parse_source
+
+# Column names as in the MET CTC line type
+CTC_COLUMNS = ["TOTAL", "FY_OY", "FY_ON", "FN_OY", "FN_ON"]
+# Subset of the MET CTS line type columns
+CTS_COLUMNS = ["BASER", "FMEAN", "ACC", "FBIAS", "PODY", "PODN", "POFD",
+               "FAR", "CSI", "GSS", "HK", "HSS", "ODDS"]
+
+
+def event_fields(fcst, obs, thresh=1.0, mask=None):
+    """
+    Applies the categorical threshold (cat_thresh = [ >=1 ] in the
+    GridStatConfig files) and builds the mask of valid points.
+
+    Args:
+        fcst (np.ndarray): Forecast field(s), NaN where undefined.
+        obs (np.ndarray): Observation field(s), NaN where undefined.
+        thresh (float): Event threshold, an event is value >= thresh.
+        mask (np.ndarray): Optional 2D boolean region mask.
+
+    Returns:
+        tuple: boolean arrays (fcst_event, obs_event, valid)
+    """
+    valid = ~np.isnan(fcst) & ~np.isnan(obs)
+    if mask is not None:
+        valid &= mask
+    with np.errstate(invalid="ignore"):
+        fcst_event = fcst >= thresh
+        obs_event = obs >= thresh
+    return fcst_event, obs_event, valid
+
+
+def contingency_counts(fcst_event, obs_event, valid, backend="numpy"):
+    """
+    Counts the four cells of the contingency table over the last two axes.
+
+    Only three masked reductions are needed: the hits, the forecast and
+    observed event counts and the number of valid points give the other
+    cells by difference.
+
+    Args:
+        fcst_event (np.ndarray): Boolean forecast events, (..., y, x).
+        obs_event (np.ndarray): Boolean observed events, (..., y, x).
+        valid (np.ndarray): Boolean valid points, broadcastable to the above.
+        backend (str): "numpy" for boolean reductions, or "packed" for the
+            bit-parallel popcount kernel in packed_ctc.py.
+
+    Returns:
+        dict: int64 arrays TOTAL, FY_OY, FY_ON, FN_OY, FN_ON of shape (...).
+    """
+    if backend == "packed":
+        return contingency_counts_packed(fcst_event, obs_event, valid)
+    if backend != "numpy":
+        raise ValueError(f"Unknown backend {backend}")
+    axes = (-2, -1)
+    fy = fcst_event & valid
+    oy = obs_event & valid
+    total = np.count_nonzero(np.broadcast_to(valid, fy.shape), axis=axes)
+    hits = np.count_nonzero(fy & oy, axis=axes)
+    fcst_yes = np.count_nonzero(fy, axis=axes)
+    obs_yes = np.count_nonzero(oy, axis=axes)
+    false_alarms = fcst_yes - hits
+    misses = obs_yes - hits
+    return {
+        "TOTAL": total.astype(np.int64),
+        "FY_OY": hits.astype(np.int64),
+        "FY_ON": false_alarms.astype(np.int64),
+        "FN_OY": misses.astype(np.int64),
+        "FN_ON": (total - hits - false_alarms - misses).astype(np.int64),
+    }
+
+
+def categorical_scores(ctc):
+    """
+    Derives the CTS scores from contingency counts, following the
+    definitions in the MET User's Guide. Scores with a zero denominator
+    are NaN (NA in MET).
+
+    Args:
+        ctc (dict or pd.DataFrame): Counts as returned by contingency_counts.
+
+    Returns:
+        dict: float arrays, one per entry of CTS_COLUMNS.
+    """
+    n = np.asarray(ctc["TOTAL"], dtype=float)
+    hits = np.asarray(ctc["FY_OY"], dtype=float)
+    fa = np.asarray(ctc["FY_ON"], dtype=float)
+    misses = np.asarray(ctc["FN_OY"], dtype=float)
+    cn = np.asarray(ctc["FN_ON"], dtype=float)
+
+    def ratio(num, den):
+        out = np.full(np.broadcast(num, den).shape, np.nan)
+        np.divide(num, den, out=out, where=den != 0)
+        return out
+
+    obs_yes = hits + misses
+    fcst_yes = hits + fa
+    hits_random = ratio(obs_yes * fcst_yes, n)
+    correct_random = ratio(obs_yes * fcst_yes + (cn + misses) * (cn + fa), n)
+    pody = ratio(hits, obs_yes)
+    pofd = ratio(fa, fa + cn)
+    return {
+        "BASER": ratio(obs_yes, n),
+        "FMEAN": ratio(fcst_yes, n),
+        "ACC": ratio(hits + cn, n),
+        "FBIAS": ratio(fcst_yes, obs_yes),
+        "PODY": pody,
+        "PODN": ratio(cn, fa + cn),
+        "POFD": pofd,
+        "FAR": ratio(fa, fcst_yes),
+        "CSI": ratio(hits, hits + misses + fa),
+        "GSS": ratio(hits - hits_random, hits + misses + fa - hits_random),
+        "HK": pody - pofd,
+        "HSS": ratio(hits + cn - correct_random, n - correct_random),
+        "ODDS": ratio(hits * cn, fa * misses),
+    }
+
+
+def verify_categorical(fcst, obs, dates, regions, thresh=1.0, backend="numpy"):
+    """
+    Computes CTC and CTS for every day and region of a stacked pair.
+
+    Args:
+        fcst (np.ndarray): Forecast cube (time, y, x).
+        obs (np.ndarray): Observation cube (time, y, x) on the same grid.
+        dates (iterable): Dates of the time axis.
+        regions (dict): Region name -> 2D boolean mask (None for FULL).
+        thresh (float): Event threshold.
+        backend (str): "numpy" or "packed" (see contingency_counts).
+            With "packed" the fields are packed once and reused for
+            all regions.
+
+    Returns:
+        pd.DataFrame: Tidy table with columns date, region, stat, value.
+    """
+    fcst_event, obs_event, valid = event_fields(fcst, obs, thresh)
+    if backend == "packed":
+        fcst_words = pack_bits(fcst_event)
+        obs_words = pack_bits(obs_event)
+        valid_words = pack_bits(valid)
+    tables = []
+    for region, mask in regions.items():
+        if backend == "packed":
+            region_words = valid_words if mask is None else valid_words & pack_bits(mask)
+            stats = packed_counts(fcst_words, obs_words, region_words)
+        else:
+            region_valid = valid if mask is None else valid & mask
+            stats = contingency_counts(fcst_event, obs_event, region_valid, backend)
+        stats.update(categorical_scores(stats))
+        wide = pd.DataFrame(stats, columns=CTC_COLUMNS + CTS_COLUMNS)
+        wide.insert(0, "region", region)
+        wide.insert(0, "date", pd.DatetimeIndex(dates))
+        tables.append(wide)
+    if not tables:
+        return pd.DataFrame(columns=["date", "region", "stat", "value"])
+    wide = pd.concat(tables, ignore_index=True)
+    return wide.melt(id_vars=["date", "region"], var_name="stat", value_name="value")
+
+
+def write_table(df, output):
+    """Writes a result table as Parquet or CSV depending on the extension."""
+    if output.endswith(".parquet"):
+        df.to_parquet(output, index=False)
+    else:
+        df.to_csv(output, index=False)
+    print(f"Wrote {len(df)} rows to {output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fcst", help="Forecast source, NAME or NAME=TEMPLATE")
+    parser.add_argument("obs", help="Observation source, NAME or NAME=TEMPLATE")
+    parser.add_argument("date_ini", help="First date, YYYY-MM-DD")
+    parser.add_argument("date_end", help="Last date, YYYY-MM-DD")
+    parser.add_argument("--mask", action="append", default=[],
+                        help="Extra region as NAME=gen_vx_mask_file.nc (repeatable)")
+    parser.add_argument("--thresh", type=float, default=1.0,
+                        help="Event threshold (value >= thresh)")
+    parser.add_argument("--backend", choices=["numpy", "packed"], default="numpy",
+                        help="Contingency counting backend")
+    parser.add_argument("--chunk-days", type=int, default=31,
+                        help="Number of days loaded at once")
+    parser.add_argument("--output", default="cts.csv", help="Output .csv or .parquet")
+    args = parser.parse_args()
+
+    _, fcst_template = parse_source(args.fcst)
+    _, obs_template = parse_source(args.obs)
+    regions = load_regions(args.mask)
+    dates = daily_dates(args.date_ini, args.date_end)
+
+    results = []
+    for start in range(0, len(dates), args.chunk_days):
+        chunk = dates[start:start + args.chunk_days]
+        fc_dates, fc_cube = load_bin_snow_cube(fcst_template, chunk)
+        ob_dates, ob_cube = load_bin_snow_cube(obs_template, chunk)
+        common = fc_dates.intersection(ob_dates)
+        if len(common) == 0:
+            continue
+        print(f"Verifying {common[0]:%Y-%m-%d} to {common[-1]:%Y-%m-%d} ({len(common)} days)")
+        fc_cube = fc_cube[fc_dates.get_indexer(common)]
+        ob_cube = ob_cube[ob_dates.get_indexer(common)]
+        results.append(verify_categorical(fc_cube, ob_cube, common, regions, args.thresh,
+                                          args.backend))
+
+    if not results:
+        print("No days with both forecast and observation files")
+        return
+    write_table(pd.concat(results, ignore_index=True), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Per-pixel contingency counts accumulated over months, seasons and years.
+
+The domain and polygon scores do not show where a model misses snow
+systematically. Here the hits (FY_OY), false alarms (FY_ON), misses
+(FN_OY) and correct negatives (FN_ON) of every grid point are summed
+over each month, season (DJF, with December counted in the next year's
+winter, MAM, JJA, SON) and year with flox, reading the daily files in
+chunks of days.
+
+The counts are kept in one Zarr store per frequency (period, y, x). The
+store records the days already accumulated, so re-running the script
+over a longer date range only reads the new days and adds them to the
+existing periods (or appends new ones). Counts of consecutive periods
+can be summed to get any longer period.
+
+Local scores (POD, FAR, FBIAS, BASER) are computed from a store without
+loading it in memory and written with --maps.
+
+Usage:
+    python contingency_maps.py CERISE IMS 2015-09-01 2019-08-31 --store ctc_maps_cerise \
+        --maps pod_far_cerise_season.nc --maps-freq season
+"""
+
+import argparse
+import os
+
+import flox
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+
+from categorical_stats import event_fields
+from snow_io import daily_dates, load_bin_snow_cube, parse_source
+
+FREQUENCIES = ("month", "season", "year")
+COUNT_VARS = ["FY_OY", "FY_ON", "FN_OY", "FN_ON"]
+SEASONS = np.array(["DJF", "DJF", "MAM", "MAM", "MAM", "JJA",
+                    "JJA", "JJA", "SON", "SON", "SON", "DJF"])
+
+
+def period_labels(dates, by):
+    """
+    Period of every date, e.g. 2016-01 (month), 2016-DJF (season), 2016 (year).
+    December belongs to the DJF season of the following year.
+    """
+    # same rules as period_labels in post-processing/fss_store.py (which
+    # also has winter), keep the two in step
+    dates = pd.DatetimeIndex(dates)
+    if by == "month":
+        return np.asarray(dates.strftime("%Y-%m"))
+    if by == "year":
+        return np.asarray(dates.strftime("%Y"))
+    if by == "season":
+        winter_year = dates.year + (dates.month == 12)
+        return np.array([f"{y}-{s}" for y, s in zip(winter_year, SEASONS[dates.month - 1])])
+    raise ValueError(f"Unknown grouping {by}, use one of {FREQUENCIES}")
+
+
+def pixel_counts(fcst, obs, labels, thresh=1.0):
+    """
+    Per-pixel contingency counts of a chunk of days, summed by period.
+
+    Args:
+        fcst (np.ndarray): Forecast cube (time, y, x), NaN where undefined.
+        obs (np.ndarray): Observation cube, same shape.
+        labels (np.ndarray): Period label of every day.
+        thresh (float): Event threshold.
+
+    Returns:
+        tuple: (periods, uint32 counts (cell, period, y, x)) with the cells
+        in the COUNT_VARS order.
+    """
+    fcst_event, obs_event, valid = event_fields(fcst, obs, thresh)
+    cells = np.stack([fcst_event & obs_event, fcst_event & ~obs_event,
+                      ~fcst_event & obs_event, ~fcst_event & ~obs_event]) & valid
+    # flox groups along the trailing axis
+    counts, periods = flox.groupby_reduce(np.moveaxis(cells, 1, -1), labels, func="sum",
+                                          dtype=np.uint32)
+    return periods, np.moveaxis(counts, -1, 1)
+
+
+def stored_dates(path):
+    """Days already accumulated in a store."""
+    if not os.path.isdir(path):
+        return set()
+    return set(zarr.open_group(path, mode="r").attrs.get("dates", []))
+
+
+def update_store(path, periods, counts, dates):
+    """
+    Adds the counts of new days to a store.
+
+    Periods already in the store are updated in place (region writes),
+    new periods are appended along the period dimension.
+    """
+    # to_zarr rewrites the group attributes, read the recorded days first
+    done = stored_dates(path) | {d.strftime("%Y-%m-%d") for d in dates}
+    ny, nx = counts.shape[-2:]
+    ds = xr.Dataset({var: (("period", "y", "x"), counts[i]) for i, var in enumerate(COUNT_VARS)},
+                    coords={"period": np.asarray(periods, dtype=str)})
+    if not os.path.isdir(path):
+        encoding = {var: {"chunks": (1, ny, nx)} for var in COUNT_VARS}
+        ds.to_zarr(path, mode="w", encoding=encoding)
+    else:
+        with xr.open_zarr(path) as store:
+            existing = list(store["period"].values)
+        for period in ds["period"].values:
+            if period not in existing:
+                continue
+            i = existing.index(period)
+            with xr.open_zarr(path) as store:
+                old = store[COUNT_VARS].isel(period=slice(i, i + 1)).load()
+            updated = old + ds[COUNT_VARS].sel(period=[period])
+            updated.drop_vars("period").to_zarr(path, region={"period": slice(i, i + 1)})
+        new = [p for p in ds["period"].values if p not in existing]
+        if new:
+            ds.sel(period=new).to_zarr(path, append_dim="period")
+    zarr.open_group(path, mode="a").attrs["dates"] = sorted(done)
+    zarr.consolidate_metadata(path)
+
+
+def score_maps(counts):
+    """
+    Local scores from a count store (lazy, computed on writing).
+
+    Returns:
+        xr.Dataset: TOTAL, BASER, PODY, FAR, FBIAS per period and grid point.
+    """
+    hits, false_alarms = counts["FY_OY"].astype(float), counts["FY_ON"].astype(float)
+    misses, negatives = counts["FN_OY"].astype(float), counts["FN_ON"].astype(float)
+    total = hits + false_alarms + misses + negatives
+    observed = hits + misses
+    forecast = hits + false_alarms
+    return xr.Dataset({
+        "TOTAL": total,
+        "BASER": (observed / total).where(total > 0),
+        "PODY": (hits / observed).where(observed > 0),
+        "FAR": (false_alarms / forecast).where(forecast > 0),
+        "FBIAS": (forecast / observed).where(observed > 0),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fcst", help="Forecast source, NAME or NAME=TEMPLATE")
+    parser.add_argument("obs", help="Observation source, NAME or NAME=TEMPLATE")
+    parser.add_argument("date_ini", help="First date, YYYY-MM-DD")
+    parser.add_argument("date_end", help="Last date, YYYY-MM-DD")
+    parser.add_argument("--store", required=True,
+                        help="Directory of the count stores (<freq>.zarr)")
+    parser.add_argument("--freq", nargs="+", choices=FREQUENCIES, default=list(FREQUENCIES))
+    parser.add_argument("--thresh", type=float, default=1.0,
+                        help="Event threshold (value >= thresh)")
+    parser.add_argument("--chunk-days", type=int, default=31,
+                        help="Number of days loaded at once")
+    parser.add_argument("--maps", help="Write local score maps to this NetCDF file")
+    parser.add_argument("--maps-freq", choices=FREQUENCIES, default="season")
+    args = parser.parse_args()
+
+    _, fcst_template = parse_source(args.fcst)
+    _, obs_template = parse_source(args.obs)
+    os.makedirs(args.store, exist_ok=True)
+    paths = {freq: os.path.join(args.store, f"{freq}.zarr") for freq in args.freq}
+    done = {freq: stored_dates(path) for freq, path in paths.items()}
+
+    dates = daily_dates(args.date_ini, args.date_end)
+    todo = [d for d in dates if any(d.strftime("%Y-%m-%d") not in done[f] for f in args.freq)]
+    dates = pd.DatetimeIndex(todo)
+    for start in range(0, len(dates), args.chunk_days):
+        chunk = dates[start:start + args.chunk_days]
+        fc_dates, fc_cube = load_bin_snow_cube(fcst_template, chunk)
+        ob_dates, ob_cube = load_bin_snow_cube(obs_template, chunk)
+        common = fc_dates.intersection(ob_dates)
+        if len(common) == 0:
+            continue
+        print(f"Accumulating {common[0]:%Y-%m-%d} to {common[-1]:%Y-%m-%d} ({len(common)} days)")
+        fc_cube = fc_cube[fc_dates.get_indexer(common)]
+        ob_cube = ob_cube[ob_dates.get_indexer(common)]
+        for freq, path in paths.items():
+            new = np.array([d.strftime("%Y-%m-%d") not in done[freq] for d in common])
+            if not new.any():
+                continue
+            periods, counts = pixel_counts(fc_cube[new], ob_cube[new],
+                                           period_labels(common[new], freq), args.thresh)
+            update_store(path, periods, counts, common[new])
+
+    if args.maps:
+        path = os.path.join(args.store, f"{args.maps_freq}.zarr")
+        with xr.open_zarr(path) as counts:
+            score_maps(counts).to_netcdf(args.maps)
+        print(f"Wrote {args.maps_freq} score maps to {args.maps}")
+
+
+if __name__ == "__main__":
+    main()
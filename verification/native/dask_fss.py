@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Out-of-core FSS straight from the Zarr stores, with dask.
+
+The other native scripts read the daily bin_snow NetCDF files written by
+pre-processing/zarr-data/dump_*.py. Here the bin_snow cubes are built
+lazily from the Zarr stores themselves, with the same definitions as the
+dump scripts:
+- IMS: IMS_Surface_Values == 4 (ims.zarr)
+- CERISE: ensemble mean of hxa > 0.01 (ana_v2.zarr)
+- CARRA1: sd / rsn > 0.01, undefined where rsn == 0 (carrasnow_v2.zarr)
+One field per day is kept (the last time step of the day, as the dump
+scripts overwrite the daily file).
+
+The neighbourhood fractions are computed chunk by chunk with map_overlap,
+the halo being the largest neighbourhood radius, and every chunk is
+reduced at once to its FSS partial sums, so the fraction fields never
+exist in full. The result is a small table of the NBRCNT statistics per
+day, region and width, including FSS_NUM and FSS_DEN (see
+post-processing/fss_store.py), in the format of multi_model_verify.py.
+
+Runs on a LocalCluster, or on SLURM through dask-jobqueue.
+
+Usage:
+    python dask_fss.py 2015-09-01 2019-08-31 --fcst CERISE --obs IMS \
+        --mask NORTH_SWEDEN=../met/north_sweden_mask.nc --cluster slurm --jobs 8 \
+        --output vx_dask.parquet
+"""
+
+import argparse
+from functools import lru_cache
+
+import dask
+import dask.array as da
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from categorical_stats import write_table
+from neighbourhood import SHAPES, check_widths, fraction_fields, fss_partial_sums, nbrcnt_scores
+from snow_io import load_regions
+
+ZARR_STORES = {
+    "IMS": "/scratch/fab0/Projects/cerise/carra_snow_data/ims.zarr",
+    "CERISE": "/ec/scratch/fab0/Projects/cerise/carra_snow_data/ana_v2.zarr",
+    "CARRA1": "/ec/scratch/fab0/Projects/cerise/carra_snow_data/carrasnow_v2.zarr",
+}
+SUM_KEYS = ["n", "fss_num", "fss_den", "sum_f", "sum_o"]
+
+
+def _ims(ds):
+    return xr.where(ds["IMS_Surface_Values"] == 4, 1.0, 0.0)
+
+
+def _cerise(ds):
+    return xr.where(ds["hxa"].mean("member") > 0.01, 1.0, 0.0)
+
+
+def _carra1(ds):
+    rsn = ds["rsn"]
+    return xr.where(rsn != 0, (ds["sd"] / rsn.where(rsn != 0) > 0.01).astype(float), np.nan)
+
+
+BIN_SNOW = {"IMS": _ims, "CERISE": _cerise, "CARRA1": _carra1}
+
+
+def parse_store(spec):
+    """NAME or NAME=PATH of a Zarr store, NAME being one of BIN_SNOW."""
+    name, _, path = spec.partition("=")
+    if name not in BIN_SNOW:
+        raise KeyError(f"No bin_snow definition for {name}, use one of {list(BIN_SNOW)}")
+    return name, path or ZARR_STORES[name]
+
+
+def open_bin_snow(name, path, date_ini, date_end, chunk_days=8, chunk_xy=-1):
+    """
+    Lazy daily bin_snow cube of a Zarr store.
+
+    Returns:
+        xr.DataArray: float32 (time, y, x), NaN where undefined, one field
+        per day with time at 00 UTC.
+    """
+    ds = xr.open_zarr(path).sel(time=slice(date_ini, date_end))
+    field = BIN_SNOW[name](ds).transpose("time", ...)
+    days = pd.to_datetime(field["time"].values).normalize()
+    last = ~pd.Index(days).duplicated(keep="last")
+    field = field.isel(time=np.flatnonzero(last))
+    data = field.data.astype(np.float32).rechunk((chunk_days, chunk_xy, chunk_xy))
+    return xr.DataArray(data, dims=("time", "y", "x"), coords={"time": days[last]}, name=name)
+
+
+@lru_cache(maxsize=4)
+def _regions(mask_specs):
+    # loaded once per worker process instead of being shipped with every task
+    return load_regions(list(mask_specs))
+
+
+def _block_sums(fcst, obs, starts, halo, widths, mask_specs, thresh, vld_thresh, nbrhd_shape,
+                block_info=None):
+    """FSS partial sums of one chunk (with its halo): (time, 1, 1, region, width, sum)."""
+    _, iy, ix = block_info[0]["chunk-location"]
+    y0, y1 = starts[0][iy], starts[0][iy + 1]
+    x0, x1 = starts[1][ix], starts[1][ix + 1]
+    fcst_valid, obs_valid = ~np.isnan(fcst), ~np.isnan(obs)
+    with np.errstate(invalid="ignore"):
+        fcst_frac = fraction_fields(fcst >= thresh, fcst_valid, widths, vld_thresh, nbrhd_shape)
+        obs_frac = fraction_fields(obs >= thresh, obs_valid, widths, vld_thresh, nbrhd_shape)
+    core = (Ellipsis, slice(halo, halo + y1 - y0), slice(halo, halo + x1 - x0))
+    regions = _regions(mask_specs)
+    out = np.zeros((fcst.shape[0], 1, 1, len(regions), len(widths), len(SUM_KEYS)))
+    for r, mask in enumerate(regions.values()):
+        block_mask = None if mask is None else mask[y0:y1, x0:x1]
+        for w, width in enumerate(widths):
+            sums = fss_partial_sums(fcst_frac[width][core], obs_frac[width][core], block_mask)
+            out[:, 0, 0, r, w] = np.stack([sums[key] for key in SUM_KEYS], axis=-1)
+    return out
+
+
+def partial_sums(fcst, obs, widths, mask_specs=(), thresh=1.0, vld_thresh=1.0,
+                 nbrhd_shape="SQUARE"):
+    """
+    Lazy FSS partial sums of two aligned (time, y, x) dask arrays.
+
+    Returns:
+        dask.array.Array: (time, region, width, sum) with the sums in the
+        SUM_KEYS order and the regions in the order of load_regions.
+    """
+    widths = check_widths(widths)
+    halo = (max(widths) - 1) // 2
+    if any(c < halo for chunks in fcst.chunks[1:] for c in chunks):
+        raise ValueError(f"Spatial chunks must be at least the halo ({halo} points)")
+    obs = obs.rechunk(fcst.chunks)
+    starts = tuple(np.cumsum((0,) + chunks) for chunks in fcst.chunks[1:])
+    n_regions = len(_regions(tuple(mask_specs)))
+    blocks = da.map_overlap(
+        _block_sums, fcst, obs, depth={0: 0, 1: halo, 2: halo}, boundary=np.nan, trim=False,
+        starts=starts, halo=halo, widths=tuple(widths), mask_specs=tuple(mask_specs),
+        thresh=thresh, vld_thresh=vld_thresh, nbrhd_shape=nbrhd_shape,
+        new_axis=[3, 4, 5], dtype=np.float64,
+        chunks=(fcst.chunks[0], (1,) * len(fcst.chunks[1]), (1,) * len(fcst.chunks[2]),
+                (n_regions,), (len(widths),), (len(SUM_KEYS),)),
+    )
+    return blocks.sum(axis=(1, 2))
+
+
+def sums_table(sums, times, model, obs_name, region_names, widths):
+    """Tidy table (date, model, obs, region, width, stat, value) of computed partial sums."""
+    rows = []
+    for r, region in enumerate(region_names):
+        for w, width in enumerate(widths):
+            part = dict(zip(SUM_KEYS, np.moveaxis(sums[:, r, w], -1, 0)))
+            stats = nbrcnt_scores(part)
+            stats.update(FSS_NUM=part["fss_num"], FSS_DEN=part["fss_den"],
+                         SUM_F=part["sum_f"], SUM_O=part["sum_o"])
+            for stat, values in stats.items():
+                rows.append(pd.DataFrame({"date": times, "model": model, "obs": obs_name,
+                                          "region": region, "width": width, "stat": stat,
+                                          "value": np.asarray(values, dtype=float)}))
+    return pd.concat(rows, ignore_index=True)
+
+
+def start_cluster(args):
+    """Dask client on a LocalCluster or on SLURM jobs (dask-jobqueue)."""
+    from dask.distributed import Client, LocalCluster
+
+    if args.cluster == "local":
+        cluster = LocalCluster(n_workers=args.workers, threads_per_worker=args.threads)
+    else:
+        from dask_jobqueue import SLURMCluster
+
+        cluster = SLURMCluster(cores=args.threads, processes=1, memory=args.memory,
+                               walltime=args.walltime, queue=args.queue, account=args.account)
+        cluster.scale(jobs=args.jobs)
+    return Client(cluster)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("date_ini", help="First date, YYYY-MM-DD")
+    parser.add_argument("date_end", help="Last date, YYYY-MM-DD")
+    parser.add_argument("--fcst", nargs="+", default=["CERISE"],
+                        help="Forecast stores, NAME or NAME=PATH")
+    parser.add_argument("--obs", default="IMS", help="Observation store, NAME or NAME=PATH")
+    parser.add_argument("--widths", type=int, nargs="+", default=[1, 3, 5, 7])
+    parser.add_argument("--vld-thresh", type=float, default=1.0)
+    parser.add_argument("--shape", choices=SHAPES, default="SQUARE")
+    parser.add_argument("--thresh", type=float, default=1.0)
+    parser.add_argument("--mask", action="append", default=[],
+                        help="Extra region as NAME=gen_vx_mask_file.nc (repeatable)")
+    parser.add_argument("--chunk-days", type=int, default=8)
+    parser.add_argument("--chunk-xy", type=int, default=-1,
+                        help="Spatial chunk size (-1: whole grid)")
+    parser.add_argument("--cluster", choices=("local", "slurm"), default="local")
+    parser.add_argument("--workers", type=int, default=4, help="LocalCluster workers")
+    parser.add_argument("--threads", type=int, default=2, help="Threads per worker (or job)")
+    parser.add_argument("--jobs", type=int, default=4, help="SLURM jobs")
+    parser.add_argument("--memory", default="32GB", help="Memory per SLURM job")
+    parser.add_argument("--walltime", default="02:00:00")
+    parser.add_argument("--queue")
+    parser.add_argument("--account")
+    parser.add_argument("--output", default="vx_dask.parquet", help="Output .csv or .parquet")
+    args = parser.parse_args()
+
+    widths = check_widths(args.widths)
+    region_names = list(load_regions(args.mask))
+    obs_name, obs_path = parse_store(args.obs)
+    obs = open_bin_snow(obs_name, obs_path, args.date_ini, args.date_end, args.chunk_days,
+                        args.chunk_xy)
+
+    client = start_cluster(args)
+    print(f"Dask dashboard: {client.dashboard_link}")
+    tables = []
+    for spec in args.fcst:
+        model, path = parse_store(spec)
+        fcst = open_bin_snow(model, path, args.date_ini, args.date_end, args.chunk_days,
+                             args.chunk_xy)
+        fcst, obs_model = xr.align(fcst, obs, join="inner")
+        if fcst.shape[1:] != obs_model.shape[1:]:
+            raise ValueError(f"{model} grid {fcst.shape[1:]} differs from the "
+                             f"{obs_name} grid {obs_model.shape[1:]}")
+        print(f"{model} vs {obs_name}: {fcst.sizes['time']} days")
+        lazy = partial_sums(fcst.data, obs_model.data, widths, args.mask, args.thresh,
+                            args.vld_thresh, args.shape)
+        sums, = dask.compute(lazy)
+        tables.append(sums_table(sums, pd.DatetimeIndex(fcst["time"].values), model, obs_name,
+                                 region_names, widths))
+    client.close()
+
+    if not tables:
+        return
+    write_table(pd.concat(tables, ignore_index=True), args.output)
+
+
+if __name__ == "__main__":
+    main()
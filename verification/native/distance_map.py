@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Native distance-map (DMAP) verification of binary snow fields.
+
+Computes the scores of the MET DMAP line type (Baddeley Delta, Hausdorff,
+mean-error distance, Pratt's figure of merit, Zhu's measure and G/G_beta)
+from Euclidean distance transforms of the snow event sets, with the
+parameters of the distance_map block in the GridStatConfig files.
+
+For every day the observation is read and its distance transform computed
+once, then reused for all forecast models. Days are processed in parallel
+in a process pool.
+
+Usage:
+    python distance_map.py 2015-09-01 2019-08-31 --obs IMS \
+        --fcst CERISE CARRA1 ERALAND --mask NORTH_SWEDEN=north_sweden_mask.nc \
+        --workers 16 --output dmap.parquet
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.ndimage import distance_transform_edt
+
+from categorical_stats import event_fields, write_table
+from snow_io import daily_dates, load_regions, parse_source, read_bin_snow
+
+# Same values as the distance_map block in GridStatConfig_ims_vs_cerise
+DMAP_PARAMS = {
+    "baddeley_p": 2,
+    "baddeley_max_dist": None,  # NA
+    "fom_alpha": 0.1,
+    "zhu_weight": 0.5,
+}
+
+_REGIONS = None
+
+
+def distance_to_events(event):
+    """
+    Distance (in grid points) from every point to the nearest event.
+
+    Args:
+        event (np.ndarray): 2D boolean event field.
+
+    Returns:
+        np.ndarray: float64 distances, zero on events and inf everywhere
+        if there is no event.
+    """
+    if not event.any():
+        return np.full(event.shape, np.inf)
+    return distance_transform_edt(~event)
+
+
+def beta_value(n):
+    """beta_value(n) = n * n / 2.0 as in the GridStatConfig files."""
+    return n * n / 2.0
+
+
+def dmap_scores(fcst_event, obs_event, dist_fcst, dist_obs, valid, params=DMAP_PARAMS):
+    """
+    Distance-map scores following the definitions in the MET User's Guide.
+    Scores that are undefined (e.g. no events in one field) are NaN.
+
+    Args:
+        fcst_event (np.ndarray): 2D boolean forecast events.
+        obs_event (np.ndarray): 2D boolean observed events.
+        dist_fcst (np.ndarray): Distance to the nearest forecast event.
+        dist_obs (np.ndarray): Distance to the nearest observed event.
+        valid (np.ndarray): 2D boolean points included in the statistics.
+        params (dict): baddeley_p, baddeley_max_dist, fom_alpha, zhu_weight.
+
+    Returns:
+        dict: TOTAL, FY, OY and the DMAP scores.
+    """
+    f = fcst_event & valid
+    o = obs_event & valid
+    n = int(valid.sum())
+    n_f = int(f.sum())
+    n_o = int(o.sum())
+    out = {"TOTAL": n, "FY": n_f, "OY": n_o}
+    nan_scores = ["BADDELEY", "HAUSDORFF", "MED_FO", "MED_OF", "MED_MIN", "MED_MAX",
+                  "MED_MEAN", "FOM_FO", "FOM_OF", "FOM_MIN", "FOM_MAX", "FOM_MEAN",
+                  "ZHU_FO", "ZHU_OF", "ZHU_MIN", "ZHU_MAX", "ZHU_MEAN", "G", "GBETA"]
+    out.update(dict.fromkeys(nan_scores, np.nan))
+    out["BETA_VALUE"] = beta_value(n)
+    if n == 0:
+        return out
+
+    d_f = dist_fcst[valid]
+    d_o = dist_obs[valid]
+    if n_f > 0 and n_o > 0:
+        max_dist = params.get("baddeley_max_dist")
+        if max_dist is not None:
+            w_f = np.minimum(d_f, max_dist)
+            w_o = np.minimum(d_o, max_dist)
+        else:
+            w_f, w_o = d_f, d_o
+        p = params["baddeley_p"]
+        out["BADDELEY"] = np.mean(np.abs(w_f - w_o) ** p) ** (1.0 / p)
+        out["HAUSDORFF"] = np.max(np.abs(d_f - d_o))
+
+        # MED_FO: mean distance from the forecast events to the nearest observed event
+        med_fo = dist_obs[f].mean()
+        med_of = dist_fcst[o].mean()
+        out.update(MED_FO=med_fo, MED_OF=med_of, MED_MIN=min(med_fo, med_of),
+                   MED_MAX=max(med_fo, med_of), MED_MEAN=0.5 * (med_fo + med_of))
+
+        alpha = params["fom_alpha"]
+        n_max = max(n_f, n_o)
+        fom_fo = np.sum(1.0 / (1.0 + alpha * dist_obs[f] ** 2)) / n_max
+        fom_of = np.sum(1.0 / (1.0 + alpha * dist_fcst[o] ** 2)) / n_max
+        out.update(FOM_FO=fom_fo, FOM_OF=fom_of, FOM_MIN=min(fom_fo, fom_of),
+                   FOM_MAX=max(fom_fo, fom_of), FOM_MEAN=0.5 * (fom_fo + fom_of))
+
+        weight = params["zhu_weight"]
+        rmse = np.sqrt(np.count_nonzero(f != o) / n)
+        zhu_fo = weight * rmse + (1.0 - weight) * med_fo
+        zhu_of = weight * rmse + (1.0 - weight) * med_of
+        out.update(ZHU_FO=zhu_fo, ZHU_OF=zhu_of, ZHU_MIN=min(zhu_fo, zhu_of),
+                   ZHU_MAX=max(zhu_fo, zhu_of), ZHU_MEAN=0.5 * (zhu_fo + zhu_of))
+
+        # G and G_beta (Gilleland, 2017)
+        n_both = int(np.count_nonzero(f & o))
+        y1 = n_f + n_o - 2 * n_both
+        y2 = med_of * n_o + med_fo * n_f
+        y = y1 * y2
+        out["G"] = y ** (1.0 / 3.0)
+        out["GBETA"] = max(1.0 - y / beta_value(n), 0.0)
+    return out
+
+
+def _init_worker(mask_specs):
+    global _REGIONS
+    _REGIONS = load_regions(mask_specs)
+
+
+def verify_day(date, obs_template, fcst_templates, thresh=1.0, params=DMAP_PARAMS):
+    """
+    DMAP scores of all forecast models against the observation of one day.
+
+    The observed events and their distance transform (per region) are
+    computed once and reused for every model.
+
+    Args:
+        date (pd.Timestamp): Day to verify.
+        obs_template (str): File name template of the observations.
+        fcst_templates (dict): Model name -> file name template.
+        thresh (float): Event threshold.
+        params (dict): Distance map parameters.
+
+    Returns:
+        list: dicts with date, model, region and the scores.
+    """
+    stamp = date.strftime("%Y%m%d")
+    try:
+        obs = read_bin_snow(obs_template.format(date=stamp))
+    except FileNotFoundError:
+        return []
+    obs_valid = ~np.isnan(obs)
+    with np.errstate(invalid="ignore"):
+        obs_event = obs >= thresh
+
+    obs_dist = {}
+    rows = []
+    for model, template in fcst_templates.items():
+        try:
+            fcst = read_bin_snow(template.format(date=stamp))
+        except FileNotFoundError:
+            continue
+        fcst_event, _, valid = event_fields(fcst, obs, thresh)
+        fcst_valid = ~np.isnan(fcst)
+        for region, mask in _REGIONS.items():
+            # each transform uses the events of its own field in the region,
+            # so the observed one does not depend on the model
+            in_region = obs_valid if mask is None else obs_valid & mask
+            if region not in obs_dist:
+                obs_dist[region] = distance_to_events(obs_event & in_region)
+            fcst_in_region = fcst_valid if mask is None else fcst_valid & mask
+            fcst_dist = distance_to_events(fcst_event & fcst_in_region)
+            region_valid = valid if mask is None else valid & mask
+            scores = dmap_scores(fcst_event, obs_event, fcst_dist, obs_dist[region],
+                                 region_valid, params)
+            rows.append({"date": date, "model": model, "region": region, **scores})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("date_ini", help="First date, YYYY-MM-DD")
+    parser.add_argument("date_end", help="Last date, YYYY-MM-DD")
+    parser.add_argument("--obs", default="IMS", help="Observation source, NAME or NAME=TEMPLATE")
+    parser.add_argument("--fcst", nargs="+", default=["CERISE"],
+                        help="Forecast sources, NAME or NAME=TEMPLATE")
+    parser.add_argument("--mask", action="append", default=[],
+                        help="Extra region as NAME=gen_vx_mask_file.nc (repeatable)")
+    parser.add_argument("--thresh", type=float, default=1.0)
+    parser.add_argument("--baddeley-p", type=float, default=DMAP_PARAMS["baddeley_p"])
+    parser.add_argument("--baddeley-max-dist", type=float, default=None)
+    parser.add_argument("--fom-alpha", type=float, default=DMAP_PARAMS["fom_alpha"])
+    parser.add_argument("--zhu-weight", type=float, default=DMAP_PARAMS["zhu_weight"])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--output", default="dmap.csv", help="Output .csv or .parquet")
+    args = parser.parse_args()
+
+    _, obs_template = parse_source(args.obs)
+    fcst_templates = dict(parse_source(spec) for spec in args.fcst)
+    params = {
+        "baddeley_p": args.baddeley_p,
+        "baddeley_max_dist": args.baddeley_max_dist,
+        "fom_alpha": args.fom_alpha,
+        "zhu_weight": args.zhu_weight,
+    }
+    dates = daily_dates(args.date_ini, args.date_end)
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                             initargs=(args.mask,)) as pool:
+        futures = [pool.submit(verify_day, date, obs_template, fcst_templates,
+                               args.thresh, params) for date in dates]
+        for date, future in zip(dates, futures):
+            day_rows = future.result()
+            if day_rows:
+                print(f"{date:%Y-%m-%d}: {len(day_rows)} model/region scores")
+            rows.extend(day_rows)
+
+    if not rows:
+        print("No days with both forecast and observation files")
+        return
+    wide = pd.DataFrame(rows)
+    tidy = wide.melt(id_vars=["date", "model", "region"], var_name="stat", value_name="value")
+    write_table(tidy, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Ensemble neighbourhood verification of the CERISE analysis members.
+
+pre-processing/zarr-data/dump_cerise.py averages ana_v2.zarr over the
+member dimension before thresholding, so only the ensemble mean is
+verified. Here the members are thresholded individually (hxa > 0.01, as
+in dump_cerise.py) and, for every time step, region and width:
+- per-member fractions are computed in one vectorized pass over the
+  (time, member) axes, each member sharing one integral image for all
+  widths (see neighbourhood.py)
+- eFSS: FSS of the ensemble-mean fractions against the observation
+- MFSS: mean FSS of the individual members against the observation
+- dFSS: dispersion FSS, the mean FSS over all member pairs (i < j); the
+  pair sums come from the Gram matrix of the member fractions,
+  sum (Pi - Pj)^2 = sum Pi^2 + sum Pj^2 - 2 sum Pi Pj
+
+The store is read in chunks of time steps, so only a few time steps of
+all members are in memory. The partial sums (EFSS_NUM, EFSS_DEN,
+DFSS_NUM, DFSS_DEN, summed over the pairs) are written along with the
+scores so that they can be aggregated over any period.
+
+Usage:
+    python ensemble_fss.py 2015-09-01 2019-08-31 --obs IMS \
+        --mask NORTH_SWEDEN=north_sweden_mask.nc --chunk-times 4 --output efss.parquet
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from categorical_stats import write_table
+from neighbourhood import SHAPES, check_widths, fraction_fields
+from snow_io import load_regions, parse_source, read_bin_snow
+
+CERISE_ZARR = "/ec/scratch/fab0/Projects/cerise/carra_snow_data/ana_v2.zarr"
+# snow threshold on the snow cover fraction, as in dump_cerise.py
+HXA_THRESH = 0.01
+WIDTHS = [1, 3, 5, 7]
+
+
+def _fss(num, den):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(den > 0, 1.0 - num / den, np.nan)
+
+
+def ensemble_sums(member_frac, obs_frac, ok):
+    """
+    Ensemble FSS partial sums of a chunk of time steps.
+
+    Args:
+        member_frac (np.ndarray): Member fractions (time, member, y, x).
+        obs_frac (np.ndarray): Observed fractions (time, y, x).
+        ok (np.ndarray): Boolean (time, y, x), points where all members and
+            the observation are valid and inside the region.
+
+    Returns:
+        dict: arrays of shape (time,): n, efss_num, efss_den, dfss_num,
+        dfss_den (summed over member pairs), dfss (mean pair FSS) and
+        mfss (mean member FSS).
+    """
+    n_time, n_member = member_frac.shape[:2]
+    pm = np.where(ok[:, None], member_frac, 0.0).reshape(n_time, n_member, -1)
+    po = np.where(ok, obs_frac, 0.0).reshape(n_time, -1)
+    sum_po2 = (po ** 2).sum(axis=-1)
+
+    mean = pm.mean(axis=1)
+    efss_num = ((mean - po) ** 2).sum(axis=-1)
+    efss_den = (mean ** 2).sum(axis=-1) + sum_po2
+
+    # Gram matrix (time, member, member) of the member fractions
+    gram = pm @ pm.transpose(0, 2, 1)
+    sum_pm2 = np.diagonal(gram, axis1=1, axis2=2)
+    member_num = sum_pm2 - 2.0 * np.einsum("tmn,tn->tm", pm, po) + sum_po2[:, None]
+    mfss = np.nanmean(_fss(member_num, sum_pm2 + sum_po2[:, None]), axis=1)
+
+    iu, ju = np.triu_indices(n_member, k=1)
+    pair_den = sum_pm2[:, iu] + sum_pm2[:, ju]
+    pair_num = np.maximum(pair_den - 2.0 * gram[:, iu, ju], 0.0)
+    dfss = np.nanmean(_fss(pair_num, pair_den), axis=1) if len(iu) else np.full(n_time, np.nan)
+
+    return {
+        "n": np.count_nonzero(ok.reshape(n_time, -1), axis=-1),
+        "efss_num": efss_num,
+        "efss_den": efss_den,
+        "dfss_num": pair_num.sum(axis=1),
+        "dfss_den": pair_den.sum(axis=1),
+        "dfss": dfss,
+        "mfss": mfss,
+    }
+
+
+def verify_chunk(times, hxa, obs, regions, widths, vld_thresh=1.0, nbrhd_shape="SQUARE",
+                 hxa_thresh=HXA_THRESH):
+    """
+    Ensemble statistics of a chunk of time steps.
+
+    Args:
+        times (pd.DatetimeIndex): Time steps of the chunk.
+        hxa (np.ndarray): Member snow cover (time, member, y, x).
+        obs (np.ndarray): Observed bin_snow (time, y, x), NaN undefined.
+
+    Returns:
+        list: tidy rows (date, region, width, stat, value).
+    """
+    member_valid = ~np.isnan(hxa)
+    with np.errstate(invalid="ignore"):
+        member_event = hxa > hxa_thresh
+    obs_valid = ~np.isnan(obs)
+    with np.errstate(invalid="ignore"):
+        obs_event = obs >= 1.0
+    member_fracs = fraction_fields(member_event, member_valid, widths, vld_thresh, nbrhd_shape)
+    obs_fracs = fraction_fields(obs_event, obs_valid, widths, vld_thresh, nbrhd_shape)
+
+    rows = []
+    for width in widths:
+        valid = ~np.isnan(member_fracs[width]).any(axis=1) & ~np.isnan(obs_fracs[width])
+        for region, mask in regions.items():
+            ok = valid if mask is None else valid & mask
+            sums = ensemble_sums(member_fracs[width], obs_fracs[width], ok)
+            stats = {
+                "TOTAL": sums["n"],
+                "EFSS": _fss(sums["efss_num"], sums["efss_den"]),
+                "EFSS_NUM": sums["efss_num"],
+                "EFSS_DEN": sums["efss_den"],
+                "MFSS": sums["mfss"],
+                "DFSS": sums["dfss"],
+                "DFSS_NUM": sums["dfss_num"],
+                "DFSS_DEN": sums["dfss_den"],
+            }
+            for i, time in enumerate(times):
+                rows += [{"date": time, "region": region, "width": width,
+                          "stat": stat, "value": float(values[i])}
+                         for stat, values in stats.items()]
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("date_ini", help="First date, YYYY-MM-DD")
+    parser.add_argument("date_end", help="Last date, YYYY-MM-DD")
+    parser.add_argument("--zarr", default=CERISE_ZARR, help="CERISE analysis store")
+    parser.add_argument("--var", default="hxa")
+    parser.add_argument("--hxa-thresh", type=float, default=HXA_THRESH)
+    parser.add_argument("--obs", default="IMS", help="Observation source, NAME or NAME=TEMPLATE")
+    parser.add_argument("--widths", type=int, nargs="+", default=WIDTHS)
+    parser.add_argument("--vld-thresh", type=float, default=1.0)
+    parser.add_argument("--shape", choices=SHAPES, default="SQUARE")
+    parser.add_argument("--mask", action="append", default=[],
+                        help="Extra region as NAME=gen_vx_mask_file.nc (repeatable)")
+    parser.add_argument("--chunk-times", type=int, default=4,
+                        help="Time steps (all members) held in memory at once")
+    parser.add_argument("--output", default="efss.parquet", help="Output .csv or .parquet")
+    args = parser.parse_args()
+
+    obs_name, obs_template = parse_source(args.obs)
+    widths = check_widths(args.widths)
+    regions = load_regions(args.mask)
+
+    analysis = xr.open_zarr(args.zarr)[args.var].sel(time=slice(args.date_ini, args.date_end))
+    analysis = analysis.transpose("time", "member", ...)
+    times = pd.to_datetime(analysis["time"].values)
+
+    rows = []
+    for start in range(0, len(times), args.chunk_times):
+        chunk_times, obs = [], []
+        for time in times[start:start + args.chunk_times]:
+            try:
+                obs.append(read_bin_snow(obs_template.format(date=time.strftime("%Y%m%d"))))
+            except FileNotFoundError:
+                continue
+            chunk_times.append(time)
+        if not chunk_times:
+            continue
+        hxa = analysis.sel(time=chunk_times).values.astype(np.float32)
+        obs = np.stack(obs)
+        if hxa.shape[-2:] != obs.shape[-2:]:
+            raise ValueError(f"{obs_name} grid {obs.shape[-2:]} differs from the "
+                             f"ensemble grid {hxa.shape[-2:]}")
+        rows += verify_chunk(pd.DatetimeIndex(chunk_times), hxa, obs, regions, widths,
+                             args.vld_thresh, args.shape, args.hxa_thresh)
+        print(f"{chunk_times[0]:%Y-%m-%d %H} - {chunk_times[-1]:%Y-%m-%d %H}: "
+              f"{hxa.shape[1]} members verified against {obs_name}")
+
+    if not rows:
+        print("No time steps with an observation file")
+        return
+    table = pd.DataFrame(rows)
+    table.insert(1, "obs", obs_name)
+    write_table(table, args.output)
+
+
+if __name__ == "__main__":
+    main()
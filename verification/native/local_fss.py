@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Localized FSS skill maps.
+
+The domain FSS hides regional differences in skill, which are otherwise
+looked for by drawing polygons (post-processing/select_a_polygon_MET_file.py).
+Here, for every grid point and neighbourhood width, the FSS is computed
+over the surrounding window x window box (e.g. 101 x 101 points):
+
+    FSS_local = 1 - sum (Pf - Po)^2 / (sum Pf^2 + sum Po^2)
+              = 1 - (Sff + Soo - 2 Sfo) / (Sff + Soo)
+
+The window sums Sff, Soo and Sfo of Pf^2, Po^2 and Pf*Po come from
+integral images (see neighbourhood.py), so every width costs O(pixels)
+whatever the window size. The sums are accumulated over the days of
+each period (day, month, season or year) before taking the ratio, so a
+seasonal map is the FSS of the season, not a mean of daily maps.
+
+Days are read and processed in chunks, all days of a chunk in one
+vectorized pass.
+
+Usage:
+    python local_fss.py CERISE IMS 2015-12-01 2016-02-29 --window 101 \
+        --widths 1 3 5 7 --period season --output local_fss_cerise.nc
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from categorical_stats import event_fields
+from contingency_maps import period_labels
+from neighbourhood import SHAPES, box_sum, check_widths, fraction_fields, integral_image
+from snow_io import daily_dates, load_bin_snow_cube, parse_source
+
+PERIODS = ("day", "month", "season", "year")
+SUMS = ["SFF", "SOO", "SFO", "N"]
+
+
+def local_sums(fcst_frac, obs_frac, window):
+    """
+    Window sums of Pf^2, Po^2, Pf*Po and of the valid points.
+
+    Args:
+        fcst_frac (np.ndarray): Forecast fractions (..., y, x), NaN if invalid.
+        obs_frac (np.ndarray): Observed fractions, same shape.
+        window (int): Odd size of the local window.
+
+    Returns:
+        dict: SFF, SOO, SFO, N arrays (..., y, x).
+    """
+    ok = ~np.isnan(fcst_frac) & ~np.isnan(obs_frac)
+    pf = np.where(ok, fcst_frac, 0.0)
+    po = np.where(ok, obs_frac, 0.0)
+    pad = (window - 1) // 2
+    shape = pf.shape[-2:]
+    return {name: box_sum(integral_image(values, pad), window, pad, shape)
+            for name, values in (("SFF", pf * pf), ("SOO", po * po), ("SFO", pf * po), ("N", ok))}
+
+
+def local_fss(sums):
+    """Local FSS from (accumulated) window sums, NaN where there is no reference."""
+    den = sums["SFF"] + sums["SOO"]
+    num = den - 2.0 * sums["SFO"]
+    out = np.full(den.shape, np.nan)
+    np.divide(num, den, out=out, where=den > 0)
+    return 1.0 - out
+
+
+def accumulate_chunk(fcst, obs, labels, widths, window, thresh=1.0, vld_thresh=1.0,
+                     nbrhd_shape="SQUARE"):
+    """
+    Window sums of a chunk of days, summed by period.
+
+    Returns:
+        dict: period -> {sum name: (width, y, x) array}
+    """
+    fcst_event, obs_event, _ = event_fields(fcst, obs, thresh)
+    fcst_frac = fraction_fields(fcst_event, ~np.isnan(fcst), widths, vld_thresh, nbrhd_shape)
+    obs_frac = fraction_fields(obs_event, ~np.isnan(obs), widths, vld_thresh, nbrhd_shape)
+    out = {}
+    for w, width in enumerate(widths):
+        sums = local_sums(fcst_frac[width], obs_frac[width], window)
+        for period in pd.unique(labels):
+            days = labels == period
+            acc = out.setdefault(period, {name: np.zeros((len(widths),) + fcst.shape[-2:])
+                                          for name in SUMS})
+            for name in SUMS:
+                acc[name][w] += sums[name][days].sum(axis=0)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fcst", help="Forecast source, NAME or NAME=TEMPLATE")
+    parser.add_argument("obs", help="Observation source, NAME or NAME=TEMPLATE")
+    parser.add_argument("date_ini", help="First date, YYYY-MM-DD")
+    parser.add_argument("date_end", help="Last date, YYYY-MM-DD")
+    parser.add_argument("--window", type=int, default=101, help="Odd size of the local window")
+    parser.add_argument("--widths", type=int, nargs="+", default=[1, 3, 5, 7])
+    parser.add_argument("--vld-thresh", type=float, default=1.0)
+    parser.add_argument("--shape", choices=SHAPES, default="SQUARE")
+    parser.add_argument("--thresh", type=float, default=1.0)
+    parser.add_argument("--period", choices=PERIODS, default="season")
+    parser.add_argument("--chunk-days", type=int, default=8,
+                        help="Number of days loaded at once")
+    parser.add_argument("--output", default="local_fss.nc")
+    args = parser.parse_args()
+
+    if args.window < 1 or args.window % 2 == 0:
+        parser.error("--window must be odd")
+    _, fcst_template = parse_source(args.fcst)
+    _, obs_template = parse_source(args.obs)
+    widths = check_widths(args.widths)
+    dates = daily_dates(args.date_ini, args.date_end)
+
+    totals = {}
+    for start in range(0, len(dates), args.chunk_days):
+        chunk = dates[start:start + args.chunk_days]
+        fc_dates, fc_cube = load_bin_snow_cube(fcst_template, chunk)
+        ob_dates, ob_cube = load_bin_snow_cube(obs_template, chunk)
+        common = fc_dates.intersection(ob_dates)
+        if len(common) == 0:
+            continue
+        print(f"Processing {common[0]:%Y-%m-%d} to {common[-1]:%Y-%m-%d} ({len(common)} days)")
+        if args.period == "day":
+            labels = np.asarray(common.strftime("%Y-%m-%d"))
+        else:
+            labels = period_labels(common, args.period)
+        chunk_sums = accumulate_chunk(fc_cube[fc_dates.get_indexer(common)],
+                                      ob_cube[ob_dates.get_indexer(common)],
+                                      labels, widths, args.window, args.thresh,
+                                      args.vld_thresh, args.shape)
+        for period, sums in chunk_sums.items():
+            if period not in totals:
+                totals[period] = sums
+            else:
+                for name in SUMS:
+                    totals[period][name] += sums[name]
+
+    if not totals:
+        print("No days with both forecast and observation files")
+        return
+    periods = sorted(totals)
+    ds = xr.Dataset(
+        {
+            "LOCAL_FSS": (("period", "width", "y", "x"),
+                          np.stack([local_fss(totals[p]) for p in periods]).astype(np.float32)),
+            "N": (("period", "width", "y", "x"),
+                  np.stack([totals[p]["N"] for p in periods]).astype(np.int32)),
+        },
+        coords={"period": periods, "width": widths},
+        attrs={"window": args.window, "shape": args.shape, "fcst": args.fcst, "obs": args.obs},
+    )
+    ds.to_netcdf(args.output, encoding={v: {"zlib": True, "complevel": 4} for v in ds.data_vars})
+    print(f"Wrote local FSS maps ({len(periods)} periods) to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+FSS, agreement scales and distance-map scores at new neighbourhood widths
+from the matched pairs files (*_pairs.nc) that grid_stat already wrote.
+
+With nc_pairs_flag on, grid_stat writes the FCST and OBS fields of every
+mask (FCST_<field>_<MASK>, e.g. FCST_bin_snow_all_all_FULL, missing
+outside the mask) next to its .stat files. Those fields are all the
+neighbourhood statistics need, so extending the scale range does not
+need grid_stat nor the pre-processing chain to be run again:
+- the fractions are computed on the FULL fields, as grid_stat does, and
+  the other masks of the file select the points of each region
+- nbrcnt: NBRCNT statistics and FSS partial sums per width, CTC/CTS at
+  width 1 (as multi_model_verify.py)
+- agreement: agreement scale of every point (Dey et al., 2016) among the
+  given widths, from the same fractions: the smallest width whose
+  D = (Pf - Po)^2 / (Pf^2 + Po^2) is below
+  alpha + (1 - alpha) S / S_lim, with S = (width - 1) / 2 and S_lim given
+  by --s-lim, independent of the widths, so that adding widths does not
+  change the scales found at the others (D = 1 where both fractions are
+  0). Output per region: AGREE_FRAC (share of the points agreeing at that
+  width or below) per width, and SA_MEAN and SA_MEDIAN (S, in grid
+  points) at width 2 S_lim + 1 if it is among the widths (every point
+  agrees there).
+- dmap: distance-map scores (distance_map.dmap_scores), width 1, with the
+  events of both fields where both are defined
+Files are processed in parallel in a process pool.
+
+The output is a tidy table (date, model, region, width, stat, value), as
+multi_model_verify.py, that post-processing/fss_store.py can ingest
+(--native).
+
+Usage:
+    python met_pairs_verify.py CERISE=/ec/res4/scratch/nhd/CERISE/MET_CERISE_vs_IMS_paper \
+        --widths 1 3 5 7 9 15 25 51 --metrics nbrcnt agreement dmap \
+        --date-ini 2015-09-01 --date-end 2019-08-31 --workers 16 --output pairs_vx.parquet
+"""
+
+import argparse
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from categorical_stats import categorical_scores, contingency_counts, event_fields, write_table
+from distance_map import DMAP_PARAMS, dmap_scores, distance_to_events
+from neighbourhood import (SHAPES, check_widths, fraction_fields, fss_partial_sums,
+                           nbrcnt_scores)
+
+METRICS = ("nbrcnt", "agreement", "dmap")
+_PAIRS = re.compile(r"_(\d{8})_(\d{6})V_pairs\.nc$")
+# MET bad data value, in case it is not declared as _FillValue
+BAD_DATA = -9999.0
+
+
+def pairs_files(met_dir, date_ini=None, date_end=None):
+    """
+    Valid time -> path of the *_pairs.nc files of a MET output directory.
+    """
+    found = {}
+    for name in sorted(os.listdir(met_dir)):
+        match = _PAIRS.search(name)
+        if match is None:
+            continue
+        valid = pd.Timestamp(f"{match.group(1)}T{match.group(2)}")
+        if date_ini is not None and valid < pd.Timestamp(date_ini):
+            continue
+        if date_end is not None and valid >= pd.Timestamp(date_end) + pd.Timedelta(days=1):
+            continue
+        found[valid] = os.path.join(met_dir, name)
+    return found
+
+
+def _values(ds, name):
+    field = ds[name].squeeze(drop=True).values.astype(np.float32)
+    field[field == BAD_DATA] = np.nan
+    return field
+
+
+def read_pairs(path, field=None):
+    """
+    FULL forecast and observation fields of a pairs file and its regions.
+
+    Args:
+        path (str): grid_stat *_pairs.nc file.
+        field (str): Middle part of the variable names, e.g.
+            bin_snow_all_all; found from FCST_<field>_FULL if None.
+
+    Returns:
+        tuple: (fcst, obs, regions), 2D float32 fields (NaN where missing)
+        and region name -> 2D boolean mask (None for FULL).
+    """
+    with xr.open_dataset(path) as ds:
+        names = list(ds.data_vars)
+        if field is None:
+            fields = [name[len("FCST_"):-len("_FULL")] for name in names
+                      if name.startswith("FCST_") and name.endswith("_FULL")]
+            if not fields:
+                raise KeyError(f"No FCST_<field>_FULL variable in {path}, give the field")
+            field = fields[0]
+        prefix = f"FCST_{field}_"
+        # mask names are upper case, the threshold and NBRHD variables are not
+        masks = [name[len(prefix):] for name in names if name.startswith(prefix)
+                 and re.fullmatch(r"[A-Z0-9_]+", name[len(prefix):])]
+        fcst, obs = _values(ds, f"{prefix}FULL"), _values(ds, f"OBS_{field}_FULL")
+        regions = {"FULL": None}
+        for mask in masks:
+            if mask != "FULL":
+                regions[mask] = (~np.isnan(_values(ds, prefix + mask))
+                                 | ~np.isnan(_values(ds, f"OBS_{field}_{mask}")))
+    return fcst, obs, regions
+
+
+def agreement_widths(fcst_frac, obs_frac, widths, s_lim=80, alpha=0.5):
+    """
+    Agreement scale S = (width - 1) / 2 of every point among the widths
+    (Dey et al., 2016), from the neighbourhood fractions of the forecast
+    and the observation.
+
+    With the event fields (0/1, NaN where undefined) and all the widths
+    1, 3, ..., 2 S_lim + 1 this is agreement_scale_map of
+    pre-processing/cryo/agreement_scales_fo.py, except near the domain
+    edges and missing points: the fractions are those of fraction_fields
+    (no mirroring, NaN below vld_thresh), not the mirrored window means
+    ignoring NaNs. With fewer widths a point gets the smallest listed
+    width meeting the criterion, at or above its scale in
+    agreement_scale_map.
+
+    Args:
+        widths (list): Odd widths, at most 2 s_lim + 1.
+        s_lim (int): S_lim of the criterion, in grid points.
+
+    Returns:
+        np.ndarray: float S, inf where no listed width agrees, NaN where
+        the fractions are undefined at every width.
+    """
+    scale = np.full(fcst_frac[widths[0]].shape, np.nan)
+    pending = np.ones(scale.shape, dtype=bool)
+    defined = np.zeros(scale.shape, dtype=bool)
+    for width in widths:
+        f, o = fcst_frac[width], obs_frac[width]
+        den = f ** 2 + o ** 2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            D = np.where(den > 0, (f - o) ** 2 / den, 1.0)
+        s = (width - 1) / 2
+        D_crit = alpha + (1 - alpha) * s / s_lim if s_lim > 0 else 1.0
+        # NaN fractions never agree, NaN compares False
+        both = ~np.isnan(f) & ~np.isnan(o)
+        agreed = pending & (D <= D_crit) & both
+        scale[agreed] = s
+        pending &= ~agreed
+        defined |= both
+    scale[pending & defined] = np.inf
+    return scale
+
+
+def agreement_rows(scale, valid, widths, s_lim=80):
+    """
+    AGREE_FRAC per width, SA_MEAN and SA_MEDIAN (at width 2 s_lim + 1, if
+    listed) of the points of a region.
+    """
+    values = scale[valid & ~np.isnan(scale)]
+    rows = {}
+    for width in widths:
+        share = np.mean(values <= (width - 1) / 2) if values.size else np.nan
+        rows[width] = {"AGREE_FRAC": share}
+    if 2 * s_lim + 1 in rows:
+        # points undefined at that width only may still be inf
+        values = values[np.isfinite(values)]
+        rows[2 * s_lim + 1].update(SA_MEAN=values.mean() if values.size else np.nan,
+                                   SA_MEDIAN=np.median(values) if values.size else np.nan)
+    return rows
+
+
+def verify_pairs(date, model, path, widths, metrics=METRICS, thresh=1.0, vld_thresh=1.0,
+                 nbrhd_shape="SQUARE", field=None, alpha=0.5, s_lim=80, params=DMAP_PARAMS,
+                 backend="numpy"):
+    """
+    Statistics of one pairs file.
+
+    Returns:
+        list: tidy rows (date, model, region, width, stat, value).
+    """
+    fcst, obs, regions = read_pairs(path, field)
+    fcst_event, obs_event, valid = event_fields(fcst, obs, thresh)
+    stats = []
+    if "nbrcnt" in metrics or "agreement" in metrics:
+        fcst_frac = fraction_fields(fcst_event, ~np.isnan(fcst), widths, vld_thresh,
+                                    nbrhd_shape, backend)
+        obs_frac = fraction_fields(obs_event, ~np.isnan(obs), widths, vld_thresh,
+                                   nbrhd_shape, backend)
+    if "agreement" in metrics:
+        scale = agreement_widths(fcst_frac, obs_frac, widths, s_lim, alpha)
+    for region, mask in regions.items():
+        region_valid = valid if mask is None else valid & mask
+        if "nbrcnt" in metrics:
+            ctc = contingency_counts(fcst_event, obs_event, region_valid)
+            ctc.update(categorical_scores(ctc))
+            stats.append((region, 1, ctc))
+            for width in widths:
+                sums = fss_partial_sums(fcst_frac[width], obs_frac[width], mask)
+                scores = nbrcnt_scores(sums)
+                scores.update(FSS_NUM=sums["fss_num"], FSS_DEN=sums["fss_den"],
+                              SUM_F=sums["sum_f"], SUM_O=sums["sum_o"])
+                stats.append((region, width, scores))
+        if "agreement" in metrics:
+            for width, scores in agreement_rows(scale, region_valid, widths, s_lim).items():
+                stats.append((region, width, scores))
+        if "dmap" in metrics:
+            # both transforms from the points where both fields are defined
+            obs_dist = distance_to_events(obs_event & region_valid)
+            fcst_dist = distance_to_events(fcst_event & region_valid)
+            stats.append((region, 1, dmap_scores(fcst_event, obs_event, fcst_dist, obs_dist,
+                                                 region_valid, params)))
+    return [{"date": date, "model": model, "region": region, "width": width,
+             "stat": stat, "value": float(value)}
+            for region, width, scores in stats for stat, value in scores.items()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="MODEL=MET output directory with *_pairs.nc")
+    parser.add_argument("--widths", type=int, nargs="+", required=True,
+                        help="Neighbourhood widths, any odd values")
+    parser.add_argument("--metrics", nargs="+", choices=METRICS, default=["nbrcnt"])
+    parser.add_argument("--date-ini", help="First date, YYYY-MM-DD")
+    parser.add_argument("--date-end", help="Last date, YYYY-MM-DD")
+    parser.add_argument("--field", help="Variable name part, e.g. bin_snow_all_all "
+                                        "(default: from FCST_<field>_FULL)")
+    parser.add_argument("--thresh", type=float, default=1.0)
+    parser.add_argument("--vld-thresh", type=float, default=1.0)
+    parser.add_argument("--shape", choices=SHAPES, default="SQUARE")
+    parser.add_argument("--alpha", type=float, default=0.5, help="Agreement scale alpha")
+    parser.add_argument("--s-lim", type=int, default=80,
+                        help="Agreement scale S_lim in grid points, widths up to 2 S_lim + 1")
+    parser.add_argument("--backend", choices=["numpy", "numba"], default="numpy",
+                        help="Fraction field kernels (numba: multi-threaded, SQUARE)")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--output", default="pairs_vx.parquet", help="Output .csv or .parquet")
+    args = parser.parse_args()
+
+    if args.backend == "numba" and args.shape != "SQUARE":
+        parser.error("--backend numba works with SQUARE neighbourhoods only")
+    widths = check_widths(args.widths)
+    if "agreement" in args.metrics and max(widths) > 2 * args.s_lim + 1:
+        parser.error(f"--widths above 2 S_lim + 1 = {2 * args.s_lim + 1} with --s-lim {args.s_lim}")
+    jobs = []
+    for spec in args.inputs:
+        model, met_dir = spec.split("=", 1)
+        for date, path in pairs_files(met_dir, args.date_ini, args.date_end).items():
+            jobs.append((date, model, path))
+    if not jobs:
+        print("No *_pairs.nc files found")
+        return
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(verify_pairs, date, model, path, widths, args.metrics,
+                               args.thresh, args.vld_thresh, args.shape, args.field,
+                               args.alpha, args.s_lim, DMAP_PARAMS, args.backend)
+                   for date, model, path in jobs]
+        for (date, model, _), future in zip(jobs, futures):
+            rows.extend(future.result())
+            print(f"{date:%Y-%m-%d %H:%M} {model}: done")
+    write_table(pd.DataFrame(rows), args.output)
+
+
+if __name__ == "__main__":
+    main()
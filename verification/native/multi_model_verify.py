@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Single-pass verification of several forecast models against one
+observation source.
+
+The run_grid_stat_ims_vs_*.sh scripts read the same IMS file and
+recompute the observed neighbourhood fractions once per model. Here each
+observation day is read, thresholded and turned into fraction fields
+once, and all models (CERISE, CARRA1, ERA-Land, CARRA-Land Pv2, ...) are
+evaluated against it. Days are processed in parallel.
+
+For every day, model and region the output contains the CTC/CTS
+statistics (width 1) and the NBRCNT statistics per neighbourhood width,
+including the FSS partial sums (FSS_NUM, FSS_DEN) so that scores can be
+aggregated correctly over any period.
+
+With --sparse the NBRCNT sums are only evaluated at the mixed points of
+each forecast/observation pair (see neighbourhood.sparse_partial_sums),
+homogeneous snow and snow-free areas are counted directly.
+
+With --band-rows the neighbourhood fractions are computed in bands of
+rows with a halo (see neighbourhood.tiled_partial_sums), so the memory of
+a worker is set by the band height on large grids (CARRA2, 2869 x 2869);
+the results are bit-identical to the full-grid computation.
+
+Usage:
+    python multi_model_verify.py 2015-09-01 2019-08-31 --obs IMS \
+        --fcst CERISE CARRA1 ERALAND --widths 1 3 5 7 \
+        --mask NORTH_SWEDEN=north_sweden_mask.nc --workers 16 --output vx.parquet
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from categorical_stats import categorical_scores, contingency_counts, event_fields, write_table
+from neighbourhood import (SHAPES, check_widths, fraction_fields, fss_partial_sums, nbrcnt_scores,
+                           sparse_partial_sums, tiled_partial_sums, window_tables)
+from obs_cache import ObsFractionCache
+from snow_io import daily_dates, load_regions, parse_source, read_bin_snow
+
+# nbrhd block of the GridStatConfig files
+WIDTHS = [1, 3, 5, 7]
+VLD_THRESH = 1.0
+SHAPE = "SQUARE"
+# days between two evictions of the observation cache
+EVICT_EVERY = 30
+
+_REGIONS = None
+_CACHE = None
+
+
+def _init_worker(mask_specs, cache_dir=None, cache_bytes=None):
+    global _REGIONS, _CACHE
+    _REGIONS = load_regions(mask_specs)
+    if cache_dir:
+        _CACHE = ObsFractionCache(cache_dir, cache_bytes)
+
+
+def _rows(date, model, region, width, stats):
+    return [{"date": date, "model": model, "region": region, "width": width,
+             "stat": stat, "value": float(value)} for stat, value in stats.items()]
+
+
+def observation_fields(obs, widths, thresh=1.0, vld_thresh=VLD_THRESH, nbrhd_shape=SHAPE,
+                       cache=None, cache_key=None, sparse=False, tiled=False, backend="numpy"):
+    """
+    Everything that only depends on the observation of a day.
+
+    Args:
+        sparse (bool): Keep the integral images of the observation instead
+            of its fractions (for sparse_partial_sums), the cache is not used.
+        tiled (bool): No fractions, they are computed band by band with
+            the forecast (tiled_partial_sums).
+        backend (str): fraction_fields backend, numpy or numba.
+        cache (ObsFractionCache): Optional cache of the fractions.
+        cache_key (dict): source, date and mask_version of the cache entry.
+
+    Returns:
+        dict: obs field, events, valid points and fractions per width.
+    """
+    obs_valid = ~np.isnan(obs)
+    with np.errstate(invalid="ignore"):
+        obs_event = obs >= thresh
+    if tiled:
+        return {"field": obs, "event": obs_event, "valid": obs_valid}
+    if sparse:
+        return {
+            "field": obs,
+            "event": obs_event,
+            "valid": obs_valid,
+            "tables": window_tables(obs_event, obs_valid, (max(widths) - 1) // 2),
+        }
+    fractions = None
+    if cache is not None:
+        fractions = cache.get(cache_key["source"], cache_key["date"], obs.shape, widths,
+                              thresh, vld_thresh, cache_key["mask_version"], nbrhd_shape)
+    if fractions is None:
+        fractions = fraction_fields(obs_event, obs_valid, widths, vld_thresh, nbrhd_shape,
+                                    backend)
+        if cache is not None:
+            cache.put(cache_key["source"], cache_key["date"], fractions,
+                      thresh, vld_thresh, cache_key["mask_version"], nbrhd_shape)
+    return {
+        "field": obs,
+        "event": obs_event,
+        "valid": obs_valid,
+        "fractions": fractions,
+    }
+
+
+def verify_model(date, model, fcst, obs_fields, regions, widths, thresh=1.0,
+                 vld_thresh=VLD_THRESH, nbrhd_shape=SHAPE, sparse=False, band_rows=None,
+                 backend="numpy"):
+    """
+    Statistics of one forecast field against preprocessed observations.
+
+    The NBRCNT sums come from the full fraction fields, from
+    sparse_partial_sums (sparse) or from tiled_partial_sums (band_rows).
+
+    Returns:
+        list: tidy rows (date, model, region, width, stat, value).
+    """
+    fcst_event, _, valid = event_fields(fcst, obs_fields["field"], thresh)
+    if band_rows:
+        region_sums = tiled_partial_sums(fcst_event, ~np.isnan(fcst), obs_fields["event"],
+                                         obs_fields["valid"], widths, regions, vld_thresh,
+                                         nbrhd_shape, band_rows, backend=backend)
+    elif sparse:
+        fcst_tables = window_tables(fcst_event, ~np.isnan(fcst), (max(widths) - 1) // 2)
+        region_sums = sparse_partial_sums(fcst_tables, obs_fields["tables"], valid, widths,
+                                          regions, vld_thresh)
+    else:
+        fcst_fractions = fraction_fields(fcst_event, ~np.isnan(fcst), widths, vld_thresh,
+                                         nbrhd_shape, backend)
+    rows = []
+    for region, mask in regions.items():
+        region_valid = valid if mask is None else valid & mask
+        ctc = contingency_counts(fcst_event, obs_fields["event"], region_valid)
+        ctc.update(categorical_scores(ctc))
+        rows += _rows(date, model, region, 1, ctc)
+        for width in widths:
+            if sparse or band_rows:
+                sums = region_sums[region][width]
+            else:
+                sums = fss_partial_sums(fcst_fractions[width], obs_fields["fractions"][width],
+                                        mask)
+            stats = nbrcnt_scores(sums)
+            stats.update(FSS_NUM=sums["fss_num"], FSS_DEN=sums["fss_den"],
+                         SUM_F=sums["sum_f"], SUM_O=sums["sum_o"])
+            rows += _rows(date, model, region, width, stats)
+    return rows
+
+
+def verify_day(date, obs_name, obs_template, fcst_templates, widths, thresh=1.0,
+               vld_thresh=VLD_THRESH, nbrhd_shape=SHAPE, mask_version="", sparse=False,
+               band_rows=None, backend="numpy"):
+    """Reads and preprocesses the observation once, then verifies all models."""
+    stamp = date.strftime("%Y%m%d")
+    try:
+        obs = read_bin_snow(obs_template.format(date=stamp))
+    except FileNotFoundError:
+        return []
+    obs_fields = observation_fields(obs, widths, thresh, vld_thresh, nbrhd_shape, _CACHE,
+                                    {"source": obs_name, "date": date,
+                                     "mask_version": mask_version}, sparse, bool(band_rows),
+                                    backend)
+    rows = []
+    for model, template in fcst_templates.items():
+        try:
+            fcst = read_bin_snow(template.format(date=stamp))
+        except FileNotFoundError:
+            continue
+        rows += verify_model(date, model, fcst, obs_fields, _REGIONS, widths,
+                             thresh, vld_thresh, nbrhd_shape, sparse, band_rows, backend)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("date_ini", help="First date, YYYY-MM-DD")
+    parser.add_argument("date_end", help="Last date, YYYY-MM-DD")
+    parser.add_argument("--obs", default="IMS", help="Observation source, NAME or NAME=TEMPLATE")
+    parser.add_argument("--fcst", nargs="+", default=["CERISE", "CARRA1", "ERALAND"],
+                        help="Forecast sources, NAME or NAME=TEMPLATE")
+    parser.add_argument("--widths", type=int, nargs="+", default=WIDTHS)
+    parser.add_argument("--vld-thresh", type=float, default=VLD_THRESH)
+    parser.add_argument("--shape", choices=SHAPES, default=SHAPE,
+                        help="Neighbourhood shape, as in the nbrhd block of GridStatConfig")
+    parser.add_argument("--mask", action="append", default=[],
+                        help="Extra region as NAME=gen_vx_mask_file.nc (repeatable)")
+    parser.add_argument("--thresh", type=float, default=1.0)
+    parser.add_argument("--sparse", action="store_true",
+                        help="Evaluate the neighbourhood sums at the mixed points only (SQUARE)")
+    parser.add_argument("--band-rows", type=int,
+                        help="Compute the fractions in bands of this many rows (large grids)")
+    parser.add_argument("--backend", choices=["numpy", "numba"], default="numpy",
+                        help="Fraction field kernels (numba: multi-threaded, SQUARE)")
+    parser.add_argument("--obs-cache", help="Directory of the observation fraction cache")
+    parser.add_argument("--cache-size-gb", type=float, default=50.0)
+    parser.add_argument("--mask-version", default="",
+                        help="Version tag of the observation preprocessing, part of the cache key")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--output", default="vx.parquet", help="Output .csv or .parquet")
+    args = parser.parse_args()
+
+    if args.sparse and args.shape != "SQUARE":
+        parser.error("--sparse works with SQUARE neighbourhoods only")
+    if args.backend == "numba" and args.shape != "SQUARE":
+        parser.error("--backend numba works with SQUARE neighbourhoods only")
+    if args.band_rows and (args.sparse or args.obs_cache):
+        parser.error("--band-rows cannot be combined with --sparse or --obs-cache")
+    if args.sparse and args.obs_cache:
+        parser.error("--sparse cannot be combined with --obs-cache (no fractions to cache)")
+    obs_name, obs_template = parse_source(args.obs)
+    fcst_templates = dict(parse_source(spec) for spec in args.fcst)
+    widths = check_widths(args.widths)
+    dates = daily_dates(args.date_ini, args.date_end)
+
+    cache_bytes = args.cache_size_gb * 1e9
+    cache = ObsFractionCache(args.obs_cache, cache_bytes) if args.obs_cache else None
+    rows = []
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                             initargs=(args.mask, args.obs_cache, cache_bytes)) as pool:
+        futures = [pool.submit(verify_day, date, obs_name, obs_template, fcst_templates,
+                               widths, args.thresh, args.vld_thresh, args.shape,
+                               args.mask_version, args.sparse, args.band_rows, args.backend)
+                   for date in dates]
+        for i, (date, future) in enumerate(zip(dates, futures), 1):
+            day_rows = future.result()
+            if day_rows:
+                print(f"{date:%Y-%m-%d}: verified against {obs_name}")
+            rows.extend(day_rows)
+            # keep the cache near its cap during long runs, not only at the end
+            if cache is not None and i % EVICT_EVERY == 0:
+                cache.evict()
+    if cache is not None:
+        cache.evict()
+
+    if not rows:
+        print("No days with both forecast and observation files")
+        return
+    table = pd.DataFrame(rows)
+    table.insert(2, "obs", obs_name)
+    write_table(table, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,418 @@
+"""
+Neighbourhood fraction fields and FSS partial sums, as in the nbrhd block
+of the GridStatConfig files (shape = SQUARE or CIRCLE, widths in grid
+points, vld_thresh).
+
+SQUARE: the fractions of all widths are obtained from one integral image
+(summed area table) of the event field and one of the valid points, so
+the cost of a width does not depend on its size.
+
+CIRCLE: the window is the disc of diameter width, (dy^2 + dx^2 <= r^2
+with r = (width - 1) / 2). Window sums are computed by real-FFT
+convolution; the field spectra are computed once for all widths and the
+kernel spectra are cached per (FFT shape, width), so large radii cost the
+same as small ones.
+
+Leading axes (e.g. time) are processed in one go.
+
+Window sums of events and valid points are exact integers: the integral
+images of boolean fields are kept in unsigned integers (uint16 while the
+largest window holds fewer than 65536 points, uint32 otherwise). The
+table itself may wrap around, but unsigned arithmetic is modular, so the
+four-corner differences are exact as long as the window sum fits. The
+counts are only turned into fractions by the final division.
+
+tiled_partial_sums gives the same FSS partial sums as fraction_fields +
+fss_partial_sums, bit for bit, processing the grid in bands of rows with
+a halo of the largest radius: the window counts are exact integers, and
+the sums are reduced per row first and then over the rows, so the bands
+only change the grouping, not the arithmetic. Peak memory is set by the
+band height.
+
+sparse_partial_sums gives the FSS partial sums of a forecast/observation
+pair without building full fraction fields: points whose largest window
+is fully valid and homogeneous (all or no events) in both fields have
+fractions 0 or 1 at every width and are counted directly, only the
+remaining mixed points (snow edges) are evaluated, by gathering window
+sums from the integral images at their flat indices.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+from scipy import fft
+
+SHAPES = ("SQUARE", "CIRCLE")
+
+
+def check_widths(widths):
+    """Neighbourhood widths must be odd, as in MET."""
+    widths = sorted(set(int(w) for w in widths))
+    if any(w < 1 or w % 2 == 0 for w in widths):
+        raise ValueError(f"Neighbourhood widths must be odd and positive: {widths}")
+    return widths
+
+
+def count_dtype(max_sum):
+    """Smallest unsigned integer type holding window sums up to max_sum."""
+    for dtype in (np.uint16, np.uint32):
+        if max_sum <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def integral_image(field, pad):
+    """
+    Summed area table of a field padded with pad zeros on each side.
+
+    Boolean fields give a count table in the smallest unsigned type that
+    holds a (2 pad + 1)^2 window sum (the cumulative sums wrap around,
+    window sums from box_sum are exact), other fields float64 or int64.
+
+    Args:
+        field (np.ndarray): Array (..., y, x).
+        pad (int): Number of zero points added around the domain, so that
+            windows extending outside the domain can be summed.
+
+    Returns:
+        np.ndarray: (..., y + 2 pad + 1, x + 2 pad + 1) cumulative sums
+        with a leading row and column of zeros.
+    """
+    lead = field.shape[:-2]
+    ny, nx = field.shape[-2:]
+    if field.dtype == bool:
+        dtype = count_dtype((2 * pad + 1) ** 2)
+    else:
+        dtype = np.result_type(field.dtype, np.int64)
+    table = np.zeros(lead + (ny + 2 * pad + 1, nx + 2 * pad + 1), dtype=dtype)
+    table[..., pad + 1:pad + ny + 1, pad + 1:pad + nx + 1] = field
+    np.cumsum(table, axis=-2, dtype=dtype, out=table)
+    np.cumsum(table, axis=-1, dtype=dtype, out=table)
+    return table
+
+
+def box_sum(table, width, pad, shape):
+    """
+    Sums over the width x width window centred on every point.
+
+    Args:
+        table (np.ndarray): Integral image from integral_image.
+        width (int): Odd window width, (width - 1) / 2 <= pad.
+        pad (int): Padding used for the integral image.
+        shape (tuple): (ny, nx) of the original field.
+
+    Returns:
+        np.ndarray: (..., ny, nx) window sums, in the dtype of the table.
+    """
+    ny, nx = shape
+    half = (width - 1) // 2
+    y0, y1 = pad - half, pad + half + 1
+    x0, x1 = pad - half, pad + half + 1
+    return (table[..., y1:y1 + ny, x1:x1 + nx] - table[..., y0:y0 + ny, x1:x1 + nx]
+            - table[..., y1:y1 + ny, x0:x0 + nx] + table[..., y0:y0 + ny, x0:x0 + nx])
+
+
+def circle_kernel(width):
+    """Boolean disc of diameter width (odd)."""
+    half = (width - 1) // 2
+    yy, xx = np.mgrid[-half:half + 1, -half:half + 1]
+    return yy ** 2 + xx ** 2 <= half ** 2
+
+
+# reused by every day of a run, but each entry is a full padded grid
+# (~70 MB on CARRA2) per process: about as many entries as widths in use
+@lru_cache(maxsize=8)
+def _kernel_spectrum(fft_shape, width):
+    kernel = np.zeros(fft_shape)
+    kernel[:width, :width] = circle_kernel(width)
+    return fft.rfft2(kernel)
+
+
+def circle_sums(spectrum, width, fft_shape, pad, shape):
+    """
+    Sums over the circular window centred on every point.
+
+    Args:
+        spectrum (np.ndarray): rfft2 of the field zero padded to fft_shape,
+            with the field starting at (pad, pad).
+        width (int): Odd window diameter, (width - 1) / 2 <= pad.
+        fft_shape (tuple): Padded 2D shape used for the FFT.
+        pad (int): Offset of the field in the padded array.
+        shape (tuple): (ny, nx) of the original field.
+
+    Returns:
+        np.ndarray: (..., ny, nx) window sums, rounded to unsigned integers.
+    """
+    ny, nx = shape
+    half = (width - 1) // 2
+    conv = fft.irfft2(spectrum * _kernel_spectrum(fft_shape, width), s=fft_shape, workers=-1)
+    # the convolution with the kernel anchored at (0, 0) is shifted by half
+    y0, x0 = pad + half, pad + half
+    sums = np.rint(conv[..., y0:y0 + ny, x0:x0 + nx])
+    return sums.astype(count_dtype(np.count_nonzero(circle_kernel(width))))
+
+
+def _field_spectrum(field, pad, fft_shape):
+    padded = np.zeros(field.shape[:-2] + fft_shape)
+    ny, nx = field.shape[-2:]
+    padded[..., pad:pad + ny, pad:pad + nx] = field
+    return fft.rfft2(padded, workers=-1)
+
+
+def fraction_fields(event, valid, widths, vld_thresh=1.0, nbrhd_shape="SQUARE", backend="numpy"):
+    """
+    Neighbourhood event fractions for several widths.
+
+    Points outside the domain and undefined points do not count as valid.
+    The fraction is the number of events over the number of valid points
+    in the window; it is NaN where the valid share of the window is below
+    vld_thresh or where the point itself is undefined.
+
+    Args:
+        event (np.ndarray): Boolean events (..., y, x).
+        valid (np.ndarray): Boolean valid points, same shape.
+        widths (list): Odd neighbourhood widths.
+        vld_thresh (float): Minimum share of valid points in the window.
+        nbrhd_shape (str): SQUARE or CIRCLE.
+        backend (str): "numpy", or "numba" for the multi-threaded kernels
+            of box_filter.py (SQUARE, same results).
+
+    Returns:
+        dict: width -> float64 fraction field (..., y, x).
+    """
+    widths = check_widths(widths)
+    if nbrhd_shape not in SHAPES:
+        raise ValueError(f"Unknown neighbourhood shape {nbrhd_shape}, use one of {SHAPES}")
+    if backend == "numba":
+        from box_filter import fraction_fields as numba_fraction_fields
+        return numba_fraction_fields(event, valid, widths, vld_thresh, nbrhd_shape)
+    if backend != "numpy":
+        raise ValueError(f"Unknown backend {backend}")
+    shape = event.shape[-2:]
+    pad = (max(widths) - 1) // 2
+    if nbrhd_shape == "SQUARE":
+        event_table = integral_image(event & valid, pad)
+        valid_table = integral_image(valid, pad)
+    else:
+        # linear (not circular) convolution: pad by the largest kernel
+        fft_shape = tuple(fft.next_fast_len(n + 2 * pad, real=True) for n in shape)
+        event_spectrum = _field_spectrum(event & valid, pad, fft_shape)
+        valid_spectrum = _field_spectrum(valid, pad, fft_shape)
+    fractions = {}
+    for width in widths:
+        if nbrhd_shape == "SQUARE":
+            events = box_sum(event_table, width, pad, shape)
+            counts = box_sum(valid_table, width, pad, shape)
+            size = width * width
+        else:
+            events = circle_sums(event_spectrum, width, fft_shape, pad, shape)
+            counts = circle_sums(valid_spectrum, width, fft_shape, pad, shape)
+            size = np.count_nonzero(circle_kernel(width))
+        frac = np.full(events.shape, np.nan)
+        ok = valid & (counts >= vld_thresh * size) & (counts > 0)
+        np.divide(events, counts, out=frac, where=ok)
+        fractions[width] = frac
+    return fractions
+
+
+def window_tables(event, valid, pad):
+    """Integral images of the events and of the valid points of a field."""
+    return integral_image(event & valid, pad), integral_image(valid, pad)
+
+
+def _gather(table, width, base):
+    """Window sums at the points with flat index base in the padded table."""
+    half = (width - 1) // 2
+    stride = table.shape[-1]
+    flat = table.ravel()
+    low, high = -half * (stride + 1), (half + 1) * (stride + 1)
+    return (flat.take(base + high) - flat.take(base + high - (2 * half + 1))
+            - flat.take(base + high - (2 * half + 1) * stride) + flat.take(base + low))
+
+
+def sparse_partial_sums(fcst_tables, obs_tables, valid, widths, regions, vld_thresh=1.0):
+    """
+    FSS partial sums of all widths and regions, evaluated at the mixed points only.
+
+    Args:
+        fcst_tables (tuple): window_tables of the forecast, with
+            pad = (max(widths) - 1) / 2.
+        obs_tables (tuple): Same for the observation.
+        valid (np.ndarray): 2D boolean, points defined in both fields.
+        widths (list): Odd neighbourhood widths.
+        regions (dict): Region name -> 2D boolean mask, or None for FULL.
+        vld_thresh (float): Minimum share of valid points in the window.
+
+    Returns:
+        dict: region -> width -> sums, with the keys of fss_partial_sums.
+    """
+    widths = check_widths(widths)
+    big = max(widths)
+    pad = (big - 1) // 2
+    shape = valid.shape
+    full = big * big
+    f_events = box_sum(fcst_tables[0], big, pad, shape)
+    o_events = box_sum(obs_tables[0], big, pad, shape)
+    trivial = (valid & (box_sum(fcst_tables[1], big, pad, shape) == full)
+               & (box_sum(obs_tables[1], big, pad, shape) == full)
+               & ((f_events == 0) | (f_events == full)) & ((o_events == 0) | (o_events == full)))
+    f_one = trivial & (f_events == full)
+    o_one = trivial & (o_events == full)
+    differ = f_one ^ o_one
+    iy, ix = np.nonzero(valid & ~trivial)
+    # flat index of the points in the padded integral images
+    base = (iy + pad) * fcst_tables[0].shape[-1] + ix + pad
+
+    mixed = {}
+    for width in widths:
+        f_count = _gather(fcst_tables[1], width, base)
+        o_count = _gather(obs_tables[1], width, base)
+        ok = ((f_count >= vld_thresh * width * width) & (f_count > 0)
+              & (o_count >= vld_thresh * width * width) & (o_count > 0))
+        pf = np.zeros(len(iy))
+        po = np.zeros(len(iy))
+        np.divide(_gather(fcst_tables[0], width, base), f_count, out=pf, where=ok)
+        np.divide(_gather(obs_tables[0], width, base), o_count, out=po, where=ok)
+        mixed[width] = (ok, pf, po)
+
+    out = {}
+    for region, mask in regions.items():
+        if mask is None:
+            in_region, counts = np.ones(len(iy), dtype=bool), (trivial, differ, f_one, o_one)
+        else:
+            in_region, counts = mask[iy, ix], (trivial & mask, differ & mask, f_one & mask,
+                                                o_one & mask)
+        n_t, num_t, f_t, o_t = (np.count_nonzero(c) for c in counts)
+        out[region] = {}
+        for width, (ok, pf, po) in mixed.items():
+            sel = ok & in_region
+            pf_r, po_r = pf[sel], po[sel]
+            out[region][width] = {
+                "n": n_t + np.count_nonzero(sel),
+                "fss_num": num_t + ((pf_r - po_r) ** 2).sum(),
+                "fss_den": f_t + o_t + (pf_r ** 2).sum() + (po_r ** 2).sum(),
+                "sum_f": f_t + pf_r.sum(),
+                "sum_o": o_t + po_r.sum(),
+            }
+    return out
+
+
+def _row_sums(fcst_frac, obs_frac, mask=None):
+    """Per-row (..., y) FSS sums, see fss_partial_sums."""
+    ok = ~np.isnan(fcst_frac) & ~np.isnan(obs_frac)
+    if mask is not None:
+        ok &= mask
+    pf = np.where(ok, fcst_frac, 0.0)
+    po = np.where(ok, obs_frac, 0.0)
+    return {
+        "n": np.count_nonzero(ok, axis=-1),
+        "fss_num": ((pf - po) ** 2).sum(axis=-1),
+        "sum_f2": (pf ** 2).sum(axis=-1),
+        "sum_o2": (po ** 2).sum(axis=-1),
+        "sum_f": pf.sum(axis=-1),
+        "sum_o": po.sum(axis=-1),
+    }
+
+
+def _total(rows):
+    return {
+        "n": rows["n"].sum(axis=-1),
+        "fss_num": rows["fss_num"].sum(axis=-1),
+        "fss_den": rows["sum_f2"].sum(axis=-1) + rows["sum_o2"].sum(axis=-1),
+        "sum_f": rows["sum_f"].sum(axis=-1),
+        "sum_o": rows["sum_o"].sum(axis=-1),
+    }
+
+
+def fss_partial_sums(fcst_frac, obs_frac, mask=None):
+    """
+    FSS partial sums over the last two axes.
+
+    Args:
+        fcst_frac (np.ndarray): Forecast fractions (..., y, x), NaN if invalid.
+        obs_frac (np.ndarray): Observed fractions, same shape.
+        mask (np.ndarray): Optional 2D boolean region.
+
+    Returns:
+        dict: arrays of shape (...): n (number of points), fss_num
+        (sum (Pf - Po)^2), fss_den (sum Pf^2 + sum Po^2), sum_f and sum_o.
+    """
+    return _total(_row_sums(fcst_frac, obs_frac, mask))
+
+
+def row_bands(ny, band_rows, halo):
+    """(y0, y1, h0, h1): rows y0:y1 of every band and h0:h1 with their halo."""
+    return [(y0, min(y0 + band_rows, ny), max(y0 - halo, 0), min(y0 + band_rows + halo, ny))
+            for y0 in range(0, ny, band_rows)]
+
+
+def tiled_partial_sums(fcst_event, fcst_valid, obs_event, obs_valid, widths, regions,
+                       vld_thresh=1.0, nbrhd_shape="SQUARE", band_rows=256, workers=1,
+                       backend="numpy"):
+    """
+    fss_partial_sums of the fraction_fields of a forecast/observation
+    pair, computed in bands of band_rows rows (parallel threads).
+
+    Args:
+        fcst_event, fcst_valid (np.ndarray): Boolean forecast events and
+            valid points (..., y, x).
+        obs_event, obs_valid (np.ndarray): Same for the observation.
+        widths (list): Odd neighbourhood widths.
+        regions (dict): Region name -> 2D boolean mask, or None for FULL.
+        backend (str): fraction_fields backend.
+
+    Returns:
+        dict: region -> width -> sums, with the keys of fss_partial_sums.
+    """
+    widths = check_widths(widths)
+    halo = (max(widths) - 1) // 2
+
+    def band_sums(band):
+        y0, y1, h0, h1 = band
+        fcst_frac = fraction_fields(fcst_event[..., h0:h1, :], fcst_valid[..., h0:h1, :],
+                                    widths, vld_thresh, nbrhd_shape, backend)
+        obs_frac = fraction_fields(obs_event[..., h0:h1, :], obs_valid[..., h0:h1, :],
+                                   widths, vld_thresh, nbrhd_shape, backend)
+        core = slice(y0 - h0, y1 - h0)
+        return {region: {width: _row_sums(fcst_frac[width][..., core, :],
+                                          obs_frac[width][..., core, :],
+                                          None if mask is None else mask[y0:y1])
+                         for width in widths}
+                for region, mask in regions.items()}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        bands = list(pool.map(band_sums, row_bands(fcst_event.shape[-2], band_rows, halo)))
+    return {region: {width: _total({key: np.concatenate([b[region][width][key] for b in bands],
+                                                        axis=-1)
+                                    for key in bands[0][region][width]})
+                     for width in widths}
+            for region in regions}
+
+
+def nbrcnt_scores(sums):
+    """
+    MET NBRCNT scores from partial sums (summed over any set of days).
+
+    Returns:
+        dict: TOTAL, FBS, FSS, AFSS, UFSS, F_RATE, O_RATE
+    """
+    n = np.asarray(sums["n"], dtype=float)
+    num = np.asarray(sums["fss_num"], dtype=float)
+    den = np.asarray(sums["fss_den"], dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fbs = np.where(n > 0, num / n, np.nan)
+        fss = np.where(den > 0, 1.0 - num / den, np.nan)
+        f_rate = np.where(n > 0, np.asarray(sums["sum_f"]) / n, np.nan)
+        o_rate = np.where(n > 0, np.asarray(sums["sum_o"]) / n, np.nan)
+        afss = np.where(f_rate ** 2 + o_rate ** 2 > 0,
+                        2.0 * f_rate * o_rate / (f_rate ** 2 + o_rate ** 2), np.nan)
+    return {
+        "TOTAL": n,
+        "FBS": fbs,
+        "FSS": fss,
+        "AFSS": afss,
+        "UFSS": 0.5 + o_rate / 2.0,
+        "F_RATE": f_rate,
+        "O_RATE": o_rate,
+    }
@@ -0,0 +1,128 @@
+"""
+Persistent cache of observation neighbourhood fractions.
+
+IMS and CRYO observations do not change between verification campaigns,
+so their fraction fields at the configured widths are stored on disk and
+reused: verifying a new forecast experiment then only computes the
+forecast side.
+
+Each entry is a compressed Zarr store holding the fractions of one
+observation day for one set of widths. Entries are keyed by observation
+source, date, grid shape, neighbourhood shape and widths, event
+threshold, vld_thresh and a free
+mask version string (to be changed when the observation preprocessing or
+masking changes). The cache is kept under a size cap by removing the
+least recently used entries.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+import xarray as xr
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+class ObsFractionCache:
+    """
+    On-disk LRU cache of observation fraction fields.
+
+    Args:
+        root (str): Cache directory.
+        max_bytes (float): Size cap of the cache.
+    """
+
+    def __init__(self, root, max_bytes=50e9):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, source, date, shape, widths, thresh, vld_thresh, mask_version,
+              nbrhd_shape):
+        key = json.dumps({
+            "source": source,
+            "date": date.strftime("%Y%m%d"),
+            "shape": list(shape),
+            "widths": sorted(int(w) for w in widths),
+            "thresh": float(thresh),
+            "vld_thresh": float(vld_thresh),
+            "mask_version": mask_version,
+            "nbrhd_shape": nbrhd_shape,
+        }, sort_keys=True)
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return os.path.join(self.root, f"{source}_{date:%Y%m%d}_{digest}.zarr")
+
+    def get(self, source, date, shape, widths, thresh=1.0, vld_thresh=1.0, mask_version="",
+            nbrhd_shape="SQUARE"):
+        """
+        Cached fractions of one observation day.
+
+        Returns:
+            dict: width -> float64 fraction field, or None if not cached.
+        """
+        path = self._path(source, date, shape, widths, thresh, vld_thresh, mask_version,
+                          nbrhd_shape)
+        if not os.path.isdir(path):
+            return None
+        try:
+            with xr.open_zarr(path) as ds:
+                fractions = {int(w): ds[f"frac_{w}"].values for w in widths}
+        except (OSError, KeyError, ValueError):
+            return None
+        # the directory time stamp is the last access time used for eviction
+        os.utime(path)
+        return fractions
+
+    def put(self, source, date, fractions, thresh=1.0, vld_thresh=1.0, mask_version="",
+            nbrhd_shape="SQUARE"):
+        """Stores the fractions of one observation day."""
+        widths = sorted(fractions)
+        shape = fractions[widths[0]].shape
+        path = self._path(source, date, shape, widths, thresh, vld_thresh, mask_version,
+                          nbrhd_shape)
+        if os.path.isdir(path):
+            return
+        ds = xr.Dataset({f"frac_{w}": (("y", "x"), np.asarray(fractions[w], dtype=np.float64))
+                         for w in widths})
+        ds.attrs.update(source=source, date=date.strftime("%Y-%m-%d"),
+                        thresh=thresh, vld_thresh=vld_thresh, mask_version=mask_version,
+                        nbrhd_shape=nbrhd_shape)
+        # write to a temporary store and rename, so that concurrent workers
+        # never see a partial entry
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        ds.to_zarr(tmp, mode="w")
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits the size cap."""
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith(".tmp"):
+                continue
+            if name.endswith(".zarr") and os.path.isdir(path):
+                entries.append((os.path.getmtime(path), _dir_size(path), path))
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        if removed:
+            print(f"Observation cache: removed {removed} entries, {total / 1e9:.2f} GB left")
+        return total
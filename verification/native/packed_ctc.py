@@ -0,0 +1,146 @@
+"""
+Bit-parallel contingency table counts for binary fields.
+
+The forecast events, observed events and valid points are packed into
+uint64 words (64 grid points per word), and the cells of the contingency
+table are counted with bitwise operations and popcount:
+
+    hits         = popcount(f & o & v)
+    false alarms = popcount(f & ~o & v)
+    misses       = popcount(~f & o & v)
+    correct neg. = popcount(~f & ~o & v)
+
+Once packed, every extra region costs one AND with the packed region mask
+per word, which makes sweeps over many regions cheap. A numba kernel is
+used when numba is available, otherwise the NumPy popcount is used.
+"""
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+def pack_bits(field):
+    """
+    Packs a boolean field into uint64 words over its last two axes.
+
+    Args:
+        field (np.ndarray): Boolean array (..., y, x).
+
+    Returns:
+        np.ndarray: uint64 array (..., nwords). Padding bits are zero.
+    """
+    field = np.asarray(field, dtype=bool)
+    lead = field.shape[:-2]
+    flat = field.reshape(lead + (-1,))
+    packed = np.packbits(flat, axis=-1, bitorder="little")
+    pad = (-packed.shape[-1]) % 8
+    if pad:
+        packed = np.concatenate(
+            [packed, np.zeros(lead + (pad,), dtype=np.uint8)], axis=-1)
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+if hasattr(np, "bitwise_count"):
+    def _popcount(words, axis=-1):
+        return np.bitwise_count(words).sum(axis=axis, dtype=np.int64)
+else:
+    _BYTE_COUNTS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(words, axis=-1):
+        as_bytes = words.view(np.uint8).reshape(words.shape[:-1] + (-1,))
+        return _BYTE_COUNTS[as_bytes].sum(axis=axis, dtype=np.int64)
+
+
+def _counts_numpy(f, o, v):
+    fy = f & v
+    oy = o & v
+    return (_popcount(v), _popcount(fy & oy), _popcount(fy), _popcount(oy))
+
+
+if HAVE_NUMBA:
+    @njit(inline="always")
+    def _popcount64(x):
+        x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+        x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+        x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+        return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+    @njit(parallel=True, nogil=True, cache=True)
+    def _counts_kernel(f, o, v, out):
+        for t in prange(f.shape[0]):
+            total = np.uint64(0)
+            hits = np.uint64(0)
+            fcst_yes = np.uint64(0)
+            obs_yes = np.uint64(0)
+            for w in range(f.shape[1]):
+                vw = v[t, w]
+                fw = f[t, w] & vw
+                ow = o[t, w] & vw
+                total += _popcount64(vw)
+                hits += _popcount64(fw & ow)
+                fcst_yes += _popcount64(fw)
+                obs_yes += _popcount64(ow)
+            out[t, 0] = total
+            out[t, 1] = hits
+            out[t, 2] = fcst_yes
+            out[t, 3] = obs_yes
+
+    def _counts_numba(f, o, v):
+        lead = np.broadcast_shapes(f.shape, o.shape, v.shape)
+        nwords = lead[-1]
+        lead = lead[:-1]
+        f2, o2, v2 = (np.ascontiguousarray(np.broadcast_to(a, lead + (nwords,)))
+                      .reshape(-1, nwords) for a in (f, o, v))
+        out = np.empty((f2.shape[0], 4), dtype=np.uint64)
+        _counts_kernel(f2, o2, v2, out)
+        out = out.astype(np.int64).reshape(lead + (4,))
+        return tuple(out[..., i] for i in range(4))
+
+
+def packed_counts(f, o, v, backend="auto"):
+    """
+    Contingency counts from packed words.
+
+    Args:
+        f (np.ndarray): Packed forecast events (..., nwords).
+        o (np.ndarray): Packed observed events (..., nwords).
+        v (np.ndarray): Packed valid points, broadcastable to f.
+        backend (str): "numba", "numpy" or "auto" (numba if available).
+
+    Returns:
+        dict: int64 arrays TOTAL, FY_OY, FY_ON, FN_OY, FN_ON.
+    """
+    if backend == "auto":
+        backend = "numba" if HAVE_NUMBA else "numpy"
+    if backend == "numba":
+        if not HAVE_NUMBA:
+            raise ImportError("numba is not available, use backend='numpy'")
+        total, hits, fcst_yes, obs_yes = _counts_numba(f, o, v)
+    elif backend == "numpy":
+        total, hits, fcst_yes, obs_yes = _counts_numpy(f, o, v)
+    else:
+        raise ValueError(f"Unknown backend {backend}")
+    false_alarms = fcst_yes - hits
+    misses = obs_yes - hits
+    return {
+        "TOTAL": total,
+        "FY_OY": hits,
+        "FY_ON": false_alarms,
+        "FN_OY": misses,
+        "FN_ON": total - hits - false_alarms - misses,
+    }
+
+
+def contingency_counts_packed(fcst_event, obs_event, valid, backend="auto"):
+    """
+    Drop-in replacement for categorical_stats.contingency_counts that packs
+    the boolean fields and counts the cells with popcount.
+    """
+    valid = np.broadcast_to(valid, np.broadcast_shapes(np.shape(fcst_event), np.shape(valid)))
+    return packed_counts(pack_bits(fcst_event), pack_bits(obs_event),
+                         pack_bits(valid), backend=backend)
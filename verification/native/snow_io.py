@@ -0,0 +1,136 @@
+"""
+Helpers to read the daily bin_snow NetCDF files written by the
+pre-processing converters (pre-processing/zarr-data/dump_*.py,
+pre-processing/process_carra_land_pv2/) into stacked (time, y, x) cubes,
+plus the MET gen_vx_mask files used as verification regions.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# File name templates of the daily files, as used in the run_grid_stat_*.sh
+# and verify_carra1_land2_cryo.sh scripts. {date} is YYYYMMDD.
+SOURCES = {
+    "IMS": "/ec/res4/scratch/nhd/CERISE/IMS_snow_cover/from_zarr/ims_{date}.nc",
+    "CRYO": "/ec/res4/scratch/nhd/CERISE/CRYO_orig_proj_CF_compliant/snowcover_daily_{date}_cf_compliant.nc",
+    "CERISE": "/ec/res4/scratch/nhd/CERISE/CERISE_output/cerise_{date}.nc",
+    "CARRA1": "/ec/res4/scratch/nhd/CERISE/CARRA1/from_zarr/carra1_{date}.nc",
+    "ERALAND": "/ec/res4/scratch/nhd/CERISE/ERA5/from_zarr/eraland_{date}.nc",
+    "CARRA_LAND_PV2": "/ec/res4/scratch/nhd/CERISE/CARRA_Land_pv2/SELECT_SURFOUT.{date}_03h00_bin_snow.nc",
+}
+
+
+def parse_source(spec):
+    """
+    Splits a source given on the command line as NAME or NAME=TEMPLATE.
+
+    Args:
+        spec (str): e.g. "CERISE" or "CERISE=/path/cerise_{date}.nc".
+
+    Returns:
+        tuple: (name, template)
+    """
+    if "=" in spec:
+        name, template = spec.split("=", 1)
+        return name, template
+    if spec not in SOURCES:
+        raise KeyError(f"Unknown source {spec}, give it as NAME=TEMPLATE")
+    return spec, SOURCES[spec]
+
+
+def daily_dates(date_ini, date_end):
+    """Daily dates between date_ini and date_end (both included)."""
+    return pd.date_range(date_ini, date_end, freq="D")
+
+
+def read_bin_snow(path, var="bin_snow"):
+    """
+    Reads one daily binary snow field.
+
+    Args:
+        path (str): Path to the NetCDF file.
+        var (str): Name of the binary snow variable.
+
+    Returns:
+        np.ndarray: 2D float32 array, NaN where the field is undefined.
+    """
+    with xr.open_dataset(path) as ds:
+        field = ds[var].squeeze(drop=True).values.astype(np.float32)
+    if field.ndim != 2:
+        raise ValueError(f"{path}: expected a 2D {var} field, got shape {field.shape}")
+    return field
+
+
+def load_bin_snow_cube(template, dates, var="bin_snow", workers=4):
+    """
+    Stacks the daily files of one source into a (time, y, x) cube.
+
+    Days without a file are skipped, like the `if [[ -f $OB ]]` checks
+    in the MET scripts.
+
+    Args:
+        template (str): File name template with a {date} placeholder.
+        dates (iterable): Dates to read.
+        var (str): Name of the binary snow variable.
+        workers (int): Number of threads used to read the files.
+
+    Returns:
+        tuple: (pd.DatetimeIndex of the dates found, float32 cube)
+    """
+    dates = pd.DatetimeIndex(dates)
+    paths = [template.format(date=d.strftime("%Y%m%d")) for d in dates]
+    found = [os.path.isfile(p) for p in paths]
+    dates = dates[found]
+    paths = [p for p, ok in zip(paths, found) if ok]
+    if not paths:
+        return dates, np.empty((0, 0, 0), dtype=np.float32)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        fields = list(pool.map(lambda p: read_bin_snow(p, var), paths))
+    return dates, np.stack(fields)
+
+
+def load_mask(path, var=None):
+    """
+    Reads a verification region written by MET gen_vx_mask.
+
+    Args:
+        path (str): Path to the mask NetCDF file.
+        var (str): Mask variable. If None, the first 2D data variable
+            that is not lat/lon is used.
+
+    Returns:
+        np.ndarray: 2D boolean array, True inside the region.
+    """
+    with xr.open_dataset(path) as ds:
+        if var is None:
+            candidates = [v for v in ds.data_vars
+                          if ds[v].ndim == 2 and v not in ("lat", "lon")]
+            if not candidates:
+                raise KeyError(f"No 2D mask variable found in {path}")
+            var = candidates[0]
+        mask = ds[var].values
+    return np.nan_to_num(mask) > 0
+
+
+def load_regions(mask_specs):
+    """
+    Builds the verification regions from NAME=PATH specifications.
+
+    FULL (the whole grid) is always included, like mask.grid = [ "FULL" ]
+    in the GridStatConfig files.
+
+    Args:
+        mask_specs (list): Strings of the form NAME=PATH.
+
+    Returns:
+        dict: region name -> 2D boolean array, or None for FULL.
+    """
+    regions = {"FULL": None}
+    for spec in mask_specs or []:
+        name, path = spec.split("=", 1)
+        regions[name] = load_mask(path)
+    return regions
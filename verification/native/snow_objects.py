@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+MODE-style identification of snow objects in the daily bin_snow fields.
+
+As in MET mode (see verification/met/run_mode.sh) the field is optionally
+smoothed (convolution radius) and thresholded, then the connected snow
+patches are labelled with scipy.ndimage.label. Object attributes are
+computed for all objects at once with label-indexed reductions:
+- area (grid points)
+- centroid (y, x)
+- length, width and orientation angle from the second order moments
+  (length/width of the rectangle with the same moments)
+- perimeter (number of object edges facing a non-object point)
+
+Forecast objects are matched to observed objects by overlap and centroid
+distance. The days of the date range are processed in parallel and the
+results are written as two columnar tables: the objects and the
+forecast/observation object pairs.
+
+Usage:
+    python snow_objects.py 2015-09-01 2019-08-31 --obs IMS --fcst CERISE CARRA1 \
+        --conv-radius 2 --min-area 25 --workers 16 --output objects.parquet
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+
+from categorical_stats import write_table
+from snow_io import daily_dates, parse_source, read_bin_snow
+
+OBJECT_COLUMNS = ["object_id", "area", "centroid_y", "centroid_x",
+                  "length", "width", "angle", "perimeter"]
+PAIR_COLUMNS = ["fcst_id", "obs_id", "centroid_dist", "overlap_area", "overlap_ratio"]
+
+
+def identify_objects(field, conv_radius=0, conv_thresh=0.5, min_area=1, connectivity=8):
+    """
+    Labels the snow objects of one field.
+
+    Args:
+        field (np.ndarray): 2D binary snow field, NaN where undefined.
+        conv_radius (int): Half-width of the square smoothing window
+            (0 for no smoothing).
+        conv_thresh (float): Threshold applied to the smoothed field.
+        min_area (int): Objects smaller than this (grid points) are removed.
+        connectivity (int): 4 or 8 connected neighbours.
+
+    Returns:
+        tuple: (labels, n_objects), labels is 0 outside objects.
+    """
+    values = np.nan_to_num(field, nan=0.0)
+    if conv_radius > 0:
+        values = ndimage.uniform_filter(values, size=2 * conv_radius + 1, mode="constant")
+    structure = np.ones((3, 3)) if connectivity == 8 else None
+    labels, n_objects = ndimage.label(values >= conv_thresh, structure=structure)
+    if min_area > 1 and n_objects > 0:
+        area = np.bincount(labels.ravel(), minlength=n_objects + 1)
+        keep = area >= min_area
+        keep[0] = False
+        relabel = np.zeros(n_objects + 1, dtype=labels.dtype)
+        relabel[keep] = np.arange(1, keep.sum() + 1)
+        labels = relabel[labels]
+        n_objects = int(keep.sum())
+    return labels, n_objects
+
+
+def object_attributes(labels, n_objects):
+    """
+    Attributes of all labelled objects in one pass of label-indexed sums.
+
+    Returns:
+        pd.DataFrame: one row per object with the OBJECT_COLUMNS.
+    """
+    if n_objects == 0:
+        return pd.DataFrame(columns=OBJECT_COLUMNS)
+    flat = labels.ravel()
+    yy, xx = np.indices(labels.shape)
+    yy = yy.ravel().astype(float)
+    xx = xx.ravel().astype(float)
+    n_bins = n_objects + 1
+
+    def label_sum(weights):
+        return np.bincount(flat, weights=weights, minlength=n_bins)[1:]
+
+    area = np.bincount(flat, minlength=n_bins)[1:].astype(float)
+    cy = label_sum(yy) / area
+    cx = label_sum(xx) / area
+    var_y = label_sum(yy * yy) / area - cy ** 2
+    var_x = label_sum(xx * xx) / area - cx ** 2
+    cov_xy = label_sum(xx * yy) / area - cx * cy
+
+    # eigenvalues of the covariance matrix; a uniform rectangle of side L
+    # has variance L^2 / 12 along that side (+1/12 for the pixel size)
+    half_trace = 0.5 * (var_x + var_y)
+    root = np.sqrt(np.maximum(0.25 * (var_x - var_y) ** 2 + cov_xy ** 2, 0.0))
+    length = np.sqrt(12.0 * (half_trace + root) + 1.0)
+    width = np.sqrt(np.maximum(12.0 * (half_trace - root), 0.0) + 1.0)
+    angle = np.degrees(0.5 * np.arctan2(2.0 * cov_xy, var_x - var_y))
+
+    # perimeter: edges between an object point and a point with another label
+    padded = np.pad(labels, 1)
+    inner = padded[1:-1, 1:-1]
+    edges = np.zeros(labels.shape, dtype=float)
+    for shifted in (padded[:-2, 1:-1], padded[2:, 1:-1], padded[1:-1, :-2], padded[1:-1, 2:]):
+        edges += shifted != inner
+    perimeter = label_sum(edges.ravel())
+
+    return pd.DataFrame({
+        "object_id": np.arange(1, n_bins),
+        "area": area.astype(int),
+        "centroid_y": cy,
+        "centroid_x": cx,
+        "length": length,
+        "width": width,
+        "angle": angle,
+        "perimeter": perimeter.astype(int),
+    })
+
+
+def match_objects(fcst_labels, obs_labels, fcst_attrs, obs_attrs,
+                  max_centroid_dist=20.0, min_overlap=0.1):
+    """
+    Matches forecast and observed objects.
+
+    The overlap of all object pairs is counted in one bincount over the
+    joint labels. A pair is kept if the overlap area is at least
+    min_overlap of the smaller object, or if the centroids are closer than
+    max_centroid_dist grid points.
+
+    Returns:
+        pd.DataFrame: one row per matched pair with the PAIR_COLUMNS.
+    """
+    n_f, n_o = len(fcst_attrs), len(obs_attrs)
+    if n_f == 0 or n_o == 0:
+        return pd.DataFrame(columns=PAIR_COLUMNS)
+    both = (fcst_labels > 0) & (obs_labels > 0)
+    joint = fcst_labels[both].astype(np.int64) * (n_o + 1) + obs_labels[both]
+    overlap = np.bincount(joint, minlength=(n_f + 1) * (n_o + 1)).reshape(n_f + 1, n_o + 1)[1:, 1:]
+
+    dy = fcst_attrs["centroid_y"].values[:, None] - obs_attrs["centroid_y"].values[None, :]
+    dx = fcst_attrs["centroid_x"].values[:, None] - obs_attrs["centroid_x"].values[None, :]
+    dist = np.hypot(dy, dx)
+    smaller = np.minimum(fcst_attrs["area"].values[:, None], obs_attrs["area"].values[None, :])
+    ratio = overlap / smaller
+
+    fi, oi = np.nonzero((ratio >= min_overlap) | (dist <= max_centroid_dist))
+    return pd.DataFrame({
+        "fcst_id": fi + 1,
+        "obs_id": oi + 1,
+        "centroid_dist": dist[fi, oi],
+        "overlap_area": overlap[fi, oi],
+        "overlap_ratio": ratio[fi, oi],
+    })
+
+
+def objects_day(date, obs_name, obs_template, fcst_templates, params):
+    """
+    Objects and matches of all models for one day. The observed objects
+    are identified once and matched against every forecast model.
+
+    Returns:
+        tuple: (objects DataFrame, pairs DataFrame)
+    """
+    stamp = date.strftime("%Y%m%d")
+    try:
+        obs = read_bin_snow(obs_template.format(date=stamp))
+    except FileNotFoundError:
+        return None, None
+    obs_labels, n_obs = identify_objects(obs, **params["identify"])
+    obs_attrs = object_attributes(obs_labels, n_obs)
+    objects = [obs_attrs.assign(source=obs_name, field="OBS")]
+    pairs = []
+    for model, template in fcst_templates.items():
+        try:
+            fcst = read_bin_snow(template.format(date=stamp))
+        except FileNotFoundError:
+            continue
+        fcst_labels, n_fcst = identify_objects(fcst, **params["identify"])
+        fcst_attrs = object_attributes(fcst_labels, n_fcst)
+        objects.append(fcst_attrs.assign(source=model, field="FCST"))
+        pairs.append(match_objects(fcst_labels, obs_labels, fcst_attrs, obs_attrs,
+                                   **params["match"]).assign(model=model))
+    objects = pd.concat(objects, ignore_index=True).assign(date=date)
+    pairs = pd.concat(pairs, ignore_index=True).assign(date=date) if pairs else None
+    return objects, pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("date_ini", help="First date, YYYY-MM-DD")
+    parser.add_argument("date_end", help="Last date, YYYY-MM-DD")
+    parser.add_argument("--obs", default="IMS", help="Observation source, NAME or NAME=TEMPLATE")
+    parser.add_argument("--fcst", nargs="+", default=["CERISE"],
+                        help="Forecast sources, NAME or NAME=TEMPLATE")
+    parser.add_argument("--conv-radius", type=int, default=0)
+    parser.add_argument("--conv-thresh", type=float, default=0.5)
+    parser.add_argument("--min-area", type=int, default=1)
+    parser.add_argument("--connectivity", type=int, choices=[4, 8], default=8)
+    parser.add_argument("--max-centroid-dist", type=float, default=20.0)
+    parser.add_argument("--min-overlap", type=float, default=0.1)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--output", default="objects.parquet",
+                        help="Objects table (.csv or .parquet); pairs go to <name>_pairs")
+    args = parser.parse_args()
+
+    obs_name, obs_template = parse_source(args.obs)
+    fcst_templates = dict(parse_source(spec) for spec in args.fcst)
+    params = {
+        "identify": {"conv_radius": args.conv_radius, "conv_thresh": args.conv_thresh,
+                     "min_area": args.min_area, "connectivity": args.connectivity},
+        "match": {"max_centroid_dist": args.max_centroid_dist,
+                  "min_overlap": args.min_overlap},
+    }
+    dates = daily_dates(args.date_ini, args.date_end)
+
+    objects, pairs = [], []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(objects_day, date, obs_name, obs_template, fcst_templates, params)
+                   for date in dates]
+        for date, future in zip(dates, futures):
+            day_objects, day_pairs = future.result()
+            if day_objects is None:
+                continue
+            print(f"{date:%Y-%m-%d}: {len(day_objects)} objects")
+            objects.append(day_objects)
+            if day_pairs is not None:
+                pairs.append(day_pairs)
+
+    if not objects:
+        print("No observation files found")
+        return
+    objects = pd.concat(objects, ignore_index=True)
+    write_table(objects[["date", "source", "field"] + OBJECT_COLUMNS], args.output)
+    if pairs:
+        stem, ext = os.path.splitext(args.output)
+        pairs = pd.concat(pairs, ignore_index=True)
+        write_table(pairs[["date", "model"] + PAIR_COLUMNS], f"{stem}_pairs{ext}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Dependency-aware runner of the convert -> mask -> verify -> aggregate chain.
+
+The verification used to be run as a sequence of bash loops
+(process_carra_land_pv2/submit_slurm.sh, then verify_carra1_land2_cryo.sh,
+then the post-processing by hand), each with its own copy of
+maxday_month. Here the whole chain is one DAG described in a YAML file
+(see carra_land_pv2_vs_cryo.yaml):
+- tasks of scope "day" are instantiated for every date and depend on the
+  tasks they need on the same date (convert obs, convert forecast, verify)
+- tasks of scope "once" run a single time (e.g. gen_vx_mask), before the
+  day tasks needing them
+- tasks of scope "all" run once after every instance of the tasks they
+  need has finished (e.g. adding the MET output to
+  post-processing/fss_store.py), skipping the days that did not complete
+
+Ready tasks are started oldest date first with a cap on the number of
+running tasks per stage, so the conversion of day N+1 overlaps the
+verification of day N. A day whose input file is missing is reported
+and its dependent tasks skipped, as the bash loops did; failed tasks are
+retried. The state of every task is kept in a JSON file, so a rerun
+only does what is not done yet.
+
+Tasks are shell commands, run in a local process pool or on SLURM jobs
+(dask-jobqueue).
+
+Usage:
+    python pipeline.py run carra_land_pv2_vs_cryo.yaml --date-ini 2015-10-01 \
+        --date-end 2015-11-30 --backend slurm --jobs 8
+    python pipeline.py status carra_land_pv2_vs_cryo.yaml
+"""
+
+import argparse
+import concurrent.futures as cf
+import json
+import os
+import subprocess
+import time
+import uuid
+
+import pandas as pd
+import yaml
+
+SCOPES = ("day", "once", "all")
+STATUSES = ("pending", "running", "done", "failed", "missing", "skipped")
+
+
+class Task:
+    """One instance of a stage (a shell command), on one date for day tasks."""
+
+    def __init__(self, stage, scope, date, command, inputs, outputs, needs, retries, log):
+        self.stage = stage
+        self.scope = scope
+        self.date = date
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+        self.needs = needs
+        self.retries = retries
+        self.log = log
+
+    @property
+    def key(self):
+        return self.stage if self.date is None else f"{self.stage}/{self.date:%Y%m%d}"
+
+    def order(self):
+        # oldest day first; once tasks before, all tasks after the days
+        if self.date is None:
+            return (pd.Timestamp.min if not self.needs else pd.Timestamp.max, self.stage)
+        return (self.date, self.stage)
+
+
+def load_config(path):
+    """Pipeline description, with the stages checked and sorted in dependency order."""
+    with open(path) as f:
+        config = yaml.safe_load(f)
+    stages = config["tasks"]
+    for name, stage in stages.items():
+        stage.setdefault("scope", "day")
+        stage.setdefault("needs", [])
+        if stage["scope"] not in SCOPES:
+            raise ValueError(f"Task {name}: unknown scope {stage['scope']}, use one of {SCOPES}")
+        unknown = set(stage["needs"]) - set(stages)
+        if unknown:
+            raise ValueError(f"Task {name} needs unknown tasks {sorted(unknown)}")
+        for need in stage["needs"]:
+            if stage["scope"] != "all" and stages[need]["scope"] == "all":
+                raise ValueError(f"Task {name} cannot need the 'all' task {need}")
+    order = []
+    while len(order) < len(stages):
+        ready = [n for n, s in stages.items() if n not in order and set(s["needs"]) <= set(order)]
+        if not ready:
+            raise ValueError(f"Dependency cycle among {sorted(set(stages) - set(order))}")
+        order.extend(ready)
+    config["tasks"] = {name: stages[name] for name in order}
+    return config
+
+
+def fill(template, date, paths, extra):
+    """
+    Formats a template with the date, the other path templates and extra
+    values, e.g. "{obs}" or "snowcover_daily_{date:%Y%m%d}.nc".
+    """
+    values = dict(extra)
+    if date is not None:
+        values["date"] = date
+        values.update({name: path.format(**values) for name, path in paths.items()})
+    else:
+        # once and all tasks only see the paths without a date
+        for name, path in paths.items():
+            if "{date" not in path:
+                values[name] = path.format(**values)
+    return template.format(**values)
+
+
+def build_tasks(config, dates):
+    """All task instances of the pipeline over the dates, keyed by Task.key."""
+    paths = config.get("paths", {})
+    extra = dict(config.get("variables", {}))
+    extra.update(date_ini=dates[0], date_end=dates[-1])
+    log_dir = config.get("logs", "logs")
+    retries = config.get("retries", 1)
+    tasks = {}
+    for name, stage in config["tasks"].items():
+        for date in (dates if stage["scope"] == "day" else [None]):
+            needs = []
+            for need in stage["needs"]:
+                if config["tasks"][need]["scope"] == "day" and date is None:
+                    needs.extend(f"{need}/{d:%Y%m%d}" for d in dates)
+                elif config["tasks"][need]["scope"] == "day":
+                    needs.append(f"{need}/{date:%Y%m%d}")
+                else:
+                    needs.append(need)
+            log = name if date is None else f"{name}_{date:%Y%m%d}"
+            task = Task(name, stage["scope"], date, fill(stage["command"], date, paths, extra),
+                        [fill(p, date, paths, extra) for p in stage.get("inputs", [])],
+                        [fill(p, date, paths, extra) for p in stage.get("outputs", [])],
+                        needs, stage.get("retries", retries), os.path.join(log_dir, f"{log}.log"))
+            tasks[task.key] = task
+    return tasks
+
+
+class PipelineState:
+    """
+    Status and number of attempts of every task, kept in a JSON file.
+
+    Args:
+        path (str): State file, created on the first update.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tasks = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.tasks = json.load(f)
+
+    def status(self, key):
+        return self.tasks.get(key, {}).get("status", "pending")
+
+    def update(self, key, status, message=None, new_attempt=False):
+        entry = self.tasks.setdefault(key, {"attempts": 0})
+        entry["status"] = status
+        entry["time"] = pd.Timestamp.now().isoformat(timespec="seconds")
+        entry["message"] = message
+        if new_attempt:
+            entry["attempts"] += 1
+        # write to a temporary file first, an interrupted run leaves the old state
+        tmp = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.tasks, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def run_command(command, log_path, outputs):
+    """
+    Runs a task command in a shell, appending its output to log_path.
+
+    Returns:
+        tuple: (return code, message)
+    """
+    os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+    for output in outputs:
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(log_path, "a") as log:
+        log.write(f"# {pd.Timestamp.now():%Y-%m-%d %H:%M:%S} {command}\n")
+        log.flush()
+        code = subprocess.run(command, shell=True, stdout=log, stderr=subprocess.STDOUT).returncode
+    if code != 0:
+        return code, f"exit code {code}, see {log_path}"
+    missing = [output for output in outputs if not os.path.exists(output)]
+    if missing:
+        return 1, f"outputs not written: {', '.join(missing)}"
+    return 0, None
+
+
+def start_executor(args):
+    """concurrent.futures executor of the backend, and a function closing it."""
+    if args.backend == "local":
+        executor = cf.ProcessPoolExecutor(max_workers=args.workers)
+        return executor, executor.shutdown
+    from dask.distributed import Client
+    from dask_jobqueue import SLURMCluster
+
+    cluster = SLURMCluster(cores=args.workers, processes=1, memory=args.memory,
+                           walltime=args.walltime, queue=args.queue, account=args.account)
+    cluster.scale(jobs=args.jobs)
+    client = Client(cluster)
+    print(f"Dask dashboard: {client.dashboard_link}")
+    # pure=False: a retried command must run again, not return the cached failure
+    return client.get_executor(pure=False), client.close
+
+
+def run(tasks, stages, state, executor, only=None, retry_delay=60.0, dry_run=False):
+    """
+    Runs the tasks not done yet, respecting the dependencies and the
+    concurrency of every stage.
+
+    Args:
+        tasks (dict): Task.key -> Task, from build_tasks.
+        stages (dict): Stage settings of the configuration (concurrency).
+        state (PipelineState): Task states, updated as the tasks finish.
+        executor: concurrent.futures executor running run_command.
+        only (list): Run only the tasks of these stages, the tasks they
+            need from other stages must already be done.
+        retry_delay (float): Seconds before a failed task is started again.
+        dry_run (bool): Only print the commands of the tasks to run.
+
+    Returns:
+        dict: Number of tasks run per final status.
+    """
+    todo = sorted((t for t in tasks.values() if state.status(t.key) != "done"
+                   and (only is None or t.stage in only)), key=Task.order)
+    in_run = {task.key for task in todo}
+    status = {key: state.status(key) for key in tasks}
+    for task in todo:
+        # interrupted runs leave tasks in running; failed ones get new attempts
+        status[task.key] = "pending"
+    if dry_run:
+        for task in todo:
+            print(f"{task.key}: {task.command}")
+        return {}
+    attempts = {task.key: 0 for task in todo}
+    not_before = {}
+    running = {}
+    limits = {name: stage.get("concurrency") for name, stage in stages.items()}
+    pending = list(todo)
+    while pending or running:
+        now = time.monotonic()
+        waiting = []
+        for task in pending:
+            blocked = [status[need] in ("failed", "missing", "skipped")
+                       or (need not in in_run and status[need] != "done") for need in task.needs]
+            # an 'all' task runs once its needs are settled, with the days that are done
+            settled = all(b or status[need] == "done" for b, need in zip(blocked, task.needs))
+            if (any(blocked) and task.scope != "all") or (settled and task.needs and all(blocked)):
+                status[task.key] = "skipped"
+                state.update(task.key, "skipped", "a needed task did not complete")
+                print(f"{task.key}: skipped")
+                continue
+            n_stage = sum(t.stage == task.stage for t in running.values())
+            ready = (settled
+                     and not_before.get(task.key, 0.0) <= now
+                     and (limits[task.stage] is None or n_stage < limits[task.stage]))
+            if not ready:
+                waiting.append(task)
+                continue
+            absent = [path for path in task.inputs if not os.path.exists(path)]
+            if absent:
+                status[task.key] = "missing"
+                state.update(task.key, "missing", f"not available: {', '.join(absent)}")
+                print(f"{task.key}: {absent[0]} not available, stepping over")
+                continue
+            attempts[task.key] += 1
+            status[task.key] = "running"
+            state.update(task.key, "running", new_attempt=True)
+            running[executor.submit(run_command, task.command, task.log, task.outputs)] = task
+        pending = waiting
+        if not running:
+            delays = [not_before[t.key] for t in pending if not_before.get(t.key, 0.0) > now]
+            if delays:
+                # only retries waiting for their delay
+                time.sleep(min(delays) - now)
+            continue
+        done, _ = cf.wait(running, timeout=retry_delay, return_when=cf.FIRST_COMPLETED)
+        for future in done:
+            task = running.pop(future)
+            try:
+                code, message = future.result()
+            except Exception as err:  # worker lost, job killed by SLURM, ...
+                code, message = 1, repr(err)
+            if code == 0:
+                status[task.key] = "done"
+                state.update(task.key, "done")
+                print(f"{task.key}: done")
+            elif attempts[task.key] <= task.retries:
+                status[task.key] = "pending"
+                state.update(task.key, "pending", message)
+                not_before[task.key] = time.monotonic() + retry_delay
+                pending.append(task)
+                print(f"{task.key}: {message}, retrying ({attempts[task.key]}/{task.retries})")
+            else:
+                status[task.key] = "failed"
+                state.update(task.key, "failed", message)
+                print(f"{task.key}: failed, {message}")
+        pending.sort(key=Task.order)
+    return {s: sum(status[t.key] == s for t in todo) for s in STATUSES if s != "running"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("run", "status"):
+        cmd = sub.add_parser(name)
+        cmd.add_argument("config", help="Pipeline YAML file")
+        cmd.add_argument("--date-ini", help="First date, YYYY-MM-DD (default: config dates)")
+        cmd.add_argument("--date-end", help="Last date, YYYY-MM-DD")
+        cmd.add_argument("--state", help="State file (default: config state)")
+    run_cmd = sub.choices["run"]
+    run_cmd.add_argument("--only", nargs="+", help="Run only these tasks (their needs must be done)")
+    run_cmd.add_argument("--rerun", nargs="+", default=[],
+                         help="Run these tasks again even if done")
+    run_cmd.add_argument("--backend", choices=("local", "slurm"), default="local")
+    run_cmd.add_argument("--workers", type=int, default=8,
+                         help="Processes of the local pool (cores per SLURM job)")
+    run_cmd.add_argument("--jobs", type=int, default=4, help="SLURM jobs")
+    run_cmd.add_argument("--memory", default="64GB", help="Memory per SLURM job")
+    run_cmd.add_argument("--walltime", default="48:00:00")
+    run_cmd.add_argument("--queue")
+    run_cmd.add_argument("--account")
+    run_cmd.add_argument("--retry-delay", type=float, default=60.0,
+                         help="Seconds before a failed task is retried")
+    run_cmd.add_argument("--dry-run", action="store_true", help="Print the commands to run")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    dates = pd.date_range(args.date_ini or config["dates"]["start"],
+                          args.date_end or config["dates"]["end"], freq="D")
+    tasks = build_tasks(config, dates)
+    state = PipelineState(args.state or config.get("state", "pipeline_state.json"))
+
+    if args.command == "status":
+        table = pd.DataFrame([{"task": t.stage, "date": t.date, "status": state.status(key)}
+                              for key, t in tasks.items()])
+        print(table.pivot_table(index="task", columns="status", values="date", aggfunc="size",
+                                fill_value=0).reindex(list(config["tasks"])).to_string())
+        failed = [key for key in tasks if state.status(key) == "failed"]
+        for key in failed:
+            print(f"{key}: {state.tasks[key]['message']}")
+        return
+
+    unknown = (set(args.only or []) | set(args.rerun)) - set(config["tasks"])
+    if unknown:
+        parser.error(f"unknown tasks {sorted(unknown)}")
+    for key, task in tasks.items():
+        if task.stage in args.rerun and state.status(key) == "done":
+            state.tasks[key]["status"] = "pending"
+
+    executor, close = (None, lambda: None) if args.dry_run else start_executor(args)
+    try:
+        counts = run(tasks, config["tasks"], state, executor, args.only, args.retry_delay,
+                     args.dry_run)
+    finally:
+        close()
+    if counts:
+        print(", ".join(f"{n} {s}" for s, n in counts.items() if n))
+
+
+if __name__ == "__main__":
+    main()